@@ -9,6 +9,7 @@ from application.routes.user_routes import user_bp
 from application.routes.agent_routes import agent_bp
 from application.routes.chat_routes import chat_bp
 from application.routes.session_routes import session_bp
+from application.routes.stats_routes import stats_bp
 from utils.access_control import limiter
 import os
 
@@ -30,6 +31,7 @@ def create_app():
     app.register_blueprint(agent_bp)
     app.register_blueprint(chat_bp)
     app.register_blueprint(session_bp)
+    app.register_blueprint(stats_bp)
 
     @app.route('/receive_data', methods=['POST'])
     def receive_data():
@@ -8,6 +8,7 @@ from database.db_functions import *
 from flask import Blueprint, render_template, redirect, url_for, request, flash, session, jsonify
 from utils.gpt_api import validate_api_key
 from utils.access_control import has_access, limiter, custom_limit_key
+from utils.utils import DEFAULT_HISTORY_MAX_TURNS, DEFAULT_HISTORY_TOKEN_BUDGET
 
 
 # Создаем blueprint для маршрутов, связанных с агентами
@@ -69,6 +70,9 @@ def agent_settings(agent_id=None):
         temperature = float(request.form.get('temperature')) / 100  # Конвертируем значение из диапазона 0-100 в 0-1
         max_tokens = request.form.get('max_tokens')
         api_key = request.form.get('api_key')
+        history_max_turns = request.form.get('history_max_turns', DEFAULT_HISTORY_MAX_TURNS)
+        history_token_budget = request.form.get('history_token_budget', DEFAULT_HISTORY_TOKEN_BUDGET)
+        response_cache_enabled = request.form.get('response_cache_enabled') is not None
         # Проверка на отсутствие обязательных полей
         if not all([name, instruction, start_message, error_message, api_key]):
             flash("Все поля должны быть заполнены корректно!", "error")
@@ -77,12 +81,17 @@ def agent_settings(agent_id=None):
         if int(max_tokens) < 0:
             flash("Максимальное количество токенов не может быть отрицательными.", "error")
             return redirect(url_for('agent_bp.agent_settings', agent_id=agent_id))
+        if int(history_max_turns) < 0 or int(history_token_budget) < 0:
+            flash("Параметры истории диалога не могут быть отрицательными.", "error")
+            return redirect(url_for('agent_bp.agent_settings', agent_id=agent_id))
         # Проверка валидности API Key
         if not validate_api_key(api_key):
             flash("API Key недействителен. Проверьте корректность ключа.", "error")
             return redirect(url_for('agent_bp.agent_settings', agent_id=agent_id))
         # Преобразование значений для базы данных
         max_tokens = int(max_tokens)
+        history_max_turns = int(history_max_turns)
+        history_token_budget = int(history_token_budget)
         settings = {
             'name': name,
             'instruction': instruction,
@@ -90,7 +99,10 @@ def agent_settings(agent_id=None):
             'error_message': error_message,
             'temperature': temperature,
             'max_tokens': max_tokens,
-            'api_key': api_key
+            'api_key': api_key,
+            'history_max_turns': history_max_turns,
+            'history_token_budget': history_token_budget,
+            'response_cache_enabled': response_cache_enabled
         }
         if agent:
             update_agent_settings(agent_id, settings)
@@ -104,7 +116,10 @@ def agent_settings(agent_id=None):
                 error_message=error_message,
                 temperature=temperature,
                 max_tokens=max_tokens,
-                api_key=api_key
+                api_key=api_key,
+                history_max_turns=history_max_turns,
+                history_token_budget=history_token_budget,
+                response_cache_enabled=response_cache_enabled
             )
             flash("Агент создан", "success")
         return redirect(url_for('agent_bp.agent_selection'))
@@ -3,12 +3,15 @@ chat_routes.py
 Модуль маршрутов (роутов) для управления функционалом чата. Включает маршруты для взаимодействия с ботом,
 получения истории чата и очистки чата. Использует подключение к базе данных для хранения и извлечения сообщений.
 Также используется для отображения переписок пользователей и сессий (ботов).
+Ответ бота в веб-чате передаётся потоком Server-Sent Events (/chat_stream) по мере генерации.
 """
 
 from database.db_functions import *
-from flask import Blueprint, render_template, redirect, url_for, request, flash, session, jsonify
-from utils.gpt_api import generate_response
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session, jsonify, Response
+from utils.gpt_api import generate_response, generate_response_stream
+from utils.utils import get_history_window
 from utils.access_control import has_access, limiter, custom_limit_key
+import json
 
 
 # Создаем blueprint для маршрутов, связанных с чатом
@@ -49,9 +52,12 @@ def chat():
             return jsonify({"error": "Требуются ID агента и сообщение"}), 400
 
         try:
-            # Получаем и обновляем историю чата из базы данных
-            my_chat_history = get_chat_history_by_user_and_agent(user_id, agent_id, chat_type_id) or []
-            response = generate_response(agent_id, user_input, my_chat_history)
+            # Получаем из базы данных последние сообщения чата в пределах окна истории агента
+            agent = get_agent_by_id(agent_id)
+            max_turns, token_budget = get_history_window(agent)
+            my_chat_history = get_recent_chat_history_by_user_and_agent(user_id, agent_id, chat_type_id,
+                                                                        max_turns, token_budget)
+            response = generate_response(agent_id, user_input, my_chat_history, agent=agent)
             # Сохраняем сообщение пользователя и ответ бота в базу данных
             insert_chat_message(user_id, agent_id, chat_type_id, user_input, response)
             return jsonify({"response": response})
@@ -60,6 +66,66 @@ def chat():
             return jsonify({"error": str(e)}), 500
 
 
+def sse_event(data, event=None):
+    """
+    Формирует событие Server-Sent Events с данными в формате JSON.
+    :param data: Данные события.
+    :param event: Тип события (по умолчанию message).
+    """
+    payload = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"event: {event}\n{payload}" if event else payload
+
+
+@chat_bp.route('/chat_stream', methods=['POST'])
+@limiter.limit("5 per minute", key_func=custom_limit_key)
+def chat_stream():
+    """
+    Маршрут для получения ответа бота в чате потоком Server-Sent Events.
+
+    Обрабатывает POST запрос с тем же телом, что и /chat, и возвращает поток событий:
+    - без типа: {"delta": фрагмент ответа} по мере генерации;
+    - done: {"response": полный ответ} после завершения, полный ответ сохраняется в историю чата;
+    - error: {"error": текст ошибки}.
+
+    :return: Поток text/event-stream или JSON с ошибкой.
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "Пожалуйста, авторизуйтесь"}), 401
+
+    user_id = session['user_id']
+    data = request.get_json()
+    agent_id = data.get('agent_id')
+    chat_type_id = data.get('chat_type_id')
+    user_input = data.get('message')
+    if not agent_id or not user_input:
+        return jsonify({"error": "Требуются ID агента и сообщение"}), 400
+
+    agent = get_agent_by_id(agent_id)
+    if not agent:
+        return jsonify({"error": "Агент не найден"}), 404
+    max_turns, token_budget = get_history_window(agent)
+    my_chat_history = get_recent_chat_history_by_user_and_agent(user_id, agent_id, chat_type_id,
+                                                                max_turns, token_budget)
+
+    def events():
+        parts = []
+        try:
+            for delta in generate_response_stream(agent_id, user_input, my_chat_history, agent=agent):
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+            return
+        response = "".join(parts)
+        # Сохраняем сообщение пользователя и полный ответ бота в базу данных
+        insert_chat_message(user_id, agent_id, chat_type_id, user_input, response)
+        yield sse_event({"response": response}, event="done")
+
+    # X-Accel-Buffering отключает буферизацию ответа в nginx, чтобы события доходили до браузера сразу
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @chat_bp.route('/chat_history', methods=['GET'])
 @limiter.limit("5 per minute", key_func=custom_limit_key)
 def chat_history():
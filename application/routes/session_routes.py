@@ -13,12 +13,11 @@ import asyncio
 from asyncio import run_coroutine_threadsafe
 from flask import Blueprint, render_template, redirect, url_for, request, flash, session, jsonify
 from database.db_functions import *
-from application.services.telegram.bot_manager import telegram_bot_manager
+from application.services.telegram.webhook_server import WEBHOOK_PORT
 from application.services.whatsapp.bot_manager import whatsapp_bot_manager
 from utils.gpt_api import generate_response
 from utils.logs.logger import logger
-from utils.utils import create_update_from_json, get_telegram_bot_name_and_username_by_token
-from aiogram.types import Update
+from utils.utils import get_telegram_bot_name_and_username_by_token, get_history_window
 from flask import current_app
 from application.services.telegram.bot_configurator import *
 from werkzeug.utils import secure_filename
@@ -104,8 +103,7 @@ def create_session(agent_id):
                 return redirect(url_for('session_bp.assign_platform', agent_id=agent_id))
             flash(f"Сессия {session_id} успешно создана.", "success")
             # Привязка вебхука и сохранение бота
-            webhook_port = get_last_webhook_port()
-            add_telegram_bot(session_id, api_token, bot_name, f'@{bot_username}', webhook_port)
+            add_telegram_bot(session_id, api_token, bot_name, f'@{bot_username}', WEBHOOK_PORT)
             flash('Telegram бот успешно создан!', 'success')
         # WhatsApp (бот)
         if platform_id == 4:
@@ -169,32 +167,6 @@ def sessions():
         return redirect(url_for('agent_bp.agent_selection'))
 
 
-@session_bp.route('/webhook/<int:session_id>', methods=['POST'])
-@limiter.limit("5 per minute", key_func=custom_limit_key)
-def webhook(session_id):
-    """
-    Обработка обновлений от Telegram или WhatsApp.
-    """
-    user_session = get_session_by_id(session_id)
-    # Telegram (бот)
-    if user_session['chat_type_id'] == 2:
-        bot_runner = telegram_bot_manager.get_bot(session_id)
-        if not bot_runner:
-            logger.log(f"Bot for session {session_id} not found", level="ERROR")
-            return jsonify({"error": "Bot not found"}), 404
-        update_data = request.get_json()
-        try:
-            update = create_update_from_json(update_data)
-            loop = current_app.config["event_loop"]
-            asyncio.run_coroutine_threadsafe(
-                bot_runner.dp.feed_update(bot_runner.bot, update), loop
-            )
-            return jsonify({"status": "success"}), 200
-        except Exception as e:
-            logger.log(f"Error processing webhook for session {session_id}: {str(e)}", level="ERROR")
-            return jsonify({"error": str(e)}), 500
-
-
 @session_bp.route('/sessions/activate/<int:session_id>', methods=['POST'])
 @limiter.limit("5 per minute", key_func=custom_limit_key)
 def activate_session(session_id):
@@ -213,8 +185,7 @@ def activate_session(session_id):
             user_session = get_session_by_id(session_id)
             if user_session:
                 token = user_session['api_token']
-                port = user_session['webhook_port']
-                asyncio.run_coroutine_threadsafe(telegram_bot_manager.start_bot(session_id, token, port), current_app.config["event_loop"])
+                asyncio.run_coroutine_threadsafe(current_app.config["telegram_bots"].start_bot(session_id, token), current_app.config["event_loop"])
                 activate_session_in_db(session_id)
                 flash(f"Сессия {session_id} успешно активирована!", "success")
             else:
@@ -261,7 +232,7 @@ def terminate_session(session_id):
     # Telegram (бот)
     if user_session['chat_type_id'] == 2:
         try:
-            asyncio.run_coroutine_threadsafe(telegram_bot_manager.stop_bot(session_id), current_app.config["event_loop"])
+            asyncio.run_coroutine_threadsafe(current_app.config["telegram_bots"].stop_bot(session_id), current_app.config["event_loop"])
             terminate_session_in_db(session_id)
             flash(f"Сессия {session_id} успешно завершена!", "success")
         except Exception as e:
@@ -393,9 +364,13 @@ def get_whatsapp_bot_answer(session_id):
     user_id = get_last_user_id()
     if not check_user_exists_by_full_name(user_full_name):
         insert_user(user_id, '', '', 4, user_full_name)
-    session = get_session_by_id(session_id)
-    agent = get_agent_by_id(session['agent_id'])
-    conversation_history = get_chat_history_by_session_id_and_user_id(session_id, user_id) or []
-    response = generate_response(agent_id=agent['id'], user_input=user_message, conversation_history=conversation_history)
+    context = get_message_context(session_id, user_id)
+    if context is None:
+        return jsonify({"error": "Сессия не найдена"}), 404
+    agent = context['agent']
+    max_turns, token_budget = get_history_window(agent)
+    conversation_history = get_recent_chat_history_by_session_id_and_user_id(session_id, user_id, max_turns, token_budget)
+    response = generate_response(agent_id=agent['id'], user_input=user_message, conversation_history=conversation_history,
+                                 agent=agent)
     insert_chat_message_for_session(user_id, agent['id'], 4, session_id, user_message, response)
     return jsonify({"session_id": session_id, "bot_answer": response})
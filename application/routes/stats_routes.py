@@ -0,0 +1,60 @@
+"""
+stats_routes.py
+Модуль маршрутов для просмотра внутренней статистики приложения (пул соединений и кэши базы данных и т.д.).
+Доступен только администраторам.
+"""
+
+from flask import Blueprint, redirect, url_for, flash, session, jsonify
+from database.db_connection import db_pool
+from database.db_async_connection import async_db_pool
+from database.db_cache import cache_stats
+from database.db_write_buffer import chat_write_buffer
+from application.services.telegram.debounce import message_debouncer
+from application.services.telegram.webhook_server import webhook_server
+from application.services.telegram.update_dispatcher import update_dispatcher
+from application.services.telegram.update_dedup import update_deduplicator
+from application.services.telegram.send_scheduler import send_scheduler
+from application.services.telegram.bot_manager import telegram_bot_manager
+from application.services.telegram.http_session import http_session_stats
+from application.services.telegram.sharding import shard_supervisor
+from application.services.telegram.leases import bot_leases
+from utils.llm_client import llm_clients
+from utils.gpt_api import api_key_validation_cache, single_flight
+from utils.llm_cache import response_cache
+from utils.llm_scheduler import llm_scheduler
+
+
+# Создаем blueprint для маршрутов статистики
+stats_bp = Blueprint('stats_bp', __name__)
+
+
+@stats_bp.route('/stats', methods=['GET'])
+def stats():
+    """
+    Возвращает внутреннюю статистику приложения в формате JSON.
+
+    :return: JSON со статистикой или перенаправление, если пользователь не администратор.
+    """
+    if session.get('role_id') != 1:
+        flash("У вас нет прав доступа", "error")
+        return redirect(url_for('user_bp.login'))
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "async_db_pool": async_db_pool.stats(),
+        "db_cache": cache_stats(),
+        "chat_write_buffer": chat_write_buffer.stats(),
+        "llm_clients": llm_clients.stats(),
+        "api_key_validation": api_key_validation_cache.stats(),
+        "llm_response_cache": response_cache.stats(),
+        "llm_single_flight": single_flight.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "telegram_debounce": message_debouncer.stats(),
+        "telegram_webhooks": webhook_server.stats(),
+        "telegram_dispatcher": update_dispatcher.stats(),
+        "telegram_dedup": update_deduplicator.stats(),
+        "telegram_outbound": send_scheduler.stats(),
+        "telegram_bots": telegram_bot_manager.stats(),
+        "telegram_http_session": http_session_stats(),
+        "telegram_shards": shard_supervisor.stats(),
+        "telegram_leases": bot_leases.stats(),
+    })
@@ -7,7 +7,6 @@ user_routes.py
 
 from database.db_functions import *
 from flask import Blueprint, render_template, redirect, url_for, request, flash, session
-from database.db_connection import db_instance
 from utils.access_control import has_access, limiter, custom_limit_key
 from utils.utils import validate_full_name, validate_email, validate_phone_number, validate_password
 
@@ -5,82 +5,313 @@ bot_manager.py
 ботов, а также обработки нескольких ботов одновременно.
 
 Основные функции:
-- `start_bot(session_id, token, port)`: Запускает бота для указанной сессии, если он ещё не запущен.
-Использует класс `TelegramBotRunner` для выполнения старта бота и его webhook.
-- `stop_bot(session_id)`: Останавливает бота для указанной сессии, завершив его webhook.
-- `start_all_bots(sessions)`: Запускает все боты для списка сессий асинхронно.
-- `stop_all_bots()`: Останавливает все боты.
+- `start_bot(session_id, token)`: Запускает бота для указанной сессии, если он ещё не запущен, и устанавливает
+его вебхук. Все боты регистрируются на одном общем сервере вебхуков (`webhook_server`), который запускается вместе
+с первым ботом.
+- `stop_bot(session_id)`: Останавливает бота для указанной сессии, удаляя его webhook.
+- `start_all_bots(sessions)`: Запускает все боты для списка сессий асинхронно. Данные для запуска (токен,
+настройки агента) уже содержатся в сессиях, а одновременная регистрация вебхуков ограничена семафором
+(TELEGRAM_WEBHOOK_CONCURRENCY).
+- `stop_all_bots()`: Завершает работу всех ботов при остановке приложения: останавливает сервер вебхуков и закрывает
+общую HTTP-сессию ботов. Вебхуки не удаляются, поэтому Telegram сохранит обновления до следующего запуска.
 - `get_bot(session_id)`: Возвращает экземпляр бота для указанной сессии.
+- `reconcile(sessions)`: Оставляет зарегистрированными только боты указанных сессий (используется процессами-
+обработчиками при перераспределении сессий, см. sharding.py).
+- `sync_leases()`: В режиме кластера (TELEGRAM_CLUSTER_MODE=true) продлевает аренду сессий узла и оставляет
+зарегистрированными только боты арендованных сессий. Вызывается периодически после `start_all_bots` (см. leases.py).
+
+Экземпляры `TelegramBotRunner` (бот, диспетчер и обработчики) создаются лениво - при первом
+обновлении для сессии (`activate`), и выгружаются после TELEGRAM_BOT_IDLE_TIMEOUT секунд без обновлений.
+Для зарегистрированного, но выгруженного бота в памяти хранится только токен, поэтому память зависит от числа
+активных диалогов, а не от числа ботов. Соединения с Bot API берутся из общего пула (см. http_session.py).
+При TELEGRAM_LAZY_BOTS=true (по умолчанию) при старте приложения боты только регистрируются: их вебхуки уже
+установлены в Telegram. Исключение - боты, вебхук которых установлен на другой порт (`bots.webhook_port` отличается
+от TELEGRAM_WEBHOOK_PORT, например до перехода на общий сервер вебхуков, когда у каждого бота был свой порт):
+их вебхук устанавливается заново без удаления накопленных обновлений, а порт сохраняется в базе.
+TELEGRAM_RESET_WEBHOOKS=true переустанавливает вебхуки всех ботов при старте (например, после смены SERVER_ADDRESS).
 
 Этот модуль используется для централизованного управления ботов в приложении, обеспечивая возможность асинхронной
 работы с множеством ботов и их настройки.
 """
 
 import asyncio
+import time
 from application.services.telegram.runner import TelegramBotRunner
-from database.db_functions import get_last_webhook_port, get_webhook_port
+from application.services.telegram.webhook_server import webhook_server, WEBHOOK_PORT
+from application.services.telegram.http_session import telegram_http_session
+from application.services.telegram.leases import bot_leases
+from database import db_async_functions as async_db
 from utils.logs.logger import logger
+from dotenv import load_dotenv
+import os
+
+
+load_dotenv()
+
+# Максимальное количество одновременных вызовов set_webhook при запуске ботов
+WEBHOOK_CONCURRENCY = int(os.getenv('TELEGRAM_WEBHOOK_CONCURRENCY', 20))
+# Регистрировать ли боты при старте приложения без создания экземпляров и повторной установки вебхуков
+LAZY_BOTS = os.getenv('TELEGRAM_LAZY_BOTS', 'true').lower() in ('1', 'true', 'yes')
+# Время простоя в секундах, после которого экземпляр бота выгружается. 0 отключает выгрузку
+BOT_IDLE_TIMEOUT = float(os.getenv('TELEGRAM_BOT_IDLE_TIMEOUT', 900))
+# Переустанавливать ли вебхуки всех ботов при старте приложения
+RESET_WEBHOOKS = os.getenv('TELEGRAM_RESET_WEBHOOKS', 'false').lower() in ('1', 'true', 'yes')
 
 
 class TelegramBotManager:
 
     def __init__(self):
-        self.bots = {}
+        self.tokens = {}  # ID сессии -> токен зарегистрированного бота
+        self.bots = {}  # ID сессии -> созданный экземпляр TelegramBotRunner
+        self.webhook_semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+        self.idle_timeout = BOT_IDLE_TIMEOUT
+        self._hibernation_task = None
+        self.session_filter = None  # Функция отбора сессий процесса по ID (в режиме супервизора)
+        self._lease_task = None
+        self._lease_lock = asyncio.Lock()
+        self._stats = {
+            "activations": 0,
+            "hibernations": 0,
+        }
+
+    def register(self, session_id, token):
+        """
+        Регистрирует бота сессии без создания экземпляра: обновления для него принимаются сервером вебхуков,
+        а экземпляр создаётся при первом из них.
+        """
+        self.tokens[session_id] = token
+        webhook_server.register(session_id, lambda: self.activate(session_id))
+        if self.idle_timeout > 0 and self._hibernation_task is None:
+            self._hibernation_task = asyncio.create_task(self._hibernate_idle_bots())
+
+    def activate(self, session_id):
+        """
+        Возвращает экземпляр бота зарегистрированной сессии, создавая его при необходимости.
+        """
+        bot_runner = self.bots.get(session_id)
+        if bot_runner is None:
+            bot_runner = self.bots[session_id] = TelegramBotRunner(session_id, self.tokens[session_id])
+            self._stats["activations"] += 1
+        bot_runner.touch()
+        return bot_runner
+
+    async def _hibernate_idle_bots(self):
+        """
+        Фоновая задача: выгружает экземпляры ботов, не получавших обновлений дольше idle_timeout секунд.
+        """
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_timeout / 2))
+            now = time.monotonic()
+            idle = [session_id for session_id, bot_runner in self.bots.items()
+                    if not bot_runner.in_flight and now - bot_runner.last_used > self.idle_timeout]
+            for session_id in idle:
+                del self.bots[session_id]
+            self._stats["hibernations"] += len(idle)
 
-    async def start_bot(self, session_id, token, port):
+    async def start_bot(self, session_id, token, drop_pending_updates=True):
         """
-        Асинхронный запуск бота по session_id, token и port.
+        Асинхронный запуск бота по session_id и token: регистрация на сервере вебхуков и установка вебхука.
+        :param drop_pending_updates: Удалить ли обновления, накопленные Telegram. При захвате сессии у другого узла
+        передаётся False: обновления, пришедшие, пока прежний владелец был недоступен, должны быть обработаны.
         """
-        if session_id in self.bots:
+        if session_id in self.tokens:
             print(f"Бот {session_id} уже запущен.")
             return
+        if bot_leases.enabled and not await bot_leases.claim(session_id):
+            logger.log(f"Бот {session_id} обслуживается другим узлом кластера", "WARNING")
+            return
 
-        bot_runner = TelegramBotRunner(session_id, token, port)
-        self.bots[session_id] = bot_runner
         try:
-            await bot_runner.start_webhook()
+            await webhook_server.start()
+            self.register(session_id, token)
+            await self.activate(session_id).start_webhook(self.webhook_semaphore, drop_pending_updates)
             logger.log(f"Бот {session_id} успешно запущен")
         except Exception as e:
             logger.log(f"Бот {session_id} не запущен, ошибка: {e}", "ERROR")
+            self.release(session_id)
+            if bot_leases.enabled:
+                await bot_leases.release([session_id])
 
 
     async def stop_bot(self, session_id):
         """
         Асинхронная остановка бота по session_id.
         """
-        if session_id not in self.bots:
+        if session_id not in self.tokens:
+            if bot_leases.enabled:
+                # Бот обслуживается другим узлом кластера: вебхук удаляется здесь, а узел-владелец снимет бота
+                # деактивированной сессии при следующем продлении аренды
+                session = await async_db.get_session_by_id(session_id)
+                if session:
+                    await TelegramBotRunner(session_id, session['api_token']).stop_webhook()
+                return
             print(f"Бот для сессии {session_id} не запущен.")
             return
 
-        bot_runner = self.bots.pop(session_id)
+        webhook_server.unregister(session_id)
+        bot_runner = self.bots.pop(session_id, None) or TelegramBotRunner(session_id, self.tokens[session_id])
+        del self.tokens[session_id]
 
         await bot_runner.stop_webhook()
+        if bot_leases.enabled:
+            await bot_leases.release([session_id])
         print(f"Бот для сессии {session_id} остановлен.")
 
+    def release(self, session_id):
+        """
+        Снимает бота сессии с этого процесса без удаления вебхука: сессию обслуживает другой обработчик.
+        Уже принятые обновления сессии обрабатываются этим процессом до конца.
+        """
+        token = self.tokens.pop(session_id, None)
+        bot_runner = self.bots.pop(session_id, None)
+
+        def drain():
+            nonlocal bot_runner
+            if bot_runner is None:
+                bot_runner = TelegramBotRunner(session_id, token)
+            bot_runner.touch()
+            return bot_runner
+
+        webhook_server.unregister(session_id, drain if token is not None else None)
+
+    async def reconcile(self, sessions):
+        """
+        Приводит набор зарегистрированных ботов к списку сессий: боты других сессий снимаются, новые запускаются.
+        :param sessions: Сессии из get_all_active_telegram_sessions(), принадлежащие этому процессу.
+        """
+        owned = {session['id'] for session in sessions}
+        for session_id in [session_id for session_id in self.tokens if session_id not in owned]:
+            self.release(session_id)
+        await self._start_sessions([session for session in sessions if session['id'] not in self.tokens])
+
+    def hold_leases(self):
+        """
+        Запускает периодическое продление аренды сессий узла, если оно ещё не запущено.
+        """
+        if self._lease_task is None:
+            self._lease_task = asyncio.create_task(self._renew_leases())
+
+    async def _renew_leases(self):
+        """
+        Фоновая задача: продлевает аренду каждые heartbeat_interval секунд.
+        """
+        while True:
+            try:
+                await self.sync_leases()
+            except Exception as e:
+                logger.log(f"Ошибка при продлении аренды Telegram-сессий: {e}", "ERROR")
+            await asyncio.sleep(bot_leases.heartbeat_interval)
+
+    async def sync_leases(self):
+        """
+        Продлевает аренду сессий узла, захватывает свободные и истёкшие и приводит к ним набор зарегистрированных
+        ботов. Сессии, захваченные у другого узла, запускаются с установкой вебхука на адрес этого узла.
+        """
+        async with self._lease_lock:
+            sessions = await async_db.get_all_active_telegram_sessions()
+            candidates = [session for session in sessions
+                          if self.session_filter is None or self.session_filter(session['id'])]
+            held, taken_over = None, None
+            # Пустой список сессий возвращается и при ошибке базы данных, поэтому аренда в этом случае не продлевается
+            if sessions:
+                held, taken_over = await bot_leases.heartbeat([session['id'] for session in candidates])
+            if held is None:
+                if bot_leases.lapse() and self.tokens:
+                    logger.log(f"Аренда Telegram-сессий не продлена, боты сняты с узла: {len(self.tokens)}", "ERROR")
+                    for session_id in list(self.tokens):
+                        self.release(session_id)
+                return
+            for session_id in [session_id for session_id in self.tokens if session_id not in held]:
+                # Аренду захватил другой узел, сессия передана другому обработчику или деактивирована
+                self.release(session_id)
+            new_sessions = [session for session in candidates
+                            if session['id'] in held and session['id'] not in self.tokens]
+            await self._start_sessions([session for session in new_sessions if session['id'] not in taken_over])
+            await asyncio.gather(*(self.start_bot(session['id'], session['api_token'], drop_pending_updates=False)
+                                   for session in new_sessions if session['id'] in taken_over))
+
     async def start_all_bots(self, sessions):
         """
-        Асинхронный запуск всех активных ботов (сессий).
+        Асинхронный запуск всех активных ботов (сессий). В режиме кластера запускаются только боты сессий,
+        арендованных узлом: список сессий перечитывается при каждом продлении аренды.
+        :param sessions: Сессии из get_all_active_telegram_sessions() с токеном бота.
         """
-        tasks = []
-        for session in sessions:
-            session_id = session['id']
-            token = session['api_token']
-            port = get_webhook_port(session_id)
-            tasks.append(self.start_bot(session_id, token, port))
+        if bot_leases.enabled:
+            await webhook_server.start()
+            self.hold_leases()
+            return
+        await self._start_sessions(sessions)
+
+    async def _start_sessions(self, sessions):
+        """
+        Регистрирует (TELEGRAM_LAZY_BOTS=true) или запускает с установкой вебхука боты сессий.
+        Вебхуки, установленные на другой порт, устанавливаются заново в обоих режимах.
+        """
+        stale = [session for session in sessions if RESET_WEBHOOKS or session.get('webhook_port') != WEBHOOK_PORT]
+        if LAZY_BOTS:
+            await webhook_server.start()
+            stale_ids = {session['id'] for session in stale}
+            for session in sessions:
+                if session['id'] not in self.tokens and session['id'] not in stale_ids:
+                    self.register(session['id'], session['api_token'])
+            logger.log(f"Зарегистрировано Telegram-ботов: {len(sessions) - len(stale)}, "
+                       f"переустановка вебхуков: {len(stale)}")
+            await asyncio.gather(*(self._repoint_webhook(session) for session in stale))
+            return
+        stale_ids = {session['id'] for session in stale}
+        tasks = [self._repoint_webhook(session) if session['id'] in stale_ids
+                 else self.start_bot(session['id'], session['api_token']) for session in sessions]
         await asyncio.gather(*tasks)
 
+    async def _repoint_webhook(self, session):
+        """
+        Устанавливает вебхук бота на текущий адрес без удаления накопленных обновлений и сохраняет порт вебхука.
+        """
+        await self.start_bot(session['id'], session['api_token'], drop_pending_updates=False)
+        if session['id'] in self.tokens and session.get('webhook_port') != WEBHOOK_PORT:
+            await async_db.update_webhook_port(session['id'], WEBHOOK_PORT)
+
     async def stop_all_bots(self):
         """
-        Асинхронная остановка всех запущенных ботов.
+        Завершение работы всех ботов при остановке приложения: сервер вебхуков дорабатывает принятые обновления
+        и останавливается, общая HTTP-сессия ботов закрывается. Вебхуки остаются установленными.
         """
-        tasks = [self.stop_bot(session_id) for session_id in self.bots.keys()]
-        await asyncio.gather(*tasks)
+        if self._hibernation_task is not None:
+            self._hibernation_task.cancel()
+            self._hibernation_task = None
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+            self._lease_task = None
+        await webhook_server.stop()
+        if bot_leases.enabled:
+            # Аренда освобождается, чтобы другие узлы захватили сессии, не дожидаясь её истечения
+            await bot_leases.release(list(bot_leases.held))
+        for session_id in list(self.tokens.keys()):
+            webhook_server.unregister(session_id)
+        self.tokens.clear()
+        self.bots.clear()
+        await telegram_http_session.close()
 
     def get_bot(self, session_id):
         """
-        Возвращает экземпляр бота.
+        Возвращает экземпляр бота (создаёт его, если бот зарегистрирован, но выгружен).
+        """
+        if session_id not in self.tokens:
+            return None
+        return self.activate(session_id)
+
+    def stats(self):
+        """
+        Возвращает статистику ботов.
+        :return: Словарь с количеством зарегистрированных ботов, созданных экземпляров и счётчиками создания и выгрузки.
         """
-        return self.bots.get(session_id)
+        return {
+            "lazy": LAZY_BOTS,
+            "idle_timeout": self.idle_timeout,
+            "registered": len(self.tokens),
+            "active": len(self.bots),
+            **self._stats,
+        }
 
 
-telegram_bot_manager = TelegramBotManager()
\ No newline at end of file
+telegram_bot_manager = TelegramBotManager()
@@ -0,0 +1,99 @@
+"""
+debounce.py
+Модуль объединения серий сообщений пользователя в один ход диалога (debounce).
+
+Пользователи Telegram часто отправляют несколько коротких сообщений подряд. Вместо отдельного запроса к истории,
+вызова модели и записи в базу на каждое из них текстовые сообщения одного диалога, пришедшие с интервалом меньше
+TELEGRAM_DEBOUNCE_MS миллисекунд, собираются в одну серию. Диспетчер обновлений (update_dispatcher.py) передаёт серию
+в обработку, когда пользователь замолчал (но не позже TELEGRAM_DEBOUNCE_MAX_WAIT_MS с первого сообщения): обработчик
+получает последнее сообщение серии и тексты всех её сообщений (`merged_texts`).
+
+Команды и сообщения без текста не объединяются и обрабатываются по отдельности.
+TELEGRAM_DEBOUNCE_MS=0 отключает объединение: каждое сообщение обрабатывается отдельно, как раньше.
+"""
+
+from dotenv import load_dotenv
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+
+def merge_message_texts(texts):
+    """
+    Объединяет тексты сообщений серии в один ввод пользователя (по одному сообщению на строку).
+    :param texts: Список текстов сообщений серии в порядке отправки.
+    :return: Объединенный текст.
+    """
+    return "\n".join(text for text in texts if text)
+
+
+class MessageDebouncer:
+    """
+    Правила объединения сообщений диалога в серии и статистика объединения.
+    """
+
+    def __init__(self, name, window, max_wait):
+        """
+        :param name: Имя (используется в статистике).
+        :param window: Окно ожидания следующего сообщения в секундах. 0 отключает объединение.
+        :param max_wait: Максимальное время сбора серии с первого сообщения в секундах.
+        """
+        self.name = name
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self._stats = {
+            "messages": 0,
+            "turns": 0,
+            "merged": 0,
+            "max_burst": 0,
+        }
+
+    def mergeable(self, update):
+        """
+        Проверяет, может ли обновление Telegram войти в серию: это текстовое сообщение, не являющееся командой.
+        :param update: Обновление в виде словаря.
+        """
+        if self.window <= 0:
+            return False
+        text = (update.get("message") or {}).get("text")
+        return bool(text) and not text.startswith("/")
+
+    def ready_at(self, first_arrival, last_arrival):
+        """
+        Возвращает момент, когда серия считается завершенной.
+        :param first_arrival: Время получения первого сообщения серии (time.monotonic()).
+        :param last_arrival: Время получения последнего сообщения серии.
+        """
+        return min(last_arrival + self.window, first_arrival + self.max_wait)
+
+    def record(self, size):
+        """
+        Учитывает в статистике серию, переданную в обработку.
+        :param size: Количество сообщений серии.
+        """
+        self._stats["messages"] += size
+        self._stats["turns"] += 1
+        self._stats["merged"] += size - 1
+        self._stats["max_burst"] = max(self._stats["max_burst"], size)
+
+    def stats(self):
+        """
+        Возвращает статистику объединения сообщений.
+        :return: Словарь с количеством сообщений и ходов диалога.
+        """
+        return {
+            "name": self.name,
+            "window_ms": round(self.window * 1000),
+            "max_wait_ms": round(self.max_wait * 1000),
+            **self._stats,
+        }
+
+
+# Объединение сообщений чатов Telegram для использования во всем приложении
+message_debouncer = MessageDebouncer(
+    name="telegram",
+    window=int(os.getenv('TELEGRAM_DEBOUNCE_MS', 1000)) / 1000,
+    max_wait=int(os.getenv('TELEGRAM_DEBOUNCE_MAX_WAIT_MS', 5000)) / 1000,
+)
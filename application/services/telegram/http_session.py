@@ -0,0 +1,80 @@
+"""
+http_session.py
+Общая HTTP-сессия aiogram для всех Telegram-ботов.
+
+По умолчанию каждый `Bot` создаёт собственную aiohttp-сессию с пулом соединений, поэтому сотни ботов держат сотни
+пулов и простаивающих TLS-соединений с api.telegram.org. Все экземпляры `TelegramBotRunner` используют одну сессию
+`telegram_http_session` с общим ограниченным пулом (TELEGRAM_HTTP_POOL_SIZE соединений). Токен бота передаётся
+в каждом запросе, поэтому сессия не зависит от бота.
+
+Middleware сессии подключаются здесь один раз: планировщик исходящих сообщений (send_scheduler.py) и учёт запросов
+для статистики. Сессия закрывается один раз в `TelegramBotManager.stop_all_bots`.
+"""
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from application.services.telegram.send_scheduler import send_scheduler
+from dotenv import load_dotenv
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+HTTP_POOL_SIZE = int(os.getenv('TELEGRAM_HTTP_POOL_SIZE', 100))
+HTTP_TIMEOUT = float(os.getenv('TELEGRAM_HTTP_TIMEOUT', 60))
+
+
+class RequestStats(BaseRequestMiddleware):
+    """
+    Middleware, считающий запросы к Bot API, выполняемые через общую сессию.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self._stats = {
+            "requests": 0,
+            "errors": 0,
+            "max_in_flight": 0,
+        }
+
+    async def __call__(self, make_request, bot, method):
+        """
+        Выполняет запрос и обновляет счётчики.
+        """
+        self.in_flight += 1
+        self._stats["requests"] += 1
+        self._stats["max_in_flight"] = max(self._stats["max_in_flight"], self.in_flight)
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        """
+        Возвращает счётчики запросов.
+        """
+        return {"in_flight": self.in_flight, **self._stats}
+
+
+# Общая сессия Bot API для использования во всем приложении
+telegram_http_session = AiohttpSession(limit=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT)
+request_stats = RequestStats()
+# Middleware выполняются в порядке подключения: планировщик ожидает очереди, затем запрос учитывается в статистике
+telegram_http_session.middleware(send_scheduler)
+telegram_http_session.middleware(request_stats)
+
+
+def http_session_stats():
+    """
+    Возвращает статистику общей сессии Bot API.
+    :return: Словарь с размером пула соединений, таймаутом и счётчиками запросов.
+    """
+    return {
+        "pool_size": HTTP_POOL_SIZE,
+        "timeout": HTTP_TIMEOUT,
+        **request_stats.stats(),
+    }
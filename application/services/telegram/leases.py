@@ -0,0 +1,148 @@
+"""
+leases.py
+Аренда Telegram-сессий узлами кластера.
+
+Если запустить несколько копий приложения, каждая из них запускает всех активных ботов и устанавливает их вебхуки
+на свой адрес. При TELEGRAM_CLUSTER_MODE=true узел обслуживает только сессии, аренду которых он удерживает
+в таблице `bot_leases`:
+- каждые TELEGRAM_LEASE_HEARTBEAT секунд узел продлевает аренду своих сессий на TELEGRAM_LEASE_TTL секунд
+  и захватывает свободные и истёкшие;
+- при остановке узел освобождает аренду, а при аварийном завершении она истекает, и сессии захватывают другие узлы;
+- захватив сессию у другого узла, узел устанавливает её вебхук на свой адрес (SERVER_ADDRESS узла);
+- если продлить аренду не удаётся дольше её срока (за вычетом интервала продления и отсчитывая от начала
+  последнего успешного продления), узел перестаёт обслуживать сессии, чтобы не конкурировать с узлом,
+  который их захватил.
+
+Узел определяется TELEGRAM_CLUSTER_NODE_ID (по умолчанию имя хоста и порт вебхуков). В режиме супервизора
+(см. sharding.py) все обработчики одного узла используют один идентификатор, поэтому перераспределение сессий
+внутри узла не считается захватом. Перебором сессий и их запуском управляет `TelegramBotManager.sync_leases`.
+"""
+
+from application.services.telegram.webhook_server import WEBHOOK_PORT
+from database import db_async_functions as async_db
+from dotenv import load_dotenv
+import socket
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+CLUSTER_MODE = os.getenv('TELEGRAM_CLUSTER_MODE', 'false').lower() in ('1', 'true', 'yes')
+CLUSTER_NODE_ID = os.getenv('TELEGRAM_CLUSTER_NODE_ID') or f"{socket.gethostname()}:{WEBHOOK_PORT}"
+LEASE_TTL = int(os.getenv('TELEGRAM_LEASE_TTL', 30))
+LEASE_HEARTBEAT = float(os.getenv('TELEGRAM_LEASE_HEARTBEAT', 10))
+
+
+class BotLeaseManager:
+    """
+    Аренда сессий одним процессом узла. Используется из одного событийного цикла.
+    """
+
+    def __init__(self, enabled, node_id, ttl, heartbeat_interval):
+        """
+        :param enabled: Включён ли режим кластера.
+        :param node_id: Идентификатор узла (владелец аренды).
+        :param ttl: Срок аренды в секундах.
+        :param heartbeat_interval: Интервал продления аренды в секундах (должен быть заметно меньше срока).
+        """
+        self.enabled = enabled
+        self.node_id = node_id
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.held = set()  # ID сессий, аренду которых удерживает процесс
+        self._valid_until = 0.0
+        self._stats = {
+            "heartbeats": 0,
+            "heartbeat_errors": 0,
+            "acquired": 0,
+            "takeovers": 0,
+            "dropped": 0,
+            "released": 0,
+        }
+
+    async def heartbeat(self, session_ids):
+        """
+        Продлевает аренду сессий процесса и захватывает свободные и истёкшие из списка.
+        :param session_ids: ID сессий, которые процесс готов обслуживать.
+        :return: Кортеж (ID удерживаемых сессий, ID сессий, захваченных у другого узла или впервые) или
+                 (None, None) при ошибке базы данных.
+        """
+        # Срок аренды в базе отсчитывается во время запроса, поэтому время берётся до него
+        started = time.monotonic()
+        new = [session_id for session_id in session_ids if session_id not in self.held]
+        previous = await async_db.get_bot_lease_owners(new) if new else {}
+        held = await async_db.acquire_bot_leases(session_ids, self.node_id, self.ttl) if session_ids else set()
+        if previous is None or held is None:
+            self._stats["heartbeat_errors"] += 1
+            return None, None
+        # Запас в один интервал продления: локальный срок не должен пережить аренду в базе
+        self._valid_until = started + max(self.ttl - self.heartbeat_interval, 0)
+        acquired = held - self.held
+        taken_over = {session_id for session_id in acquired if previous.get(session_id) != self.node_id}
+        self._stats["heartbeats"] += 1
+        self._stats["acquired"] += len(acquired)
+        self._stats["takeovers"] += len(taken_over)
+        self._stats["dropped"] += len(self.held - held)
+        self.held = held
+        return held, taken_over
+
+    async def claim(self, session_id):
+        """
+        Захватывает аренду одной сессии (при запуске бота из веб-интерфейса).
+        :return: True, если аренда принадлежит узлу.
+        """
+        if session_id in self.held:
+            return True
+        held = await async_db.acquire_bot_leases([session_id], self.node_id, self.ttl)
+        if not held:
+            return False
+        self.held.add(session_id)
+        self._stats["acquired"] += 1
+        return True
+
+    async def release(self, session_ids):
+        """
+        Освобождает аренду сессий.
+        """
+        session_ids = [session_id for session_id in session_ids if session_id in self.held]
+        if not session_ids:
+            return
+        self.held.difference_update(session_ids)
+        self._stats["released"] += len(session_ids)
+        await async_db.release_bot_leases(session_ids, self.node_id)
+
+    def lapse(self):
+        """
+        Проверяет, истёк ли срок аренды с момента последнего успешного продления. Истёкшую аренду могли захватить
+        другие узлы, поэтому она забывается и после восстановления базы данных захватывается заново.
+        :return: True, если аренда истекла.
+        """
+        if time.monotonic() <= self._valid_until:
+            return False
+        self.held = set()
+        return True
+
+    def stats(self):
+        """
+        Возвращает статистику аренды.
+        :return: Словарь с идентификатором узла, количеством удерживаемых сессий и счётчиками продлений и захватов.
+        """
+        return {
+            "enabled": self.enabled,
+            "node_id": self.node_id,
+            "ttl": self.ttl,
+            "heartbeat_interval": self.heartbeat_interval,
+            "held": len(self.held),
+            **self._stats,
+        }
+
+
+# Аренда сессий узла для использования во всем приложении
+bot_leases = BotLeaseManager(
+    enabled=CLUSTER_MODE,
+    node_id=CLUSTER_NODE_ID,
+    ttl=LEASE_TTL,
+    heartbeat_interval=LEASE_HEARTBEAT,
+)
@@ -2,50 +2,175 @@
 runner.py
 Модуль для запуска и управления Telegram-ботами с использованием библиотеки Aiogram.
 
-Этот файл содержит класс `TelegramBotRunner`, который позволяет запускать бота на вебхуке с использованием aiohttp-сервера.
+Этот файл содержит класс `TelegramBotRunner`, который позволяет запускать бота на вебхуке общего aiohttp-сервера
+(см. webhook_server.py). Экземпляры создаются `TelegramBotManager` при первом обновлении для сессии и удаляются
+после простоя (см. bot_manager.py).
 Он включает методы для обработки команд и сообщений, а также для остановки бота.
 
 Основные функции:
-1. **start_webhook**:
-   - Настроить и запустить сервер с использованием aiohttp для обработки запросов Telegram.
+1. **register_handlers** (вызывается при создании):
    - Обработать команду `/start`, отправляя приветственное сообщение.
    - Обрабатывать все входящие сообщения, генерируя ответ с использованием GPT API и записывая историю чата в базу данных.
-2. **stop_webhook**:
-   - Остановить работу бота, удалив вебхук и завершив сессию.
+   Ответ показывается по мере генерации: первое сообщение отправляется с первыми токенами и затем редактируется
+   не чаще, чем раз в TELEGRAM_STREAM_EDIT_INTERVAL секунд.
+   Если модель перегружена (превышено ожидание лимитов API-ключа или время ответа), пользователь получает
+   сообщение об ошибке агента.
+   Все отправки и редактирования сообщений бота проходят через планировщик send_scheduler, соблюдающий лимиты
+   частоты Telegram (на бота и на чат).
+   Несколько сообщений, отправленных подряд, объединяются диспетчером обновлений в один ход диалога
+   (см. debounce.py, update_dispatcher.py): на них формируется один ответ и сохраняется одна запись истории.
+2. **start_webhook**:
+   - Установить вебхук в Telegram.
+3. **stop_webhook**:
+   - Остановить работу бота, удалив вебхук.
 
-Для каждого бота создается уникальный сервер с портом, основанным на идентификаторе сессии.
+Все экземпляры используют общую HTTP-сессию aiogram (см. http_session.py), поэтому удаление экземпляра не требует
+закрытия соединений.
+
+Все боты принимают обновления на одном порту по пути `/webhook/{session_id}`.
 """
 
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiohttp import web
-from database.db_functions import *
-from utils.gpt_api import generate_response
-from utils.utils import check_spam
+from application.services.telegram.debounce import merge_message_texts
+from application.services.telegram.http_session import telegram_http_session
+from application.services.telegram.update_dispatcher import update_dispatcher
+from application.services.telegram.webhook_server import agent_error_message
+from database import db_async_functions as async_db
+from utils.gpt_api import agenerate_response_stream
+from utils.llm_client import LLMTimeoutError
+from utils.llm_scheduler import LLMRateLimitError
+from utils.utils import check_spam, get_history_window
+from utils.logs.logger import logger
 from dotenv import load_dotenv
+import asyncio
+import time
 import os
 
 
 load_dotenv()
 
+# Минимальный интервал между редактированиями сообщения при потоковом ответе (ограничение частоты запросов Telegram)
+STREAM_EDIT_INTERVAL = float(os.getenv('TELEGRAM_STREAM_EDIT_INTERVAL', 1.0))
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 
 class TelegramBotRunner:
 
-    def __init__(self, session_id, token, port):
+    def __init__(self, session_id, token):
         self.session_id = session_id
         self.token = token
-        self.port = port  # Порт, который будет использовать бот
-        self.bot = Bot(token=self.token, skip_updates=False)  # Инициализация бота
+        # Инициализация бота на общей HTTP-сессии всех ботов (с планировщиком исходящих сообщений)
+        self.bot = Bot(token=self.token, session=telegram_http_session, skip_updates=False)
         self.dp = Dispatcher()  # Инициализация диспетчера
         self.dp["bot"] = self.bot  # Добавление бота в контекст диспетчера
         # self.webhook_url = f"{os.getenv('NGROK_ADDRESS')}/webhook/{self.session_id}"
         self.webhook_url = f"{os.getenv('SERVER_ADDRESS')}/webhook/{self.session_id}"
+        self.last_used = time.monotonic()  # Время последней обработки обновления
+        self.in_flight = 0  # Количество обрабатываемых сейчас обновлений
+        self.register_handlers()
+
+    def touch(self):
+        """
+        Отмечает использование бота (откладывает его выгрузку при простое).
+        """
+        self.last_used = time.monotonic()
+
+    async def load_message_context(self, message: Message):
+        """
+        Загружает одним запросом контекст входящего сообщения (сессия, агент, API-ключ) и регистрирует
+        отправителя, если он ещё не существует в базе.
+        :return: Словарь контекста сообщения или None, если сессия не найдена.
+        """
+        user_id = message.from_user.id
+        context = await async_db.get_message_context(self.session_id, user_id)
+        if context is None:
+            logger.log(f"Контекст сообщения для сессии {self.session_id} не найден", "ERROR")
+            return None
+        if not context['user_exists']:
+            username = message.from_user.username or ''
+            first_name = message.from_user.first_name or ''
+            last_name = message.from_user.last_name or ''
+            await async_db.insert_user(user_id, username, '', 3, f'{last_name} {first_name}')
+            context['user_exists'] = True
+        return context
+
+    async def answer_streaming(self, message: Message, chunks):
+        """
+        Отправляет ответ, получаемый частями: первое сообщение отправляется с первым фрагментом и затем
+        редактируется (edit_message_text) не чаще, чем раз в STREAM_EDIT_INTERVAL секунд. Текст длиннее лимита
+        Telegram досылается отдельными сообщениями после завершения генерации.
+        :param message: Входящее сообщение пользователя.
+        :param chunks: Асинхронный генератор фрагментов ответа.
+        :return: Полный текст ответа.
+        """
+        text = ""
+        reply = None
+        shown = ""
+        last_edit = 0.0
+        async for delta in chunks:
+            text += delta
+            visible = text[:TELEGRAM_MESSAGE_LIMIT]
+            if reply is None:
+                if visible.strip():
+                    reply = await message.answer(visible)
+                    shown = visible
+                    last_edit = asyncio.get_running_loop().time()
+                continue
+            now = asyncio.get_running_loop().time()
+            if visible != shown and now - last_edit >= STREAM_EDIT_INTERVAL:
+                shown = await self.edit_reply(reply, visible, shown)
+                last_edit = now
+        if reply is None:
+            await message.answer(text or "...")
+            return text
+        visible = text[:TELEGRAM_MESSAGE_LIMIT]
+        if visible != shown:
+            shown = await self.edit_reply(reply, visible, shown)
+        if visible != shown:
+            # Повторяем финальное редактирование, чтобы пользователь увидел весь ответ: планировщик отправки
+            # выполнит его после паузы retry_after, назначенной чату
+            await self.edit_reply(reply, visible, shown)
+        for start in range(TELEGRAM_MESSAGE_LIMIT, len(text), TELEGRAM_MESSAGE_LIMIT):
+            await message.answer(text[start:start + TELEGRAM_MESSAGE_LIMIT])
+        return text
 
-    async def start_webhook(self):
+    async def edit_reply(self, reply: Message, text, shown):
         """
-        Настройка Webhook и запуск aiohttp-сервера для получения обновлений от Telegram.
+        Заменяет текст отправленного ответа. Если Telegram ограничил частоту запросов или текст не изменился,
+        редактирование пропускается. Ответы 429 повторяет планировщик отправки (send_scheduler.py), поэтому
+        здесь пауза не выдерживается: текст догонит следующее редактирование.
+        :return: Текст, который теперь отображается в сообщении.
+        """
+        try:
+            await self.bot.edit_message_text(text, chat_id=reply.chat.id, message_id=reply.message_id)
+            return text
+        except TelegramRetryAfter:
+            return shown
+        except TelegramBadRequest as e:
+            logger.log(f"Бот {self.session_id}: сообщение не отредактировано: {e}", "WARNING")
+            return shown
+
+    async def set_webhook(self, drop_pending_updates=True):
+        """
+        Регистрирует вебхук в Telegram. При превышении лимита запросов повторяет попытку после паузы,
+        указанной Telegram (retry_after).
+        :param drop_pending_updates: Удалить ли обновления, накопленные Telegram до установки вебхука. При переносе
+        бота с другого узла или адреса они сохраняются, чтобы не потерять сообщения пользователей.
+        """
+        try:
+            await self.bot.set_webhook(self.webhook_url, drop_pending_updates=drop_pending_updates)
+        except TelegramRetryAfter as e:
+            logger.log(f"Бот {self.session_id}: лимит set_webhook, повтор через {e.retry_after} с", "WARNING")
+            await asyncio.sleep(e.retry_after)
+            await self.bot.set_webhook(self.webhook_url, drop_pending_updates=drop_pending_updates)
+
+    def register_handlers(self):
+        """
+        Регистрация обработчиков команд и сообщений в диспетчере бота.
         """
         # Регистрация обработчика команды /start
         @self.dp.message(Command(commands=["start"]))
@@ -54,54 +179,54 @@ class TelegramBotRunner:
             if check_spam(user_id):
                 await message.answer("Вы слишком часто отправляете сообщения. Пожалуйста, подождите.")
                 return
-            if not check_user_exists(user_id):
-                username = message.from_user.username or ''
-                first_name = message.from_user.first_name or ''
-                last_name = message.from_user.last_name or ''
-                insert_user(user_id, username, '', 3, f'{last_name} {first_name}')
-            session = get_session_by_id(self.session_id)
-            agent = get_agent_by_id(session['agent_id'])
-            start_message = agent.get("start_message", "Добро пожаловать!")
+            context = await self.load_message_context(message)
+            if context is None:
+                return
+            start_message = context['agent'].get("start_message", "Добро пожаловать!")
             await message.answer(start_message)
 
         # Регистрация обработчика любых сообщений
         @self.dp.message()
-        async def echo_handler(message: Message):
+        async def echo_handler(message: Message, merged_texts=None):
+            # merged_texts - тексты серии сообщений, объединённой диспетчером обновлений (message - последнее из них)
             user_id = message.from_user.id
             if check_spam(user_id):
                 await message.answer("Вы слишком часто отправляете сообщения. Пожалуйста, подождите.")
                 return
-            if not check_user_exists(user_id):
-                username = message.from_user.username or ''
-                first_name = message.from_user.first_name or ''
-                last_name = message.from_user.last_name or ''
-                insert_user(user_id, username, '', 3, f'{last_name} {first_name}')
-            session = get_session_by_id(self.session_id)
-            user_input = message.text
-            agent = get_agent_by_id(session['agent_id'])
-            conversation_history = get_chat_history_by_session_id_and_user_id(self.session_id, user_id) or []
-            response = generate_response(agent_id=agent['id'], user_input=user_input, conversation_history=conversation_history)
-            await message.answer(response)
-            insert_chat_message_for_session(user_id, agent['id'], 2, self.session_id, user_input, response)
-
-        # Настройка Webhook в Telegram
-        await self.bot.set_webhook(self.webhook_url, drop_pending_updates=True)
-
-        # Настройка aiohttp-приложения для обработки Webhook
-        app = web.Application()
-        SimpleRequestHandler(dispatcher=self.dp, bot=self.bot).register(app, path="")
-        setup_application(app, self.dp)
-
-        # Запуск aiohttp-сервера на уникальном порту
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, "0.0.0.0", self.port)  # Используем уникальный порт
-        await site.start()
+            context = await self.load_message_context(message)
+            if context is None:
+                return
+            user_input = merge_message_texts(merged_texts) if merged_texts else message.text
+            agent = context['agent']
+            max_turns, token_budget = get_history_window(agent)
+            conversation_history = await async_db.get_recent_chat_history_by_session_id_and_user_id(
+                self.session_id, user_id, max_turns, token_budget)
+            try:
+                response = await self.answer_streaming(
+                    message, agenerate_response_stream(agent['id'], user_input, conversation_history, agent=agent))
+            except (LLMRateLimitError, LLMTimeoutError) as e:
+                # Ответ не может быть сформирован вовремя: сообщаем об ошибке вместо ожидания
+                update_dispatcher.record_shed(str(self.session_id), "llm_overload")
+                logger.log(f"Бот {self.session_id}: запрос к модели отброшен из-за перегрузки: {e}", "WARNING")
+                await message.answer(agent_error_message(agent))
+                return
+            await async_db.insert_chat_message_for_session(user_id, agent['id'], 2, self.session_id, user_input, response)
+
+    async def start_webhook(self, webhook_semaphore=None, drop_pending_updates=True):
+        """
+        Настройка Webhook в Telegram. Бот должен быть уже зарегистрирован на общем сервере вебхуков.
+        :param webhook_semaphore: Семафор, ограничивающий количество одновременных вызовов set_webhook
+        при массовом запуске ботов.
+        :param drop_pending_updates: См. set_webhook.
+        """
+        if webhook_semaphore is None:
+            await self.set_webhook(drop_pending_updates)
+        else:
+            async with webhook_semaphore:
+                await self.set_webhook(drop_pending_updates)
 
     async def stop_webhook(self):
         """
-        Удаление Webhook и остановка aiohttp-приложения.
+        Удаление Webhook. Общая HTTP-сессия ботов не закрывается.
         """
         await self.bot.delete_webhook()
-        await self.dp.shutdown()
-        await self.bot.session.close()
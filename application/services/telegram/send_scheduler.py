@@ -0,0 +1,214 @@
+"""
+send_scheduler.py
+Планировщик исходящих сообщений Telegram-ботов.
+
+Telegram ограничивает частоту отправки: около 30 сообщений в секунду на бота и около одного сообщения в секунду
+в один чат. При превышении API отвечает 429 с параметром retry_after. Планировщик подключается к общей сессии ботов
+(http_session.py) как middleware запросов aiogram, поэтому через него проходят все отправки и редактирования сообщений
+(`message.answer`, `bot.send_message`, `edit_message_text` и т.д.) без изменения вызывающего кода.
+
+Для каждого бота поддерживаются две очереди token bucket: общая (TELEGRAM_SEND_RATE сообщений в секунду) и для
+каждого чата (TELEGRAM_CHAT_SEND_RATE сообщений в секунду с запасом TELEGRAM_CHAT_SEND_BURST). Запросы ожидают
+своей очереди в порядке поступления, вызывающий код получает результат после фактической доставки. Ответ 429
+приостанавливает отправку бота на retry_after секунд, после чего запрос повторяется (до TELEGRAM_SEND_MAX_RETRIES раз).
+"""
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from utils.logs.logger import logger
+from dotenv import load_dotenv
+import asyncio
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+SEND_RATE = float(os.getenv('TELEGRAM_SEND_RATE', 30))
+CHAT_SEND_RATE = float(os.getenv('TELEGRAM_CHAT_SEND_RATE', 1))
+CHAT_SEND_BURST = int(os.getenv('TELEGRAM_CHAT_SEND_BURST', 3))
+SEND_MAX_RETRIES = int(os.getenv('TELEGRAM_SEND_MAX_RETRIES', 3))
+
+# Методы Bot API, на которые распространяются ограничения частоты отправки
+LIMITED_METHOD_PREFIXES = ("send", "edit", "copy", "forward")
+# Количество очередей чатов, при превышении которого удаляются очереди неактивных чатов
+MAX_CHAT_BUCKETS = 10000
+# Время неактивности, после которого очередь чата может быть удалена, в секундах
+CHAT_BUCKET_IDLE = 60
+
+
+class TokenBucket:
+    """
+    Асинхронная очередь token bucket: ожидающие получают разрешение на отправку в порядке поступления.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: Количество разрешений в секунду. 0 отключает ограничение.
+        :param burst: Максимальное количество разрешений, выдаваемых подряд без ожидания.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        """
+        Пополняет запас разрешений за прошедшее время.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Ожидает разрешение на отправку.
+        """
+        if self.rate <= 0:
+            return
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = max(self.paused_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0)
+                    if delay <= 0:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    def pause(self, seconds):
+        """
+        Приостанавливает выдачу разрешений (после ответа 429 от Telegram).
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        """
+        Проверяет, что очередь никто не ожидает и она давно не использовалась.
+        """
+        return not self.waiting and now - self.updated > CHAT_BUCKET_IDLE
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware запросов aiogram, ограничивающий частоту отправки сообщений каждого бота.
+    Очереди ведутся по ID бота, поэтому один экземпляр можно подключать к сессиям разных ботов.
+    """
+
+    def __init__(self, rate, chat_rate, chat_burst, max_retries):
+        """
+        :param rate: Допустимое количество сообщений бота в секунду.
+        :param chat_rate: Допустимое количество сообщений в один чат в секунду.
+        :param chat_burst: Количество сообщений в чат, отправляемых подряд без ожидания.
+        :param max_retries: Максимальное количество повторов после ответа 429.
+        """
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._bots = {}  # ID бота -> общая очередь бота
+        self._chats = {}  # (ID бота, ID чата) -> очередь чата
+        self._stats = {}  # ID бота -> счётчики
+
+    def _bot_stats(self, bot_id):
+        """
+        Возвращает словарь счётчиков бота, создавая его при необходимости.
+        """
+        stats = self._stats.get(bot_id)
+        if stats is None:
+            stats = self._stats[bot_id] = {
+                "sent": 0,
+                "retries": 0,
+                "retry_after": 0,
+                "failed": 0,
+                "total_wait_ms": 0.0,
+                "max_wait_ms": 0.0,
+            }
+        return stats
+
+    def _chat_bucket(self, bot_id, chat_id):
+        """
+        Возвращает очередь чата. При большом количестве очередей удаляет очереди неактивных чатов.
+        """
+        key = (bot_id, chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                for idle_key in [k for k, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[idle_key]
+            bucket = self._chats[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        """
+        Выполняет запрос к Bot API. Отправка сообщений ожидает очереди бота и чата и повторяется после ответа 429.
+        """
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not method.__api_method__.startswith(LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+        bot_bucket = self._bots.get(bot.id)
+        if bot_bucket is None:
+            bot_bucket = self._bots[bot.id] = TokenBucket(self.rate, self.rate)
+        chat_bucket = self._chat_bucket(bot.id, chat_id)
+        stats = self._bot_stats(bot.id)
+        started = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            await chat_bucket.acquire()
+            await bot_bucket.acquire()
+            if attempt == 0:
+                wait_ms = (time.monotonic() - started) * 1000
+                stats["total_wait_ms"] += wait_ms
+                stats["max_wait_ms"] = max(stats["max_wait_ms"], wait_ms)
+            try:
+                response = await make_request(bot, method)
+                stats["sent"] += 1
+                return response
+            except TelegramRetryAfter as e:
+                stats["retry_after"] += 1
+                bot_bucket.pause(e.retry_after)
+                chat_bucket.pause(e.retry_after)
+                if attempt == self.max_retries:
+                    stats["failed"] += 1
+                    raise
+                stats["retries"] += 1
+                logger.log(f"Бот {bot.id}: лимит отправки Telegram ({method.__api_method__}), "
+                           f"повтор через {e.retry_after} с", "WARNING")
+
+    def stats(self):
+        """
+        Возвращает статистику отправки по ботам.
+        :return: Словарь с настройками лимитов и счётчиками каждого бота (отправлено, повторы, ожидание в очереди).
+        """
+        bots = {}
+        for bot_id, stats in self._stats.items():
+            bucket = self._bots.get(bot_id)
+            bots[str(bot_id)] = {
+                **stats,
+                "total_wait_ms": round(stats["total_wait_ms"], 1),
+                "max_wait_ms": round(stats["max_wait_ms"], 1),
+                "waiting": bucket.waiting if bucket is not None else 0,
+            }
+        return {
+            "rate": self.rate,
+            "chat_rate": self.chat_rate,
+            "chat_burst": self.chat_burst,
+            "chat_queues": len(self._chats),
+            "bots": bots,
+        }
+
+
+# Планировщик исходящих сообщений для использования во всем приложении
+send_scheduler = SendScheduler(
+    rate=SEND_RATE,
+    chat_rate=CHAT_SEND_RATE,
+    chat_burst=CHAT_SEND_BURST,
+    max_retries=SEND_MAX_RETRIES,
+)
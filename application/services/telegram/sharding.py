@@ -0,0 +1,508 @@
+"""
+sharding.py
+Распределение Telegram-ботов между несколькими процессами.
+
+В обычном режиме все боты, Flask и запросы к модели работают в одном процессе и используют одно ядро.
+При TELEGRAM_WORKER_PROCESSES > 0 `run.py` запускается в режиме супервизора:
+- процесс-супервизор выполняет Flask и WhatsApp-ботов и запускает N процессов-обработчиков Telegram-ботов;
+- сессии распределяются между обработчиками консистентным хешированием ID сессии (`HashRing`), поэтому при
+  изменении состава обработчиков переезжает только часть сессий;
+- супервизор принимает вебхуки на TELEGRAM_WEBHOOK_PORT и пересылает каждое обновление обработчику-владельцу сессии
+  (на 127.0.0.1:TELEGRAM_WORKER_BASE_PORT + номер обработчика). Адрес вебхука в Telegram от обработчика не зависит,
+  поэтому перераспределение сессий не требует обращений к Bot API. Ответ 404 обработчика в течение
+  REBALANCE_GRACE секунд после перераспределения заменяется на 429 (новый владелец ещё регистрирует сессию),
+  позже передаётся Telegram как есть;
+- повторные доставки обновлений отбрасываются маршрутизатором (update_dedup.py, окно в памяти супервизора),
+  поэтому окно не теряется при переезде сессии к другому обработчику;
+- обработчик, завершившийся с ошибкой, исключается из кольца (его сессии сразу переходят к остальным) и
+  перезапускается через TELEGRAM_WORKER_RESTART_DELAY секунд, после чего снова получает свою часть сессий.
+  Новые обработчики добавляются методом `add_worker`.
+
+Супервизор и обработчики обмениваются сообщениями через multiprocessing.Pipe: обработчик сообщает о готовности,
+супервизор рассылает состав кольца и передаёт владельцу команды запуска и остановки ботов из веб-интерфейса.
+Если готового владельца нет (обработчики ещё запускаются или перезапускаются), команда откладывается и передаётся
+владельцу при следующем перераспределении; из отложенных команд одной сессии сохраняется последняя.
+Каждый обработчик сам выбирает из активных сессий свои и приводит к ним набор зарегистрированных ботов
+(`TelegramBotManager.reconcile`).
+
+Веб-интерфейс работает в процессе-супервизоре, поэтому изменения агентов, сессий и ботов сбрасывают только его кэши.
+Супервизор рассылает каждую инвалидацию кэша (db_cache.py, llm_cache.py) готовым обработчикам командой
+("invalidate", имя кэша, ключ), и они сбрасывают те же записи своих кэшей.
+"""
+
+from aiohttp import web
+from application.services.telegram.webhook_server import WebhookServer, WEBHOOK_HOST, WEBHOOK_PORT
+from application.services.telegram.update_dedup import UpdateDeduplicator, DEDUP_WINDOW
+from application.services.telegram.leases import bot_leases
+from database.db_cache import add_invalidation_listener, apply_invalidation
+from database import db_async_functions as async_db
+from utils.logs.logger import logger
+from dotenv import load_dotenv
+import multiprocessing
+import threading
+import asyncio
+import aiohttp
+import orjson
+import hashlib
+import bisect
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+WORKER_PROCESSES = int(os.getenv('TELEGRAM_WORKER_PROCESSES', 0))
+WORKER_BASE_PORT = int(os.getenv('TELEGRAM_WORKER_BASE_PORT', WEBHOOK_PORT + 1))
+WORKER_RESTART_DELAY = float(os.getenv('TELEGRAM_WORKER_RESTART_DELAY', 5))
+
+# Количество точек кольца на один обработчик (чем больше, тем равномернее распределение)
+VIRTUAL_NODES = 100
+# Время ожидания завершения обработчика при остановке в секундах
+WORKER_STOP_TIMEOUT = 30
+# Таймаут пересылки обновления обработчику в секундах
+FORWARD_TIMEOUT = 10
+# Время после перераспределения в секундах, в течение которого новый владелец может ещё не зарегистрировать сессию
+REBALANCE_GRACE = 30
+
+
+class HashRing:
+    """
+    Кольцо консистентного хеширования: сопоставляет ID сессии обработчику.
+    Использует md5, а не hash(), чтобы все процессы получали одинаковое распределение.
+    """
+
+    def __init__(self, replicas):
+        """
+        :param replicas: Количество точек кольца на одного участника.
+        """
+        self.replicas = replicas
+        self.members = ()
+        self._points = []
+        self._owners = []
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def set_members(self, members):
+        """
+        Перестраивает кольцо для нового состава участников.
+        """
+        points = sorted((self._hash(f"{member}:{i}"), member) for member in members for i in range(self.replicas))
+        self.members = tuple(sorted(members))
+        self._points = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, session_id):
+        """
+        Возвращает участника, которому принадлежит сессия, или None, если кольцо пусто.
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(session_id)) % len(self._points)
+        return self._owners[index]
+
+
+class WorkerProcess:
+    """
+    Процесс-обработчик с точки зрения супервизора.
+    """
+
+    def __init__(self, worker_id, port, process, conn):
+        self.worker_id = worker_id
+        self.port = port
+        self.process = process
+        self.conn = conn
+        self.ready = False
+        self.restarts = 0
+
+
+class ShardSupervisor:
+    """
+    Супервизор процессов-обработчиков Telegram-ботов и маршрутизатор их вебхуков.
+    Используется из событийного цикла процесса-супервизора; сообщения обработчиков читаются отдельными потоками.
+    """
+
+    def __init__(self, workers, host, port, base_port, restart_delay, deduplicator):
+        """
+        :param workers: Количество обработчиков при запуске.
+        :param host: Адрес, на котором принимаются вебхуки Telegram.
+        :param port: Порт, на котором принимаются вебхуки Telegram.
+        :param base_port: Порт первого обработчика; обработчик N слушает base_port + N на 127.0.0.1.
+        :param restart_delay: Задержка перезапуска завершившегося обработчика в секундах.
+        :param deduplicator: Дедупликация обновлений по update_id (UpdateDeduplicator) для всех обработчиков.
+        """
+        self.workers_count = workers
+        self.host = host
+        self.port = port
+        self.base_port = base_port
+        self.restart_delay = restart_delay
+        self.deduplicator = deduplicator
+        self.ring = HashRing(VIRTUAL_NODES)
+        self.workers = {}  # Номер обработчика -> WorkerProcess
+        self._target = None
+        self._loop = None
+        self._runner = None
+        self._client = None
+        self._stopping = False
+        self._rebalanced_at = 0.0
+        self._pending_commands = {}  # ID сессии -> команда, ожидающая готового обработчика-владельца
+        self._stats = {
+            "forwarded": 0,
+            "duplicates": 0,
+            "forward_errors": 0,
+            "no_worker": 0,
+            "not_registered": 0,
+            "not_found": 0,
+            "worker_exits": 0,
+            "rebalances": 0,
+            "deferred_commands": 0,
+            "invalidations": 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.workers_count > 0
+
+    async def start(self, target):
+        """
+        Запускает маршрутизатор вебхуков и процессы-обработчики.
+        :param target: Функция процесса-обработчика с параметрами (worker_id, port, conn).
+        """
+        self._target = target
+        self._loop = asyncio.get_running_loop()
+        self._client = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+        app = web.Application()
+        app.router.add_post("/webhook/{session_id}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self._runner = runner
+        add_invalidation_listener(self._on_invalidation)
+        logger.log(f"Маршрутизатор вебхуков Telegram запущен на {self.host}:{self.port}, "
+                   f"обработчиков: {self.workers_count}")
+        for worker_id in range(self.workers_count):
+            self._spawn(worker_id)
+
+    def add_worker(self):
+        """
+        Запускает ещё один процесс-обработчик. Он получит свою часть сессий после сообщения о готовности.
+        """
+        worker_id = max(self.workers, default=-1) + 1
+        self.workers_count += 1
+        self._spawn(worker_id)
+        return worker_id
+
+    def _spawn(self, worker_id):
+        """
+        Запускает процесс-обработчик и поток чтения его сообщений.
+        """
+        if self._stopping:
+            return
+        previous = self.workers.get(worker_id)
+        conn, child_conn = multiprocessing.Pipe()
+        port = self.base_port + worker_id
+        process = multiprocessing.get_context("spawn").Process(
+            target=self._target, args=(worker_id, port, child_conn), name=f"telegram-worker-{worker_id}", daemon=True
+        )
+        process.start()
+        # Копия канала в супервизоре закрывается, чтобы завершение обработчика приводило к EOF при чтении
+        child_conn.close()
+        worker = self.workers[worker_id] = WorkerProcess(worker_id, port, process, conn)
+        worker.restarts = previous.restarts + 1 if previous else 0
+        threading.Thread(target=self._read_messages, args=(worker,), daemon=True).start()
+        logger.log(f"Обработчик Telegram {worker_id} запущен (pid {process.pid}, порт {port})")
+
+    def _read_messages(self, worker):
+        """
+        Поток чтения сообщений обработчика. Закрытие канала означает завершение процесса.
+        """
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                self._loop.call_soon_threadsafe(self._on_exit, worker)
+                return
+            self._loop.call_soon_threadsafe(self._on_message, worker, message)
+
+    def _on_message(self, worker, message):
+        """
+        Обрабатывает сообщение обработчика.
+        """
+        if message[0] == "ready" and self.workers.get(worker.worker_id) is worker:
+            worker.ready = True
+            self._rebalance()
+
+    def _on_exit(self, worker):
+        """
+        Исключает завершившийся обработчик из кольца и планирует его перезапуск.
+        """
+        if self.workers.get(worker.worker_id) is not worker:
+            return
+        worker.ready = False
+        worker.process.join(0)
+        if self._stopping:
+            return
+        self._stats["worker_exits"] += 1
+        logger.log(f"Обработчик Telegram {worker.worker_id} завершился (код {worker.process.exitcode}), "
+                   f"перезапуск через {self.restart_delay} с", "ERROR")
+        self._rebalance()
+        self._loop.call_later(self.restart_delay, self._spawn, worker.worker_id)
+
+    def _rebalance(self):
+        """
+        Перестраивает кольцо по готовым обработчикам и рассылает им новый состав.
+        """
+        members = [worker_id for worker_id, worker in self.workers.items() if worker.ready]
+        self.ring.set_members(members)
+        self._rebalanced_at = time.monotonic()
+        self._stats["rebalances"] += 1
+        for worker_id in members:
+            self._send(worker_id, ("members", members))
+        logger.log(f"Сессии Telegram распределены между обработчиками {members}")
+        if members and self._pending_commands:
+            pending, self._pending_commands = self._pending_commands, {}
+            for session_id, command in pending.items():
+                self._send_command(session_id, command)
+
+    def _send(self, worker_id, message):
+        """
+        Отправляет сообщение обработчику. Возвращает False, если обработчик недоступен.
+        """
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            return False
+        try:
+            worker.conn.send(message)
+            return True
+        except (OSError, ValueError) as e:
+            logger.log(f"Не удалось отправить сообщение обработчику Telegram {worker_id}: {e}", "WARNING")
+            return False
+
+    def _on_invalidation(self, name, key):
+        """
+        Передаёт инвалидацию кэша супервизора обработчикам. Вызывается из любого потока (в том числе из Flask),
+        поэтому отправка выполняется в событийном цикле супервизора.
+        """
+        if not self._stopping:
+            self._loop.call_soon_threadsafe(self._broadcast, ("invalidate", name, key))
+
+    def _broadcast(self, message):
+        """
+        Отправляет сообщение всем готовым обработчикам. Обработчики, ещё не сообщившие о готовности, получат
+        актуальные данные из базы при первом обращении.
+        """
+        self._stats["invalidations"] += 1
+        for worker_id, worker in self.workers.items():
+            if worker.ready:
+                self._send(worker_id, message)
+
+    def _send_command(self, session_id, command):
+        """
+        Передаёт команду обработчику-владельцу сессии. Если готового владельца нет, команда откладывается
+        до следующего перераспределения.
+        """
+        if self._send(self.ring.owner(session_id), command):
+            return
+        self._pending_commands[session_id] = command
+        self._stats["deferred_commands"] += 1
+        logger.log(f"Бот {session_id}: нет доступного обработчика, команда {command[0]} будет передана "
+                   f"при перераспределении", "WARNING")
+
+    async def start_bot(self, session_id, token):
+        """
+        Передаёт запуск бота обработчику-владельцу сессии.
+        """
+        self._send_command(session_id, ("start", session_id, token))
+
+    async def stop_bot(self, session_id):
+        """
+        Передаёт остановку бота обработчику-владельцу сессии.
+        """
+        self._send_command(session_id, ("stop", session_id))
+
+    async def handle(self, request):
+        """
+        Отбрасывает повторные доставки, пересылает обновление Telegram обработчику-владельцу сессии
+        и возвращает его ответ. Если обработчик не принял обновление, его регистрация отменяется.
+        """
+        session_id = request.match_info["session_id"]
+        data = await request.read()
+        try:
+            update_id = orjson.loads(data)["update_id"]
+        except (orjson.JSONDecodeError, TypeError, KeyError):
+            # Некорректное обновление отклоняется обработчиком
+            update_id = None
+        if update_id is not None and not await self.deduplicator.claim(session_id, update_id):
+            self._stats["duplicates"] += 1
+            return web.json_response({})
+        response = await self._forward(session_id, data)
+        if update_id is not None and response.status != 200:
+            await self.deduplicator.release(session_id, update_id)
+        return response
+
+    async def _forward(self, session_id, data):
+        """
+        Пересылает тело запроса Telegram обработчику-владельцу сессии и возвращает его ответ.
+        """
+        worker = self.workers.get(self.ring.owner(session_id))
+        if worker is None or not worker.ready:
+            self._stats["no_worker"] += 1
+            return WebhookServer.retry_later()
+        try:
+            async with self._client.post(f"http://127.0.0.1:{worker.port}/webhook/{session_id}",
+                                         data=data,
+                                         headers={"Content-Type": "application/json"}) as response:
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._stats["forward_errors"] += 1
+            logger.log(f"Обработчик Telegram {worker.worker_id} не принял обновление сессии {session_id}: {e}",
+                       "WARNING")
+            return WebhookServer.retry_later()
+        if response.status == 404:
+            if time.monotonic() - self._rebalanced_at < REBALANCE_GRACE:
+                # Новый владелец ещё не зарегистрировал сессию после перераспределения: Telegram повторит доставку
+                self._stats["not_registered"] += 1
+                return WebhookServer.retry_later()
+            # Сессия остановлена или удалена: ответ 404 передаётся Telegram, а не откладывает обновление бесконечно
+            self._stats["not_found"] += 1
+        self._stats["forwarded"] += 1
+        headers = {"Retry-After": response.headers["Retry-After"]} if "Retry-After" in response.headers else None
+        return web.Response(status=response.status, body=body, content_type="application/json", headers=headers)
+
+    async def stop(self):
+        """
+        Останавливает маршрутизатор и завершает процессы-обработчики.
+        """
+        self._stopping = True
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for worker_id in list(self.workers):
+            self._send(worker_id, ("shutdown",))
+        for worker in self.workers.values():
+            await asyncio.to_thread(worker.process.join, WORKER_STOP_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def stats(self):
+        """
+        Возвращает статистику супервизора.
+        :return: Словарь с составом кольца, состоянием обработчиков и счётчиками пересылки обновлений.
+        """
+        return {
+            "enabled": self.enabled,
+            "members": list(self.ring.members),
+            "pending_commands": len(self._pending_commands),
+            "dedup": self.deduplicator.stats(),
+            "workers": {
+                str(worker_id): {
+                    "pid": worker.process.pid,
+                    "port": worker.port,
+                    "alive": worker.process.is_alive(),
+                    "ready": worker.ready,
+                    "restarts": worker.restarts,
+                }
+                for worker_id, worker in self.workers.items()
+            },
+            **self._stats,
+        }
+
+
+class ShardWorker:
+    """
+    Связь процесса-обработчика с супервизором: выполняет команды супервизора в событийном цикле обработчика.
+    """
+
+    def __init__(self, worker_id, conn, manager):
+        """
+        :param worker_id: Номер обработчика.
+        :param conn: Канал связи с супервизором.
+        :param manager: Менеджер ботов обработчика (TelegramBotManager).
+        """
+        self.worker_id = worker_id
+        self.conn = conn
+        self.manager = manager
+        self.ring = HashRing(VIRTUAL_NODES)
+        self._loop = None
+        self._commands = None
+
+    def start(self, loop):
+        """
+        Сообщает супервизору о готовности и начинает выполнять его команды. Вызывается после запуска сервера вебхуков.
+        """
+        self._loop = loop
+        self._commands = asyncio.Queue()
+        loop.create_task(self._run())
+        threading.Thread(target=self._read_commands, daemon=True).start()
+        self.conn.send(("ready",))
+
+    def _read_commands(self):
+        """
+        Поток чтения команд супервизора. Закрытие канала (супервизор завершился) означает остановку обработчика.
+        """
+        while True:
+            try:
+                command = self.conn.recv()
+            except (EOFError, OSError):
+                command = ("shutdown",)
+            self._loop.call_soon_threadsafe(self._commands.put_nowait, command)
+            if command[0] == "shutdown":
+                return
+
+    async def _run(self):
+        """
+        Выполняет команды супервизора по порядку.
+        """
+        while True:
+            command = await self._commands.get()
+            try:
+                if command[0] == "members":
+                    await self._rebalance(command[1])
+                elif command[0] == "start":
+                    await self.manager.start_bot(command[1], command[2])
+                elif command[0] == "stop":
+                    await self.manager.stop_bot(command[1])
+                elif command[0] == "invalidate":
+                    apply_invalidation(command[1], command[2])
+                elif command[0] == "shutdown":
+                    await self.manager.stop_all_bots()
+                    self._loop.stop()
+                    return
+            except Exception as e:
+                logger.log(f"Обработчик Telegram {self.worker_id}: ошибка команды {command[0]}: {e}", "ERROR")
+
+    async def _rebalance(self, members):
+        """
+        Принимает новый состав кольца и оставляет зарегистрированными только сессии этого обработчика.
+        """
+        self.ring.set_members(members)
+        if bot_leases.enabled:
+            # В режиме кластера обработчик арендует сессии узла, которые принадлежат ему в кольце
+            self.manager.session_filter = lambda session_id: self.ring.owner(session_id) == self.worker_id
+            await self.manager.sync_leases()
+            self.manager.hold_leases()
+            return
+        sessions = await async_db.get_all_active_telegram_sessions()
+        if not sessions:
+            # Пустой список возвращается и при ошибке базы данных: текущие боты сохраняются
+            return
+        owned = [session for session in sessions if self.ring.owner(session['id']) == self.worker_id]
+        await self.manager.reconcile(owned)
+        logger.log(f"Обработчик Telegram {self.worker_id}: сессий {len(owned)} из {len(sessions)}")
+
+
+# Супервизор обработчиков для использования во всем приложении (включён при TELEGRAM_WORKER_PROCESSES > 0)
+shard_supervisor = ShardSupervisor(
+    workers=WORKER_PROCESSES,
+    host=WEBHOOK_HOST,
+    port=WEBHOOK_PORT,
+    base_port=WORKER_BASE_PORT,
+    restart_delay=WORKER_RESTART_DELAY,
+    # Окно только в памяти: при TELEGRAM_DEDUP_PERSISTENT=true таблицу telegram_updates заполняют обработчики
+    deduplicator=UpdateDeduplicator(name="telegram_router", window=DEDUP_WINDOW, persistent=False, retention_hours=0),
+)
@@ -0,0 +1,146 @@
+"""
+update_dedup.py
+Модуль отбрасывания повторных доставок обновлений Telegram.
+
+Telegram повторяет доставку вебхука, если не получил ответ вовремя. Чтобы повторная доставка не приводила
+ко второму запросу к модели и к дублю в истории чата, сервер вебхуков перед передачей обновления в обработку
+регистрирует пару (сессия, update_id). Уже зарегистрированные обновления подтверждаются Telegram и отбрасываются
+до обработчиков.
+
+Принятые обновления хранятся в памяти в ограниченном окне (TELEGRAM_DEDUP_WINDOW последних обновлений).
+При TELEGRAM_DEDUP_PERSISTENT=true они также записываются в таблицу `telegram_updates`, что защищает от повторов
+после перезапуска и при работе нескольких процессов. Записи старше TELEGRAM_DEDUP_RETENTION_HOURS часов удаляются
+фоновой очисткой. Если база данных недоступна, обновление считается новым.
+"""
+
+from collections import OrderedDict
+from database import db_async_functions as async_db
+from utils.logs.logger import logger
+from dotenv import load_dotenv
+import asyncio
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+DEDUP_WINDOW = int(os.getenv('TELEGRAM_DEDUP_WINDOW', 100000))
+DEDUP_PERSISTENT = os.getenv('TELEGRAM_DEDUP_PERSISTENT', 'false').lower() in ('1', 'true', 'yes')
+DEDUP_RETENTION_HOURS = int(os.getenv('TELEGRAM_DEDUP_RETENTION_HOURS', 24))
+
+# Интервал очистки устаревших записей таблицы telegram_updates в секундах
+CLEANUP_INTERVAL = 3600
+
+
+class UpdateDeduplicator:
+    """
+    Регистрирует принятые обновления и распознаёт повторные доставки.
+    Используется из одного событийного цикла, поэтому блокировки не требуются.
+    """
+
+    def __init__(self, name, window, persistent, retention_hours):
+        """
+        :param name: Имя (используется в статистике).
+        :param window: Количество последних обновлений, хранимых в памяти.
+        :param persistent: Записывать ли обновления в таблицу telegram_updates.
+        :param retention_hours: Срок хранения записей в таблице в часах.
+        """
+        self.name = name
+        self.window = max(window, 1)
+        self.persistent = persistent
+        self.retention_hours = retention_hours
+        self._seen = OrderedDict()  # (ID сессии, update_id) -> None
+        self._last_cleanup = time.monotonic()
+        self._cleanup_task = None
+        self._stats = {
+            "claimed": 0,
+            "duplicates": 0,
+            "persistent_duplicates": 0,
+            "released": 0,
+            "store_errors": 0,
+        }
+
+    def _remember(self, key):
+        """
+        Добавляет обновление в окно в памяти, вытесняя самые старые.
+        """
+        self._seen[key] = None
+        while len(self._seen) > self.window:
+            self._seen.popitem(last=False)
+
+    async def claim(self, session_id, update_id):
+        """
+        Регистрирует обновление как принятое.
+        :param session_id: ID сессии бота.
+        :param update_id: ID обновления Telegram.
+        :return: True, если обновление новое и его нужно обработать, False для повторной доставки.
+        """
+        key = (str(session_id), update_id)
+        if key in self._seen:
+            self._stats["duplicates"] += 1
+            return False
+        self._remember(key)
+        if self.persistent:
+            inserted = await async_db.insert_telegram_update(int(session_id), update_id)
+            if inserted is False:
+                self._stats["duplicates"] += 1
+                self._stats["persistent_duplicates"] += 1
+                return False
+            if inserted is None:
+                self._stats["store_errors"] += 1
+            self._schedule_cleanup()
+        self._stats["claimed"] += 1
+        return True
+
+    async def release(self, session_id, update_id):
+        """
+        Отменяет регистрацию обновления, которое не было принято в обработку (Telegram доставит его повторно).
+        """
+        self._seen.pop((str(session_id), update_id), None)
+        self._stats["released"] += 1
+        if self.persistent:
+            await async_db.delete_telegram_update(int(session_id), update_id)
+
+    def _schedule_cleanup(self):
+        """
+        Запускает фоновое удаление устаревших записей таблицы не чаще одного раза в CLEANUP_INTERVAL секунд.
+        """
+        now = time.monotonic()
+        if now - self._last_cleanup < CLEANUP_INTERVAL or self._cleanup_task is not None:
+            return
+        self._last_cleanup = now
+        self._cleanup_task = asyncio.create_task(self._cleanup())
+
+    async def _cleanup(self):
+        """
+        Удаляет записи о принятых обновлениях старше срока хранения.
+        """
+        try:
+            deleted = await async_db.delete_old_telegram_updates(self.retention_hours)
+            if deleted:
+                logger.log(f"Удалено {deleted} устаревших записей об обновлениях Telegram")
+        finally:
+            self._cleanup_task = None
+
+    def stats(self):
+        """
+        Возвращает статистику дедупликации.
+        :return: Словарь с размером окна и количеством принятых и отброшенных обновлений.
+        """
+        return {
+            "name": self.name,
+            "persistent": self.persistent,
+            "window": self.window,
+            "remembered": len(self._seen),
+            **self._stats,
+        }
+
+
+# Дедупликация обновлений Telegram для использования во всем приложении
+update_deduplicator = UpdateDeduplicator(
+    name="telegram",
+    window=DEDUP_WINDOW,
+    persistent=DEDUP_PERSISTENT,
+    retention_hours=DEDUP_RETENTION_HOURS,
+)
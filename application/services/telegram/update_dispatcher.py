@@ -0,0 +1,359 @@
+"""
+update_dispatcher.py
+Диспетчер обновлений Telegram с упорядоченными очередями диалогов.
+
+Обновления, принятые сервером вебхуков, распределяются по очередям диалогов (сессия, пользователь). Внутри диалога
+обновления обрабатываются строго по одному в порядке получения: второе сообщение пользователя не читает историю,
+пока ответ на первое не сохранён, поэтому ответы не перемешиваются и в истории нет пропусков. Разные диалоги
+обрабатываются параллельно, но одновременно работает не больше TELEGRAM_INGEST_WORKERS обработчиков, а общее
+количество ожидающих обновлений ограничено TELEGRAM_INGEST_QUEUE_SIZE.
+
+При перегрузке обновления не копятся без ограничений, а отбрасываются с немедленным ответом пользователю
+(сообщение об ошибке агента, см. webhook_server.py):
+- общее количество ожидающих обновлений достигло TELEGRAM_SHED_HIGH_WATER;
+- в очереди диалога уже TELEGRAM_CONVERSATION_MAX_DEPTH обновлений;
+- ожидаемое время ожидания обработки превышает TELEGRAM_UPDATE_DEADLINE секунд. Оно оценивается при приёме
+  обновления по длине очереди диалога, количеству диалогов, ожидающих обработчика, и скользящему среднему времени
+  обработки, поэтому пользователь получает ответ сразу, а не после ожидания в очереди;
+- обновление всё же ждало обработки дольше TELEGRAM_UPDATE_DEADLINE секунд (оценка оказалась заниженной).
+Количество отброшенных обновлений по сессиям доступно в статистике.
+
+Текстовые сообщения, пришедшие подряд, объединяются в одну серию по правилам `message_debouncer` (debounce.py):
+диалог становится готовым к обработке, когда пользователь замолчал. Ожидание не занимает обработчиков.
+"""
+
+from collections import deque
+from application.services.telegram.debounce import message_debouncer
+from utils.logs.logger import logger
+from dotenv import load_dotenv
+import asyncio
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+INGEST_QUEUE_SIZE = int(os.getenv('TELEGRAM_INGEST_QUEUE_SIZE', 10000))
+INGEST_WORKERS = int(os.getenv('TELEGRAM_INGEST_WORKERS', 64))
+SHED_HIGH_WATER = int(os.getenv('TELEGRAM_SHED_HIGH_WATER', INGEST_QUEUE_SIZE * 8 // 10))
+CONVERSATION_MAX_DEPTH = int(os.getenv('TELEGRAM_CONVERSATION_MAX_DEPTH', 20))
+UPDATE_DEADLINE = float(os.getenv('TELEGRAM_UPDATE_DEADLINE', 60))
+
+# Вес нового измерения в скользящем среднем времени обработки
+SERVICE_TIME_ALPHA = 0.1
+
+
+def conversation_user_id(update):
+    """
+    Возвращает ID пользователя, от которого пришло обновление (message, callback_query и т.д.).
+    :param update: Обновление Telegram в виде словаря.
+    :return: ID пользователя или None, если обновление не связано с пользователем.
+    """
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+class Conversation:
+    """
+    Очередь обновлений одного диалога.
+    """
+    __slots__ = ("updates", "running", "ready", "timer")
+
+    def __init__(self):
+        self.updates = deque()  # (обновление, время получения)
+        self.running = False  # Обновления диалога обрабатываются
+        self.ready = False  # Диалог стоит в очереди готовых к обработке
+        self.timer = None  # Отложенная постановка в очередь (ожидание конца серии сообщений)
+
+
+class UpdateDispatcher:
+    """
+    Распределяет обновления по упорядоченным очередям диалогов и обрабатывает их ограниченным числом обработчиков.
+    Используется из одного событийного цикла, поэтому блокировки не требуются.
+    """
+
+    def __init__(self, name, workers, max_pending, debouncer, high_water, max_depth, deadline):
+        """
+        :param name: Имя (используется в логах и статистике).
+        :param workers: Максимальное количество одновременно обрабатываемых диалогов.
+        :param max_pending: Максимальное количество ожидающих обработки обновлений.
+        :param debouncer: Правила объединения сообщений в серии (MessageDebouncer).
+        :param high_water: Количество ожидающих обновлений, начиная с которого новые обновления отбрасываются.
+        :param max_depth: Максимальная длина очереди одного диалога.
+        :param deadline: Максимальное время ожидания обработки в секундах. 0 отключает проверку.
+        """
+        self.name = name
+        self.workers = max(workers, 1)
+        self.max_pending = max_pending
+        self.debouncer = debouncer
+        self.high_water = min(high_water, max_pending)
+        self.max_depth = max(max_depth, 1)
+        self.deadline = deadline
+        self._conversations = {}  # (ID сессии, ID пользователя) -> Conversation
+        self._ready = None  # Очередь ключей диалогов, готовых к обработке
+        self._feed = None
+        self._on_shed = None
+        self._shed_by_session = {}  # ID сессии -> количество отброшенных обновлений
+        self._tasks = []
+        self._pending = 0
+        self._active = 0
+        self._service_time = 0.0  # Скользящее среднее времени обработки серии обновлений в секундах
+        self._stopping = False
+        self._stats = {
+            "updates": 0,
+            "processed": 0,
+            "rejected": 0,
+            "shed": 0,
+            "shed_high_water": 0,
+            "shed_conversation_depth": 0,
+            "shed_deadline": 0,
+            "shed_predicted_deadline": 0,
+            "errors": 0,
+            "max_pending": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    def start(self, feed, on_shed):
+        """
+        Запускает обработчики в текущем событийном цикле.
+        :param feed: Корутина feed(session_id, updates), обрабатывающая серию обновлений одного диалога.
+        :param on_shed: Функция on_shed(session_id, updates), вызываемая для отброшенных обновлений
+        (например, чтобы ответить пользователю сообщением об ошибке).
+        """
+        if self._tasks:
+            return
+        self._feed = feed
+        self._on_shed = on_shed
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def submit(self, session_id, update):
+        """
+        Ставит обновление в очередь его диалога. При перегрузке обновление отбрасывается (см. on_shed).
+        :return: False, если очередь заполнена и обновление не принято.
+        """
+        if self._pending >= self.max_pending:
+            self._stats["rejected"] += 1
+            return False
+        key = (session_id, conversation_user_id(update))
+        conversation = self._conversations.get(key)
+        if self._pending >= self.high_water:
+            self._shed(session_id, [update], "high_water")
+            return True
+        if conversation is not None and len(conversation.updates) >= self.max_depth:
+            self._shed(session_id, [update], "conversation_depth")
+            return True
+        if self.deadline and self._estimate_wait(conversation) > self.deadline:
+            self._shed(session_id, [update], "predicted_deadline")
+            return True
+        if conversation is None:
+            conversation = self._conversations[key] = Conversation()
+        conversation.updates.append((update, time.monotonic()))
+        self._pending += 1
+        self._stats["updates"] += 1
+        self._stats["max_pending"] = max(self._stats["max_pending"], self._pending)
+        self._schedule(key, conversation)
+        return True
+
+    def has_pending(self, session_id):
+        """
+        Проверяет, есть ли у сессии принятые обновления, ожидающие обработки или обрабатываемые.
+        """
+        return any(key[0] == session_id for key in self._conversations)
+
+    def _estimate_wait(self, conversation):
+        """
+        Оценивает время ожидания обработки нового обновления диалога: обработки, стоящие перед ним в очереди
+        диалога, и диалоги, ожидающие освобождения обработчика, умноженные на среднее время обработки.
+        Серия сообщений обрабатывается одним вызовом (см. _take_batch), поэтому считается за одну обработку.
+        :return: Оценка в секундах (0, пока время обработки не измерено).
+        """
+        if not self._service_time:
+            return 0.0
+        ahead = 0
+        if conversation is not None:
+            ahead = 1 if conversation.running else 0
+            in_burst = False
+            for update, _ in conversation.updates:
+                mergeable = self.debouncer.mergeable(update)
+                if not (mergeable and in_burst):
+                    ahead += 1
+                in_burst = mergeable
+        # Очередь готовых диалогов делится между обработчиками
+        backlog = max(0, self._ready.qsize() + self._active + 1 - self.workers) / self.workers
+        return (ahead + backlog) * self._service_time
+
+    def _shed(self, session_id, updates, reason):
+        """
+        Отбрасывает обновления и учитывает их в статистике.
+        :param reason: Причина: high_water, conversation_depth, predicted_deadline или deadline.
+        """
+        self.record_shed(session_id, reason, len(updates))
+        try:
+            self._on_shed(session_id, updates)
+        except Exception as e:
+            logger.log(f"Диспетчер '{self.name}': ошибка ответа на отброшенное обновление сессии {session_id}: {e}",
+                       "ERROR")
+
+    def record_shed(self, session_id, reason, count=1):
+        """
+        Учитывает отброшенные при перегрузке запросы сессии. Используется также обработчиками сообщений,
+        когда ответ не может быть сформирован вовремя (например, превышено ожидание лимитов API-ключа).
+        """
+        self._stats["shed"] += count
+        self._stats[f"shed_{reason}"] = self._stats.get(f"shed_{reason}", 0) + count
+        self._shed_by_session[session_id] = self._shed_by_session.get(session_id, 0) + count
+
+    def _schedule(self, key, conversation):
+        """
+        Ставит диалог в очередь готовых, если он не обрабатывается. Если первое обновление начинает серию сообщений,
+        постановка откладывается до её завершения.
+        """
+        if conversation.running or conversation.ready:
+            return
+        if conversation.timer is not None:
+            conversation.timer.cancel()
+            conversation.timer = None
+        delay = self._burst_ready_at(conversation) - time.monotonic()
+        if delay > 0:
+            conversation.timer = asyncio.get_running_loop().call_later(delay, self._on_burst_ready, key)
+            return
+        conversation.ready = True
+        self._ready.put_nowait(key)
+
+    def _on_burst_ready(self, key):
+        """
+        Ставит диалог в очередь готовых после завершения серии сообщений.
+        """
+        conversation = self._conversations.get(key)
+        if conversation is not None:
+            conversation.timer = None
+            self._schedule(key, conversation)
+
+    def _burst_ready_at(self, conversation):
+        """
+        Возвращает момент, когда серия сообщений в начале очереди диалога завершена (0, если серии нет).
+        """
+        if self._stopping:
+            return 0
+        size = 0
+        for update, _ in conversation.updates:
+            if not self.debouncer.mergeable(update):
+                break
+            size += 1
+        if size == 0 or size < len(conversation.updates):
+            return 0  # Серии нет или за ней уже пришло обновление другого типа, ждать больше нечего
+        return self.debouncer.ready_at(conversation.updates[0][1], conversation.updates[-1][1])
+
+    def _take_batch(self, conversation):
+        """
+        Забирает из очереди диалога следующее обновление или всю серию сообщений.
+        :return: Список обновлений и время получения последнего из них.
+        """
+        update, arrived = conversation.updates.popleft()
+        batch = [update]
+        last_arrived = arrived
+        if self.debouncer.mergeable(update):
+            while conversation.updates and self.debouncer.mergeable(conversation.updates[0][0]):
+                update, last_arrived = conversation.updates.popleft()
+                batch.append(update)
+            self.debouncer.record(len(batch))
+        wait_ms = (time.monotonic() - arrived) * 1000
+        self._stats["total_wait_ms"] += wait_ms
+        self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+        return batch, last_arrived
+
+    async def _work(self):
+        """
+        Обработчик: забирает готовый диалог и обрабатывает его следующее обновление или серию сообщений.
+        """
+        while True:
+            key = await self._ready.get()
+            conversation = self._conversations[key]
+            conversation.ready = False
+            conversation.running = True
+            batch, last_arrived = self._take_batch(conversation)
+            self._active += 1
+            try:
+                if self.deadline and time.monotonic() - last_arrived > self.deadline:
+                    self._shed(key[0], batch, "deadline")
+                else:
+                    started = time.monotonic()
+                    await self._feed(key[0], batch)
+                    elapsed = time.monotonic() - started
+                    if self._service_time:
+                        self._service_time += SERVICE_TIME_ALPHA * (elapsed - self._service_time)
+                    else:
+                        self._service_time = elapsed
+                    self._stats["processed"] += len(batch)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.log(f"Диспетчер '{self.name}': ошибка обработки обновления сессии {key[0]}: {e}", "ERROR")
+            finally:
+                self._active -= 1
+                self._pending -= len(batch)
+                conversation.running = False
+                if conversation.updates:
+                    self._schedule(key, conversation)
+                else:
+                    del self._conversations[key]
+                self._ready.task_done()
+
+    async def stop(self):
+        """
+        Обрабатывает уже принятые обновления и останавливает обработчики.
+        """
+        if not self._tasks:
+            return
+        self._stopping = True
+        for key, conversation in list(self._conversations.items()):
+            self._schedule(key, conversation)
+        while self._pending:
+            await self._ready.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._stopping = False
+
+    def stats(self):
+        """
+        Возвращает статистику диспетчера.
+        :return: Словарь с количеством ожидающих обновлений, диалогов и занятых обработчиков,
+        а также количеством отброшенных обновлений по причинам и по сессиям.
+        """
+        depths = [len(conversation.updates) for conversation in self._conversations.values()]
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "active_workers": self._active,
+            "pending": self._pending,
+            "max_pending_allowed": self.max_pending,
+            "high_water": self.high_water,
+            "max_depth": self.max_depth,
+            "deadline": self.deadline,
+            "service_time_ms": round(self._service_time * 1000, 1),
+            "conversations": len(depths),
+            "ready_conversations": self._ready.qsize() if self._ready is not None else 0,
+            "max_conversation_depth": max(depths, default=0),
+            **self._stats,
+            "total_wait_ms": round(self._stats["total_wait_ms"], 1),
+            "max_wait_ms": round(self._stats["max_wait_ms"], 1),
+            "shed_by_session": dict(self._shed_by_session),
+        }
+
+
+# Диспетчер обновлений Telegram для использования во всем приложении
+update_dispatcher = UpdateDispatcher(
+    name="telegram",
+    workers=INGEST_WORKERS,
+    max_pending=INGEST_QUEUE_SIZE,
+    debouncer=message_debouncer,
+    high_water=SHED_HIGH_WATER,
+    max_depth=CONVERSATION_MAX_DEPTH,
+    deadline=UPDATE_DEADLINE,
+)
@@ -0,0 +1,310 @@
+"""
+webhook_server.py
+Общий aiohttp-сервер вебхуков для всех Telegram-ботов.
+
+Вместо отдельного aiohttp-приложения и порта на каждого бота все боты принимают обновления на одном порту
+(TELEGRAM_WEBHOOK_PORT) по пути `/webhook/{session_id}`. Сервер находит бота сессии в реестре в памяти, который
+пополняется и очищается `TelegramBotManager` при запуске и остановке ботов, поэтому тысячи ботов используют один
+слушающий сокет. Реестр хранит не самих ботов, а функции их получения: экземпляр бота создаётся менеджером
+при первом обновлении и выгружается при простое.
+
+Сервер работает в событийном цикле ботов, а не во Flask, и отвечает Telegram сразу после разбора тела запроса
+(orjson): обновление передаётся диспетчеру обновлений (update_dispatcher.py), который обрабатывает обновления
+каждого диалога по порядку ограниченным числом обработчиков. У приёма собственное ограничение частоты на сессию
+(TELEGRAM_INGEST_RATE обновлений в секунду с запасом TELEGRAM_INGEST_BURST), не связанное с лимитами веб-интерфейса.
+Если лимит превышен или очередь диспетчера заполнена, Telegram получает 429 и доставляет обновление повторно позже.
+Обновления, отброшенные диспетчером при перегрузке, получают немедленный ответ с сообщением об ошибке агента
+(`gpt_agents.error_message`) вместо ожидания в очереди.
+
+Повторные доставки одного обновления (тот же update_id) подтверждаются и отбрасываются до обработчиков
+(см. update_dedup.py).
+
+Если сессия переходит к другому процессу (`TelegramBotManager.release`), уже подтверждённые Telegram обновления
+сессии обрабатываются до конца: бот сессии остаётся доступным диспетчеру, пока её очередь не опустеет,
+а новые обновления получают ответ 404.
+
+Обратный прокси SERVER_ADDRESS должен направлять все запросы `/webhook/` на TELEGRAM_WEBHOOK_PORT.
+"""
+
+from aiohttp import web
+from application.services.telegram.update_dedup import update_deduplicator
+from application.services.telegram.update_dispatcher import update_dispatcher
+from database import db_async_functions as async_db
+from utils.logs.logger import logger
+from dotenv import load_dotenv
+import asyncio
+import orjson
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+WEBHOOK_HOST = os.getenv('TELEGRAM_WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', 8443))
+INGEST_RATE = float(os.getenv('TELEGRAM_INGEST_RATE', 30))
+INGEST_BURST = int(os.getenv('TELEGRAM_INGEST_BURST', 60))
+
+# Через сколько секунд Telegram следует повторить доставку отклонённого обновления
+RETRY_AFTER = 1
+# Максимальное количество одновременно отправляемых ответов на отброшенные обновления
+MAX_SHED_REPLIES = 100
+# Ответ пользователю, если у агента не задано сообщение об ошибке
+DEFAULT_ERROR_MESSAGE = "Извините, агент недоступен."
+
+
+def agent_error_message(agent):
+    """
+    Возвращает сообщение об ошибке агента, которое отправляется пользователю, если ответ не может быть сформирован.
+    """
+    return (agent or {}).get('error_message') or DEFAULT_ERROR_MESSAGE
+
+
+class SessionRateLimiter:
+    """
+    Ограничение частоты обновлений на сессию по алгоритму token bucket.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: Допустимое количество обновлений в секунду. 0 отключает ограничение.
+        :param burst: Максимальное количество обновлений, принимаемых подряд без ожидания.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._buckets = {}  # ID сессии -> (доступные токены, время последнего пополнения)
+
+    def allow(self, session_id):
+        """
+        Проверяет, можно ли принять обновление сессии, и расходует токен.
+        """
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(session_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[session_id] = (tokens, now)
+            return False
+        self._buckets[session_id] = (tokens - 1, now)
+        return True
+
+    def forget(self, session_id):
+        """
+        Удаляет состояние сессии (при остановке бота).
+        """
+        self._buckets.pop(session_id, None)
+
+
+class WebhookServer:
+    """
+    aiohttp-сервер, распределяющий обновления Telegram между ботами по ID сессии из пути запроса.
+    """
+
+    def __init__(self, host, port, dispatcher, deduplicator, rate, burst):
+        """
+        :param host: Адрес, на котором сервер принимает соединения.
+        :param port: Порт сервера.
+        :param dispatcher: Диспетчер обновлений (UpdateDispatcher).
+        :param deduplicator: Дедупликация обновлений по update_id (UpdateDeduplicator).
+        :param rate: Допустимое количество обновлений в секунду на сессию.
+        :param burst: Запас обновлений сессии, принимаемых подряд.
+        """
+        self.host = host
+        self.port = port
+        self.dispatcher = dispatcher
+        self.deduplicator = deduplicator
+        self.rate_limiter = SessionRateLimiter(rate, burst)
+        self._bots = {}  # ID сессии -> функция, возвращающая TelegramBotRunner сессии
+        self._draining = {}  # ID снятой сессии -> функция, возвращающая бота для обработки уже принятых обновлений
+        self._runner = None
+        self._shed_replies = set()  # Задачи отправки ответов на отброшенные обновления
+        self._start_lock = asyncio.Lock()
+        self._stats = {
+            "updates": 0,
+            "unknown_session": 0,
+            "bad_requests": 0,
+            "duplicates": 0,
+            "rate_limited": 0,
+            "queue_full": 0,
+            "shed_replies": 0,
+            "shed_replies_skipped": 0,
+        }
+
+    async def start(self):
+        """
+        Запускает сервер и диспетчер обновлений, если они ещё не запущены. Вызывается при запуске первого бота.
+        """
+        async with self._start_lock:
+            if self._runner is not None:
+                return
+            self.dispatcher.start(self._feed_updates, self._reply_shed)
+            app = web.Application()
+            app.router.add_post("/webhook/{session_id}", self.handle)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, self.host, self.port).start()
+            self._runner = runner
+            logger.log(f"Сервер вебхуков Telegram запущен на {self.host}:{self.port}")
+
+    def register(self, session_id, activate):
+        """
+        Добавляет бота сессии в реестр: с этого момента его обновления принимаются и передаются диспетчеру бота.
+        :param activate: Функция без параметров, возвращающая TelegramBotRunner сессии (создаёт его при необходимости).
+        """
+        self._bots[str(session_id)] = activate
+        self._draining.pop(str(session_id), None)
+
+    def unregister(self, session_id, drain=None):
+        """
+        Удаляет бота сессии из реестра. Обновления для него получают ответ 404.
+        :param drain: Функция, возвращающая TelegramBotRunner сессии, которым обрабатываются уже принятые обновления.
+        Если не передана, они пропускаются (бот остановлен).
+        """
+        session_id = str(session_id)
+        self._bots.pop(session_id, None)
+        self.rate_limiter.forget(session_id)
+        if drain is not None and self.dispatcher.has_pending(session_id):
+            self._draining[session_id] = drain
+
+    def _activator(self, session_id):
+        """
+        Возвращает функцию получения бота сессии, в том числе снятой сессии с необработанными обновлениями.
+        """
+        return self._bots.get(session_id) or self._draining.get(session_id)
+
+    def _finish_draining(self, session_id):
+        """
+        Забывает бота снятой сессии, если все её принятые обновления обработаны.
+        """
+        if session_id in self._draining and not self.dispatcher.has_pending(session_id):
+            del self._draining[session_id]
+
+    @staticmethod
+    def retry_later():
+        """
+        Ответ, после которого Telegram повторит доставку обновления.
+        """
+        return web.json_response({"error": "Too many requests"}, status=429,
+                                 headers={"Retry-After": str(RETRY_AFTER)})
+
+    async def handle(self, request):
+        """
+        Принимает обновление Telegram, передаёт его диспетчеру обновлений и сразу отвечает.
+        """
+        session_id = request.match_info["session_id"]
+        if session_id not in self._bots:
+            self._stats["unknown_session"] += 1
+            return web.json_response({"error": "Bot not found"}, status=404)
+        try:
+            update = orjson.loads(await request.read())
+            update_id = update["update_id"]
+        except (orjson.JSONDecodeError, TypeError, KeyError):
+            self._stats["bad_requests"] += 1
+            return web.json_response({"error": "Invalid update"}, status=400)
+        if not await self.deduplicator.claim(session_id, update_id):
+            self._stats["duplicates"] += 1
+            return web.json_response({})
+        if not self.rate_limiter.allow(session_id):
+            self._stats["rate_limited"] += 1
+            await self.deduplicator.release(session_id, update_id)
+            return self.retry_later()
+        if not self.dispatcher.submit(session_id, update):
+            self._stats["queue_full"] += 1
+            await self.deduplicator.release(session_id, update_id)
+            return self.retry_later()
+        self._stats["updates"] += 1
+        return web.json_response({})
+
+    async def _feed_updates(self, session_id, updates):
+        """
+        Обрабатывает диспетчером бота обновление или серию сообщений одного диалога. Серия передаётся как последнее
+        сообщение, а тексты всех сообщений серии - в данных обработчика `merged_texts`.
+        Обновления ботов, остановленных после приёма, пропускаются.
+        """
+        activate = self._activator(session_id)
+        if activate is None:
+            return
+        data = {}
+        if len(updates) > 1:
+            data["merged_texts"] = [update["message"]["text"] for update in updates]
+        runner = activate()
+        runner.in_flight += 1
+        try:
+            await runner.dp.feed_raw_update(bot=runner.bot, update=updates[-1], **data)
+        finally:
+            runner.in_flight -= 1
+            runner.touch()
+            if session_id in self._draining:
+                # Диалог удаляется диспетчером после возврата из обработки, поэтому проверка откладывается
+                asyncio.get_running_loop().call_soon(self._finish_draining, session_id)
+
+    def _reply_shed(self, session_id, updates):
+        """
+        Запускает отправку сообщения об ошибке агента в ответ на отброшенные обновления одного диалога.
+        Если ответов отправляется слишком много, новые обновления отбрасываются без ответа.
+        """
+        activate = self._activator(session_id)
+        message = updates[-1].get("message")
+        if activate is None or not message:
+            return
+        if len(self._shed_replies) >= MAX_SHED_REPLIES:
+            self._stats["shed_replies_skipped"] += 1
+            return
+        task = asyncio.create_task(self._send_error_message(session_id, activate(), message["chat"]["id"]))
+        self._shed_replies.add(task)
+        task.add_done_callback(self._shed_replies.discard)
+
+    async def _send_error_message(self, session_id, runner, chat_id):
+        """
+        Отправляет в чат сообщение об ошибке агента сессии.
+        """
+        runner.in_flight += 1
+        try:
+            session = await async_db.get_session_by_id(int(session_id))
+            agent = await async_db.get_agent_by_id(session['agent_id']) if session else None
+            await runner.bot.send_message(chat_id, agent_error_message(agent))
+            self._stats["shed_replies"] += 1
+        except Exception as e:
+            logger.log(f"Бот {session_id}: не удалось отправить сообщение о перегрузке: {e}", "WARNING")
+        finally:
+            runner.in_flight -= 1
+            runner.touch()
+
+    async def stop(self):
+        """
+        Останавливает сервер, дожидается обработки уже принятых обновлений и останавливает диспетчер.
+        """
+        if self._runner is None:
+            return
+        await self._runner.cleanup()
+        self._runner = None
+        await self.dispatcher.stop()
+
+    def stats(self):
+        """
+        Возвращает статистику сервера вебхуков.
+        :return: Словарь с количеством зарегистрированных ботов и счётчиками запросов.
+        """
+        return {
+            "host": self.host,
+            "port": self.port,
+            "running": self._runner is not None,
+            "bots": len(self._bots),
+            "draining": len(self._draining),
+            "rate": self.rate_limiter.rate,
+            "burst": self.rate_limiter.burst,
+            **self._stats,
+        }
+
+
+# Сервер вебхуков для использования во всем приложении
+webhook_server = WebhookServer(
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    dispatcher=update_dispatcher,
+    deduplicator=update_deduplicator,
+    rate=INGEST_RATE,
+    burst=INGEST_BURST,
+)
@@ -44,6 +44,11 @@ class WhatsAppBotManager:
         task.cancel()
         logger.log(f"WhatsApp бот {session_id} остановлен", "INFO")
 
+    async def start_all_bots(self, sessions):
+        """Асинхронно запускает BAS-ботов для всех активных сессий."""
+        tasks = [self.start_bot(session['id'], session['bot_username']) for session in sessions]
+        await asyncio.gather(*tasks)
+
     async def stop_all_bots(self):
         """Асинхронно останавливает все сессии."""
         tasks = [self.stop_bot(session_id) for session_id in self.sessions.keys()]
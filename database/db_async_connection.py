@@ -0,0 +1,126 @@
+"""
+db_async_connection.py
+Модуль для управления асинхронными соединениями с базой данных.
+Используется обработчиками ботов, работающими в главном событийном цикле asyncio: запросы выполняются через
+асинхронный драйвер aiomysql и не блокируют цикл, пока база данных отвечает.
+"""
+
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+import aiomysql
+import asyncio
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+
+class AsyncConnectionPool:
+    """
+    Асинхронный пул соединений с базой данных.
+    Пул создаётся лениво при первом обращении внутри работающего событийного цикла и привязан к этому циклу.
+    """
+
+    def __init__(self, name, min_size, max_size, timeout, recycle):
+        """
+        :param name: Имя пула (используется в логах и статистике).
+        :param min_size: Минимальное количество открытых соединений.
+        :param max_size: Максимальное количество открытых соединений.
+        :param timeout: Максимальное время ожидания свободного соединения в секундах.
+        :param recycle: Время жизни соединения в секундах, после которого оно пересоздаётся.
+        """
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.recycle = recycle
+        self._pool = None
+        self._lock = None
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+        }
+
+    async def _get_pool(self):
+        """
+        Возвращает пул aiomysql, создавая его при первом вызове.
+        """
+        if self._pool is not None:
+            return self._pool
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._pool is None:
+                self._pool = await aiomysql.create_pool(
+                    user=os.getenv('DB_USER'),
+                    password=os.getenv('DB_PASSWORD'),
+                    host=os.getenv('DB_HOST'),
+                    db=os.getenv('DB_NAME'),
+                    minsize=self.min_size,
+                    maxsize=self.max_size,
+                    pool_recycle=self.recycle,
+                    autocommit=True,
+                    charset='utf8mb4'
+                )
+                print(f"Асинхронный пул соединений '{self.name}' инициализирован.")
+        return self._pool
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Асинхронный контекстный менеджер для получения соединения из пула и его гарантированного возврата.
+
+        Пример:
+            async with async_db_pool.connection() as connection:
+                async with connection.cursor(aiomysql.DictCursor) as cursor:
+                    ...
+        :raises asyncio.TimeoutError: Если соединение не освободилось за `timeout` секунд.
+        """
+        pool = await self._get_pool()
+        try:
+            connection = await asyncio.wait_for(pool.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise
+        self._stats["checkouts"] += 1
+        try:
+            yield connection
+        finally:
+            pool.release(connection)
+
+    def stats(self):
+        """
+        Возвращает статистику пула.
+
+        :return: Словарь с размером пула, количеством свободных соединений и счётчиками.
+        """
+        pool = self._pool
+        return {
+            "name": self.name,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "size": pool.size if pool else 0,
+            "idle": pool.freesize if pool else 0,
+            **self._stats,
+        }
+
+    async def close(self):
+        """
+        Закрывает все соединения пула.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+            print(f"Асинхронный пул соединений '{self.name}' закрыт.")
+
+
+# Асинхронный пул соединений для обработчиков ботов
+async_db_pool = AsyncConnectionPool(
+    name="async",
+    min_size=int(os.getenv('DB_ASYNC_POOL_MIN_SIZE', 1)),
+    max_size=int(os.getenv('DB_ASYNC_POOL_MAX_SIZE', 20)),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    recycle=int(os.getenv('DB_ASYNC_POOL_RECYCLE', 3600)),
+)
@@ -0,0 +1,529 @@
+"""
+db_async_functions.py
+Асинхронные аналоги функций из db_functions.py для кода, работающего в главном событийном цикле asyncio
+(обработчики Telegram-ботов, запуск ботов и WhatsApp-сессий).
+Функции имеют те же имена, параметры и возвращаемые значения, что и синхронные версии, но выполняют запросы
+через асинхронный пул соединений и не блокируют событийный цикл.
+"""
+
+import asyncio
+from aiomysql import Error, DictCursor
+from database.db_async_connection import async_db_pool
+from database.db_cache import agent_cache, session_cache, user_cache, user_exists_cache
+from database.db_write_buffer import CHAT_WRITE_BEHIND, chat_write_buffer
+from database.db_functions import (HISTORY_KEYSET_CONDITION, MESSAGE_CONTEXT_QUERY, build_message_context,
+                                   get_cached_message_context, message_context_cache_versions, cache_message_context,
+                                   ACTIVE_SESSIONS_QUERY, build_active_sessions)
+from utils.logs.logger import logger
+from utils.utils import HISTORY_PAGE_SIZE, take_turns_within_budget, format_recent_history
+
+
+######################################## Функции для работы с таблицей "users" #########################################
+
+async def get_user_by_id(user_id):
+    """
+    Извлекает данные пользователя по его ID.
+    :param user_id: ID пользователя, данные которого нужно получить.
+    :return: Словарь с данными пользователя или None, если пользователь не найден.
+    """
+    hit, user = user_cache.get(user_id)
+    if hit:
+        return user
+    version = user_cache.version()
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute("SELECT id AS user_id, username, password, role_id, full_name, email, phone_number FROM users WHERE id = %s AND is_deleted = FALSE", (user_id,))
+                user = await cursor.fetchone()
+                if user:
+                    user_cache.set(user_id, user, version)
+                return user
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении пользователя: {e}", "ERROR")
+
+
+async def insert_user(id, username, password, role_id, full_name=''):
+    """
+    Вставляет нового пользователя в базу данных.
+    Пользователь с тем же id может быть создан параллельно (первые сообщения пользователя обрабатываются
+    одновременно), поэтому повторная вставка по первичному ключу не считается ошибкой.
+    :param id: id пользователя.
+    :param username: Имя нового пользователя (уникальное).
+    :param password: Пароль нового пользователя.
+    :param role_id: id роли.
+    :param full_name: Полное имя пользователя (если есть).
+    :return: True, если пользователь создан, False, если пользователь с таким id уже существует, None при ошибке.
+    :raises ValueError: Если имя пользователя уже занято.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(
+                    "INSERT INTO users (id, username, password, role_id, full_name) VALUES (%s, %s, %s, %s, %s)",
+                    (id, username, password, role_id, full_name)
+                )
+        user_exists_cache.set(id, True)
+        return True
+    except Error as e:
+        if "Duplicate entry" not in str(e):
+            raise e
+        if "PRIMARY" in str(e):
+            user_exists_cache.set(id, True)
+            return False
+        raise ValueError("Пользователь с таким именем уже существует.")
+    except asyncio.TimeoutError as e:
+        logger.log(f"Ошибка при добавлении пользователя {id}: {e}", "ERROR")
+        return None
+
+
+async def get_last_user_id():
+    """
+    Возвращает последний id пользователя в диапазоне до 10000.
+    :return: Последний id в диапазоне до 10000 или None, если таких пользователей нет.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT MAX(id) + 1 FROM users WHERE id <= 10000")
+                result = await cursor.fetchone()
+                return result[0]
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении последнего id пользователя: {e}", "ERROR")
+        return None
+
+
+async def check_user_exists(user_id):
+    """
+    Проверяет, существует ли пользователь с указанным ID.
+    :param user_id: ID пользователя, которого нужно проверить.
+    :return: True, если пользователь существует, иначе False.
+    """
+    hit, _ = user_exists_cache.get(user_id)
+    if hit:
+        return True
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT COUNT(*) FROM users WHERE id = %s", (user_id,))
+                result = await cursor.fetchone()
+                if result[0] > 0:
+                    user_exists_cache.set(user_id, True)
+                return result[0] > 0
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при проверке пользователя: {e}", "ERROR")
+        return False
+
+
+async def check_user_exists_by_full_name(full_name):
+    """
+    Проверяет, существует ли пользователь с указанным full_name.
+    :param full_name: Полное имя пользователя, которого нужно проверить.
+    :return: True, если пользователь существует, иначе False.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT COUNT(*) FROM users WHERE full_name = %s", (full_name,))
+                result = await cursor.fetchone()
+                return result[0] > 0
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при проверке пользователя: {e}", "ERROR")
+        return False
+
+
+###################################### Функции для работы с таблицей "gpt_agents" ######################################
+
+async def get_agent_by_id(agent_id):
+    """
+    Извлекает данные агента GPT по его ID.
+    :param agent_id: ID агента GPT, данные которого нужно получить.
+    :return: Словарь с данными агента или None, если агент не найден.
+    """
+    hit, agent = agent_cache.get(agent_id)
+    if hit:
+        return agent
+    version = agent_cache.version()
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute("SELECT * FROM gpt_agents WHERE id = %s AND is_deleted = FALSE", (agent_id,))
+                agent = await cursor.fetchone()
+                if agent:
+                    agent_cache.set(agent_id, agent, version)
+                return agent
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении агента: {e}", "ERROR")
+
+
+######################################### Функции для работы таблицей с "chats" ########################################
+
+async def flush_pending_chat_messages(session_id, user_id):
+    """
+    Записывает в базу сообщения пользователя в сессии, ожидающие в буфере отложенной записи,
+    чтобы они были видны при чтении истории. Запись выполняется в отдельном потоке и не блокирует событийный цикл.
+    """
+    if chat_write_buffer.has_pending(session_id=session_id, user_id=user_id):
+        await asyncio.to_thread(chat_write_buffer.flush_for, session_id=session_id, user_id=user_id)
+
+
+async def get_chat_history_by_session_id_and_user_id(session_id, user_id):
+    """
+    Извлекает историю чата для заданной сессии и пользователя с дополнительными данными.
+    """
+    await flush_pending_chat_messages(session_id, user_id)
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                query = """
+                SELECT
+                    c.id AS chat_id,
+                    c.user_message,
+                    c.bot_response,
+                    c.created_at,
+                    u.full_name AS user_name,
+                    b.bot_name
+                FROM chats c
+                INNER JOIN users u ON c.user_id = u.id
+                INNER JOIN sessions s ON c.session_id = s.id
+                INNER JOIN bots b ON c.session_id = b.session_id
+                WHERE c.session_id = %s
+                  AND c.user_id = %s
+                  AND c.is_deleted = FALSE
+                ORDER BY c.created_at ASC
+                """
+                await cursor.execute(query, (session_id, user_id))
+                history = await cursor.fetchall()
+                # Формируем список сообщений
+                conversation_history = []
+                for record in history:
+                    if record['user_message']:
+                        conversation_history.append({"role": "user", "content": record['user_message'],
+                                                     "user_name": record['user_name'], "bot_name": record['bot_name'], "created_at": record['created_at']})
+                    if record['bot_response']:
+                        conversation_history.append({"role": "assistant", "content": record['bot_response'],
+                                                     "user_name": record['user_name'], "bot_name": record['bot_name'], "created_at": record['created_at']})
+                return conversation_history
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при чтении истории чата: {e}", "ERROR")
+        return []
+
+
+async def get_recent_chat_history_by_session_id_and_user_id(session_id, user_id, max_turns, token_budget):
+    """
+    Извлекает последние сообщения пользователя в сессии, помещающиеся в окно истории агента.
+    Сообщения читаются от новых к старым страницами с keyset-пагинацией.
+    :param session_id: ID сессии.
+    :param user_id: ID пользователя.
+    :param max_turns: Максимальное количество пар "сообщение - ответ".
+    :param token_budget: Бюджет токенов истории.
+    :return: Список словарей с ролью (user или assistant) и текстом сообщения (content) в хронологическом порядке.
+    """
+    query = """
+    SELECT id, user_message, bot_response, created_at
+    FROM chats
+    WHERE session_id = %s AND user_id = %s AND is_deleted = FALSE {keyset}
+    ORDER BY created_at DESC, id DESC
+    LIMIT %s
+    """
+    await flush_pending_chat_messages(session_id, user_id)
+    turns = []
+    used_tokens = 0
+    last_record = None
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                while len(turns) < max_turns:
+                    page_size = min(HISTORY_PAGE_SIZE, max_turns - len(turns))
+                    if last_record is None:
+                        await cursor.execute(query.format(keyset=""), (session_id, user_id, page_size))
+                    else:
+                        keyset = (last_record['created_at'], last_record['created_at'], last_record['id'])
+                        await cursor.execute(query.format(keyset=HISTORY_KEYSET_CONDITION),
+                                             (session_id, user_id, *keyset, page_size))
+                    page = await cursor.fetchall()
+                    used_tokens, exhausted = take_turns_within_budget(page, turns, used_tokens, token_budget)
+                    if exhausted or len(page) < page_size:
+                        break
+                    last_record = page[-1]
+        return format_recent_history(turns)
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при чтении истории чата: {e}", "ERROR")
+        return []
+
+
+async def insert_chat_message_for_session(user_id, agent_id, chat_type_id, session_id, user_message, bot_response):
+    """
+    Вставляет новое сообщение чата с учетом session_id.
+    :param user_id: ID пользователя, отправившего сообщение.
+    :param agent_id: ID агента, участвующего в чате.
+    :param chat_type_id: ID типа чата.
+    :param session_id: ID сессии, для которой вставляется сообщение.
+    :param user_message: Текст сообщения пользователя.
+    :param bot_response: Текст ответа бота.
+    """
+    if CHAT_WRITE_BEHIND:
+        # Буфер только добавляет строку в память, запись выполняет его фоновый поток
+        chat_write_buffer.add(user_id, agent_id, chat_type_id, session_id, user_message, bot_response)
+        return
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                query = """
+                INSERT INTO chats (user_id, agent_id, chat_type_id, session_id, user_message, bot_response)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """
+                await cursor.execute(query, (user_id, agent_id, chat_type_id, session_id, user_message, bot_response))
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при записи истории чата: {e}", "ERROR")
+
+
+####################################### Функции для работы с таблицей "sessions" #######################################
+
+async def get_all_active_telegram_sessions():
+    """
+    Извлекает одним запросом все активные Telegram-сессии вместе с токеном и портом бота и настройками агента.
+    Загруженные сессии и агенты сохраняются в кэш.
+    :return: Список активных сессий; настройки агента каждой сессии находятся в ключе 'agent'.
+    """
+    versions = message_context_cache_versions()
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute(ACTIVE_SESSIONS_QUERY, (2,))
+                return build_active_sessions(await cursor.fetchall(), versions)
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении активных сессий: {e}", "ERROR")
+        return []
+
+
+async def get_all_active_whatsapp_sessions():
+    """
+    Извлекает список всех активных WhatsApp-сессий из базы данных.
+    :return: Список активных сессий.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute("""
+                    SELECT s.id, s.agent_id, s.chat_type_id, b.bot_username, s.is_active, s.created_at, s.updated_at
+                    FROM sessions s
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.is_active = TRUE AND s.is_deleted = FALSE AND s.chat_type_id = 4
+                """)
+                sessions = await cursor.fetchall()
+                return sessions
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении активных сессий: {e}", "ERROR")
+        return []
+
+
+async def get_session_by_id(session_id):
+    """
+    Извлекает информацию о сессии по её ID.
+    :param session_id: ID сессии.
+    :return: Словарь с данными сессии или None, если сессия не найдена.
+    """
+    hit, session = session_cache.get(session_id)
+    if hit:
+        return session
+    version = session_cache.version()
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute("""
+                    SELECT s.id, s.agent_id, s.chat_type_id, s.user_id, s.is_active, b.api_token, b.webhook_port,
+                           s.created_at, s.updated_at, b.bot_name, b.bot_username, b.bot_description, a.name AS agent_name,
+                           ct.id as chat_type_id, ct.name AS platform
+                    FROM sessions s
+                    INNER JOIN gpt_agents a ON s.agent_id = a.id
+                    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.id = %s AND s.is_deleted = FALSE
+                """, (session_id,))
+                session = await cursor.fetchone()
+                if session:
+                    session_cache.set(session_id, session, version)
+                return session
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении данных сессии: {e}", "ERROR")
+        return None
+
+
+async def get_message_context(session_id, user_id):
+    """
+    Загружает одним запросом всё, что нужно для обработки входящего сообщения бота:
+    данные сессии и бота, настройки и API-ключ агента, а также признак существования пользователя.
+    Если все данные уже есть в кэше, запрос к базе не выполняется.
+    :param session_id: ID сессии.
+    :param user_id: ID пользователя, отправившего сообщение.
+    :return: Словарь с ключами session, agent, api_key и user_exists или None, если сессия не найдена.
+    """
+    context = get_cached_message_context(session_id, user_id)
+    if context is not None:
+        return context
+    versions = message_context_cache_versions()
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor(DictCursor) as cursor:
+                await cursor.execute(MESSAGE_CONTEXT_QUERY, (user_id, session_id))
+                context = build_message_context(await cursor.fetchone())
+                if context is not None:
+                    cache_message_context(context, user_id, versions)
+                return context
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении контекста сообщения: {e}", "ERROR")
+        return None
+
+
+################################### Функции для работы с таблицей "telegram_updates" ###################################
+
+async def insert_telegram_update(session_id, update_id):
+    """
+    Записывает обновление Telegram как принятое.
+    :param session_id: ID сессии бота.
+    :param update_id: ID обновления Telegram.
+    :return: True, если обновление записано впервые, False, если оно уже было принято, None при ошибке.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("INSERT IGNORE INTO telegram_updates (session_id, update_id) VALUES (%s, %s)",
+                                     (session_id, update_id))
+                return cursor.rowcount > 0
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при записи обновления Telegram: {e}", "ERROR")
+        return None
+
+
+async def delete_telegram_update(session_id, update_id):
+    """
+    Удаляет запись о принятом обновлении Telegram (если обновление не было принято в обработку).
+    :param session_id: ID сессии бота.
+    :param update_id: ID обновления Telegram.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("DELETE FROM telegram_updates WHERE session_id = %s AND update_id = %s",
+                                     (session_id, update_id))
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при удалении обновления Telegram: {e}", "ERROR")
+
+
+async def delete_old_telegram_updates(retention_hours, limit=10000):
+    """
+    Удаляет записи о принятых обновлениях старше retention_hours часов.
+    :param retention_hours: Срок хранения записей в часах.
+    :param limit: Максимальное количество удаляемых за один вызов записей.
+    :return: Количество удаленных записей.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("""
+                    DELETE FROM telegram_updates WHERE received_at < NOW() - INTERVAL %s HOUR LIMIT %s
+                """, (retention_hours, limit))
+                return cursor.rowcount
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при удалении старых обновлений Telegram: {e}", "ERROR")
+        return 0
+
+
+##################################### Функции для работы с таблицей "bot_leases" #####################################
+
+async def get_bot_lease_owners(session_ids):
+    """
+    Возвращает владельцев аренды сессий (в том числе истёкшей).
+    :param session_ids: Список ID сессий.
+    :return: Словарь {ID сессии: владелец} для сессий, у которых есть запись аренды, или None при ошибке.
+    """
+    placeholders = ", ".join(["%s"] * len(session_ids))
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(f"SELECT session_id, owner FROM bot_leases WHERE session_id IN ({placeholders})",
+                                     tuple(session_ids))
+                return {session_id: owner for session_id, owner in await cursor.fetchall()}
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении аренды сессий: {e}", "ERROR")
+        return None
+
+
+async def acquire_bot_leases(session_ids, owner, ttl):
+    """
+    Продлевает аренду сессий владельца и захватывает свободные и истёкшие. Аренда, удерживаемая другим владельцем,
+    не изменяется. Время истечения считается по часам сервера MySQL, поэтому расхождение часов узлов не влияет на аренду.
+    :param session_ids: Список ID сессий.
+    :param owner: Идентификатор узла.
+    :param ttl: Срок аренды в секундах.
+    :return: Множество ID сессий, аренду которых удерживает владелец, или None при ошибке.
+    """
+    placeholders = ", ".join(["%s"] * len(session_ids))
+    values = ", ".join(["(%s, %s, NOW(3) + INTERVAL %s SECOND)"] * len(session_ids))
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                # Присваивания выполняются слева направо: срок продлевается, если после первого из них владелец - мы
+                await cursor.execute(f"""
+                    INSERT INTO bot_leases (session_id, owner, expires_at) VALUES {values}
+                    ON DUPLICATE KEY UPDATE
+                        owner = IF(owner = VALUES(owner) OR expires_at < NOW(3), VALUES(owner), owner),
+                        expires_at = IF(owner = VALUES(owner), VALUES(expires_at), expires_at)
+                """, tuple(param for session_id in session_ids for param in (session_id, owner, ttl)))
+                await cursor.execute(f"""
+                    SELECT session_id FROM bot_leases WHERE owner = %s AND session_id IN ({placeholders})
+                """, (owner, *session_ids))
+                return {row[0] for row in await cursor.fetchall()}
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при продлении аренды сессий: {e}", "ERROR")
+        return None
+
+
+async def release_bot_leases(session_ids, owner):
+    """
+    Освобождает аренду сессий владельца, чтобы другие узлы могли захватить их без ожидания истечения.
+    :param session_ids: Список ID сессий.
+    :param owner: Идентификатор узла.
+    """
+    placeholders = ", ".join(["%s"] * len(session_ids))
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(f"DELETE FROM bot_leases WHERE owner = %s AND session_id IN ({placeholders})",
+                                     (owner, *session_ids))
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при освобождении аренды сессий: {e}", "ERROR")
+
+
+####################################### Функции для работы с таблицей "bots" #######################################
+
+async def get_webhook_port(session_id):
+    """
+    Возвращает порт вебхука в указанной сессии.
+    :return: Порт вебхука в указанной сессии.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT webhook_port FROM bots WHERE session_id = %s", (session_id,))
+                result = await cursor.fetchone()
+                return result[0]
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при получении порта вебхука: {e}", "ERROR")
+        return None
+
+
+async def update_webhook_port(session_id, webhook_port):
+    """
+    Сохраняет порт, на который установлен вебхук бота сессии.
+    :param session_id: ID сессии.
+    :param webhook_port: Порт вебхука.
+    """
+    try:
+        async with async_db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("UPDATE bots SET webhook_port = %s WHERE session_id = %s",
+                                     (webhook_port, session_id))
+        session_cache.invalidate(session_id)
+    except (Error, asyncio.TimeoutError) as e:
+        logger.log(f"Ошибка при обновлении порта вебхука: {e}", "ERROR")
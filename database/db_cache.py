@@ -0,0 +1,208 @@
+"""
+db_cache.py
+Модуль внутрипроцессного кэша для редко изменяющихся строк базы данных (агенты, сессии, пользователи).
+Кэш ограничен по размеру (вытеснение давно неиспользуемых записей, LRU) и по времени жизни записей (TTL).
+Записи явно сбрасываются функциями изменения данных в db_functions.py; TTL ограничивает устаревание данных,
+изменённых в обход этих функций или другим процессом.
+
+Каждая инвалидация передаётся подписчикам (`add_invalidation_listener`): в режиме супервизора Telegram-ботов
+(sharding.py) супервизор рассылает её процессам-обработчикам, которые применяют её к своим кэшам
+(`apply_invalidation`) по имени кэша.
+"""
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+# Функции сброса записей кэшей по имени кэша: func(key), где key None означает сброс всех записей
+_invalidators = {}
+# Подписчики на инвалидации: listener(имя кэша, key)
+_invalidation_listeners = []
+
+
+def register_cache(name, invalidate):
+    """
+    Регистрирует функцию сброса записей кэша для применения инвалидаций из других процессов.
+    :param name: Имя кэша.
+    :param invalidate: Функция invalidate(key); key None означает сброс всех записей.
+    """
+    _invalidators[name] = invalidate
+
+
+def add_invalidation_listener(listener):
+    """
+    Подписывает функцию listener(имя кэша, key) на инвалидации кэшей процесса.
+    Вызывается из потока, выполнившего инвалидацию.
+    """
+    _invalidation_listeners.append(listener)
+
+
+def notify_invalidation(name, key):
+    """
+    Передаёт инвалидацию кэша подписчикам.
+    """
+    for listener in _invalidation_listeners:
+        listener(name, key)
+
+
+def apply_invalidation(name, key):
+    """
+    Применяет к кэшу процесса инвалидацию, выполненную в другом процессе.
+    """
+    invalidate = _invalidators.get(name)
+    if invalidate is not None:
+        invalidate(key)
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с временем жизни записей и версионированием.
+
+    Перед чтением из базы вызывающий код запоминает версию кэша (`version()`), а после чтения сохраняет результат
+    через `set(key, value, version)`. Если за это время произошла инвалидация, значение не сохраняется: так результат
+    запроса, начатого до изменения данных, не попадёт в кэш после него.
+    """
+
+    def __init__(self, name, max_size, ttl):
+        """
+        :param name: Имя кэша (используется в статистике).
+        :param max_size: Максимальное количество записей.
+        :param ttl: Время жизни записи в секундах.
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # Ключ -> (значение, время истечения)
+        self._lock = threading.Lock()
+        self._version = 0  # Увеличивается при каждой инвалидации
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+        register_cache(name, lambda key: self.clear() if key is None else self.invalidate(key))
+
+    @staticmethod
+    def _key(key):
+        """
+        Приводит числовые ключи к int: ID из параметров запроса приходят строками, а из базы - числами.
+        """
+        if isinstance(key, str) and key.isdigit():
+            return int(key)
+        return key
+
+    @staticmethod
+    def _copy(value):
+        """
+        Возвращает поверхностную копию словаря, чтобы вызывающий код не изменял данные кэша.
+        """
+        return dict(value) if isinstance(value, dict) else value
+
+    def get(self, key):
+        """
+        Возвращает значение из кэша.
+        :param key: Ключ записи.
+        :return: Кортеж (найдено ли значение, значение).
+        """
+        key = self._key(key)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return False, None
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return False, None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return True, self._copy(value)
+
+    def version(self):
+        """
+        Возвращает текущую версию кэша. Запоминается перед чтением данных из базы.
+        """
+        with self._lock:
+            return self._version
+
+    def set(self, key, value, version=None):
+        """
+        Сохраняет значение в кэше.
+        :param key: Ключ записи.
+        :param value: Значение.
+        :param version: Версия кэша, полученная до чтения значения из базы. Если с тех пор была инвалидация,
+        значение не сохраняется.
+        """
+        key = self._key(key)
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._data[key] = (self._copy(value), time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key):
+        """
+        Удаляет запись из кэша.
+        :param key: Ключ записи.
+        """
+        key = self._key(key)
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+            self._stats["invalidations"] += 1
+        notify_invalidation(self.name, key)
+
+    def clear(self):
+        """
+        Удаляет все записи из кэша.
+        """
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+            self._stats["invalidations"] += 1
+        notify_invalidation(self.name, None)
+
+    def stats(self):
+        """
+        Возвращает статистику кэша.
+        :return: Словарь с размером кэша и счётчиками попаданий, промахов и вытеснений.
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                **self._stats,
+            }
+
+
+CACHE_MAX_SIZE = int(os.getenv('DB_CACHE_MAX_SIZE', 10000))
+CACHE_TTL = float(os.getenv('DB_CACHE_TTL', 300))
+
+# Кэши строк базы данных, используемые во всем приложении (ключ - ID записи)
+agent_cache = TTLCache("agents", CACHE_MAX_SIZE, CACHE_TTL)
+session_cache = TTLCache("sessions", CACHE_MAX_SIZE, CACHE_TTL)
+user_cache = TTLCache("users", CACHE_MAX_SIZE, CACHE_TTL)
+# Пользователи не удаляются физически, поэтому кэшируется только факт существования (значение True)
+user_exists_cache = TTLCache("user_exists", CACHE_MAX_SIZE, CACHE_TTL)
+
+
+def cache_stats():
+    """
+    Возвращает статистику всех кэшей базы данных.
+    """
+    return [cache.stats() for cache in (agent_cache, session_cache, user_cache, user_exists_cache)]
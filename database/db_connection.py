@@ -1,13 +1,18 @@
 """
 db_connection.py
-Модуль для установки и управления соединением с базой данных.
-Реализует паттерн Singleton для обеспечения единственного экземпляра соединения в приложении,
-чтобы предотвратить избыточные подключения и улучшить производительность.
+Модуль для установки и управления соединениями с базой данных.
+Реализует потокобезопасный пул соединений: каждый поток Flask и каждый обработчик ботов получает собственное
+соединение на время запроса, вместо общего соединения, на котором запросы выполнялись последовательно.
 """
 
 import mysql.connector
 from mysql.connector import Error as sqlError
+from mysql.connector.errors import PoolError
+from contextlib import contextmanager
+from collections import deque
 from dotenv import load_dotenv
+import threading
+import time
 import os
 
 
@@ -15,85 +20,240 @@ import os
 load_dotenv()
 
 
-class DatabaseConnection:
+class PoolTimeoutError(PoolError):
     """
-    Класс для управления соединением с базой данных.
-    Использует Singleton для поддержания одного соединения в течение всего времени работы приложения.
+    Исключение, возникающее, когда свободное соединение не удалось получить за отведённое время.
+    Наследуется от mysql.connector.Error, поэтому обрабатывается существующими блоками `except Error`.
     """
-    _instance = None  # Единственный экземпляр класса DatabaseConnection
-    _connection = None  # Объект соединения с базой данных
 
-    def __new__(cls):
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений с базой данных.
+
+    - Держит не менее `min_size` и не более `max_size` открытых соединений.
+    - Если все соединения заняты, вызывающий поток ждёт не дольше `timeout` секунд.
+    - Соединение проверяется (ping) при выдаче только если оно простаивало дольше `validate_after` секунд,
+      поэтому горячие соединения выдаются без лишнего обращения к серверу.
+    - Ведёт статистику выдачи, ожиданий и пересоздания соединений.
+    """
+
+    def __init__(self, name, min_size, max_size, timeout, validate_after, autocommit=True):
+        """
+        :param name: Имя пула (используется в логах и статистике).
+        :param min_size: Минимальное количество открытых соединений.
+        :param max_size: Максимальное количество открытых соединений.
+        :param timeout: Максимальное время ожидания свободного соединения в секундах.
+        :param validate_after: Время простоя в секундах, после которого соединение проверяется перед выдачей.
+        :param autocommit: Режим autocommit для новых соединений.
         """
-        Создает и возвращает единственный экземпляр класса.
-        При первом вызове также инициирует соединение с базой данных.
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self.autocommit = autocommit
+        self._idle = deque()  # Свободные соединения: (соединение, время возврата в пул)
+        self._size = 0  # Количество открытых соединений (свободных и выданных)
+        self._condition = threading.Condition()
+        self._closed = False
+        self._stats = {
+            "created": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "validations": 0,
+            "discarded": 0,
+            "max_wait_ms": 0.0,
+        }
+        self._fill()
 
-        :return: Экземпляр класса DatabaseConnection
-        :rtype: DatabaseConnection
+    def _connect(self):
         """
-        if cls._instance is None:
-            cls._instance = super(DatabaseConnection, cls).__new__(cls)
-            cls._instance._initialize_connection()
-        return cls._instance
+        Открывает новое соединение с базой данных, используя параметры из переменных окружения.
+        """
+        connection = mysql.connector.connect(
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASSWORD'),
+            host=os.getenv('DB_HOST'),
+            database=os.getenv('DB_NAME'),
+            autocommit=self.autocommit
+        )
+        with self._condition:
+            self._stats["created"] += 1
+        return connection
 
-    def _initialize_connection(self):
+    def _fill(self):
         """
-        Инициализирует соединение с базой данных, используя параметры подключения из переменных окружения.
-        Выводит сообщение об успешном подключении или ошибке в случае неудачи.
+        Открывает соединения до минимального размера пула.
         """
         try:
-            user = os.getenv('DB_USER')
-            password = os.getenv('DB_PASSWORD')
-            host = os.getenv('DB_HOST')
-            database = os.getenv('DB_NAME')
-
-            self._connection = mysql.connector.connect(
-                user=user,
-                password=password,
-                host=host,
-                database=database
-            )
-            print("Соединение с базой данных успешно установлено.")
+            while self._size < self.min_size:
+                connection = self._connect()
+                with self._condition:
+                    self._size += 1
+                    self._idle.append((connection, time.monotonic()))
+            print(f"Пул соединений '{self.name}' инициализирован ({self._size} соединений).")
         except sqlError as e:
             print(f"Ошибка при подключении к базе данных: {e}")
-            self._connection = None
 
-    def get_connection(self):
+    def _discard(self, connection):
+        """
+        Закрывает соединение и освобождает место в пуле.
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._condition.notify()
+
+    def acquire(self):
+        """
+        Выдаёт соединение из пула. Если свободных нет и пул заполнен, ожидает освобождения соединения.
+
+        :return: Соединение с базой данных.
+        :rtype: mysql.connector.connection.MySQLConnection
+        :raises PoolTimeoutError: Если соединение не освободилось за `timeout` секунд.
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise PoolError(f"Пул соединений '{self.name}' закрыт.")
+                waited = False
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"Не удалось получить соединение из пула '{self.name}' за {self.timeout} с."
+                        )
+                    waited = True
+                    self._condition.wait(remaining)
+                if waited:
+                    self._stats["waits"] += 1
+                    wait_ms = (time.monotonic() - started) * 1000
+                    self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], round(wait_ms, 2))
+                if self._idle:
+                    connection, released_at = self._idle.pop()
+                else:
+                    # Резервируем место под новое соединение до выхода из блокировки
+                    connection, released_at = None, None
+                    self._size += 1
+                self._stats["checkouts"] += 1
+
+            if connection is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+
+            # Проверяем только соединения, которые простаивали дольше validate_after
+            if time.monotonic() - released_at < self.validate_after:
+                return connection
+            with self._condition:
+                self._stats["validations"] += 1
+            try:
+                connection.ping(reconnect=False)
+                return connection
+            except sqlError:
+                print(f"Соединение пула '{self.name}' потеряно, переподключение...")
+                self._discard(connection)
+
+    def release(self, connection):
         """
-        Возвращает текущее соединение с базой данных. Если соединение потеряно, пытается переподключиться.
+        Возвращает соединение в пул. Незавершённая транзакция откатывается, чтобы следующий
+        пользователь соединения не унаследовал её состояние.
 
-        :return: Соединение с базой данных или None в случае ошибки
-        :rtype: mysql.connector.connection.MySQLConnection or None
+        :param connection: Соединение, ранее полученное через `acquire`.
         """
         try:
-            if self._connection is None or not self._connection.is_connected():
-                print("Переподключение к базе данных...")
-                self._initialize_connection()
-            return self._connection
-        except sqlError as e:
-            print(f"Ошибка при проверке соединения: {e}")
-            self._initialize_connection()
-            return self._connection
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlError:
+            self._discard(connection)
+            return
+        with self._condition:
+            if self._closed:
+                self._size -= 1
+                connection.close()
+                return
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
 
-    def close_connection(self):
+    @contextmanager
+    def connection(self):
         """
-        Закрывает текущее соединение с базой данных, если оно активно. Выводит сообщение о закрытии соединения.
+        Контекстный менеджер для получения соединения из пула и его гарантированного возврата.
+        Соединение, на котором произошла ошибка базы данных, закрывается вместо возврата в пул.
+
+        Пример:
+            with db_pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    ...
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except sqlError:
+            if connection.is_connected():
+                self.release(connection)
+            else:
+                self._discard(connection)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def stats(self):
+        """
+        Возвращает статистику пула.
+
+        :return: Словарь с размером пула, количеством свободных и выданных соединений и счётчиками.
         """
-        if self._connection is not None and self._connection.is_connected():
-            self._connection.close()
-            print("Соединение с базой данных закрыто.")
+        with self._condition:
+            return {
+                "name": self.name,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._stats,
+            }
 
-    @classmethod
-    def teardown(cls):
+    def close_all(self):
         """
-        Полностью закрывает соединение и сбрасывает экземпляр Singleton.
-        Используется для завершения соединения в конце работы приложения.
+        Закрывает все свободные соединения пула. Выданные соединения закрываются при возврате.
+        Используется для завершения работы с базой данных в конце работы приложения.
         """
-        if cls._instance:
-            cls._instance.close_connection()
-            cls._instance = None
-            print("Синглтон соединения с базой данных успешно завершены.")
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._size -= 1
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            self._condition.notify_all()
+        print(f"Пул соединений '{self.name}' закрыт.")
 
 
-# Экземпляр DatabaseConnection для использования во всем приложении
-db_instance = DatabaseConnection()
+# Пул соединений для использования во всем приложении
+db_pool = ConnectionPool(
+    name="main",
+    min_size=int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+    max_size=int(os.getenv('DB_POOL_MAX_SIZE', 20)),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    validate_after=float(os.getenv('DB_POOL_VALIDATE_AFTER', 30)),
+)
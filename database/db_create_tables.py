@@ -2,15 +2,16 @@
 db_create_tables.py
 Скрипт для создания таблиц в базе данных, необходимых для работы приложения.
 Подключается к базе данных, проверяет наличие таблиц и создает их, если они отсутствуют.
+Индексы и последующие изменения схемы применяются миграциями из db_migrations.py.
 """
 
 from mysql.connector import Error
-from db_connection import db_instance
+from db_connection import db_pool
 
 
 try:
-    # Подключение к базе данных через экземпляр Singleton
-    connection = db_instance.get_connection()
+    # Получение соединения из пула
+    connection = db_pool.acquire()
 
     if connection.is_connected():
         print("Подключение к базе данных успешно")
@@ -163,4 +164,5 @@ finally:
     # Закрытие соединения и курсора, если соединение активно
     if connection.is_connected():
         cursor.close()
+        db_pool.release(connection)
         print("Подключение к базе данных закрыто.")
@@ -6,8 +6,13 @@ db_functions.py
 """
 
 from mysql.connector import Error
-from database.db_connection import db_instance
+from database.db_connection import db_pool
+from database.db_cache import agent_cache, session_cache, user_cache, user_exists_cache
+from database.db_write_buffer import CHAT_WRITE_BEHIND, chat_write_buffer
+from utils.llm_cache import response_cache
 from utils.logs.logger import logger
+from utils.utils import (HISTORY_PAGE_SIZE, DEFAULT_HISTORY_MAX_TURNS, DEFAULT_HISTORY_TOKEN_BUDGET,
+                         take_turns_within_budget, format_recent_history)
 from application.services.telegram.bot_configurator import update_bot_name, update_bot_description
 
 
@@ -20,12 +25,18 @@ def get_user_by_id(user_id):
     :return: Словарь с данными пользователя (username, пароль, имя и т.д.), если пользователь существует.
     Возвращает None, если пользователь не найден.
     """
+    hit, user = user_cache.get(user_id)
+    if hit:
+        return user
+    version = user_cache.version()
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT id AS user_id, username, password, role_id, full_name, email, phone_number FROM users WHERE id = %s AND is_deleted = FALSE", (user_id,))
-            user = cursor.fetchone()
-            return user
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT id AS user_id, username, password, role_id, full_name, email, phone_number FROM users WHERE id = %s AND is_deleted = FALSE", (user_id,))
+                user = cursor.fetchone()
+                if user:
+                    user_cache.set(user_id, user, version)
+                return user
     except Error as e:
         logger.log(f"Ошибка при получении пользователя: {e}", "ERROR")
 
@@ -38,11 +49,11 @@ def get_user_by_username(username):
     Возвращает None, если пользователь не найден.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT * FROM users WHERE username = %s AND is_deleted = FALSE", (username,))
-            user = cursor.fetchone()
-            return user
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT * FROM users WHERE username = %s AND is_deleted = FALSE", (username,))
+                user = cursor.fetchone()
+                return user
     except Error as e:
         logger.log(f"Ошибка при получении пользователя: {e}", "ERROR")
 
@@ -53,11 +64,11 @@ def get_all_users():
     :return: Список словарей с данными пользователей (id и username) для каждого активного пользователя.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT id, username, full_name FROM users WHERE is_deleted = 0")
-            users = cursor.fetchall()
-            return users
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT id, username, full_name FROM users WHERE is_deleted = 0")
+                users = cursor.fetchall()
+                return users
     except Error as e:
         logger.log(f"Ошибка при получении списка пользователей: {e}", "ERROR")
 
@@ -73,13 +84,14 @@ def insert_user(id, username, password, role_id, full_name=''):
     :raises ValueError: Если имя пользователя уже занято, вызывает исключение с сообщением об ошибке.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(
-            "INSERT INTO users (id, username, password, role_id, full_name) VALUES (%s, %s, %s, %s, %s)",
-            (id, username, password, role_id, full_name)
-        )
-        connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                "INSERT INTO users (id, username, password, role_id, full_name) VALUES (%s, %s, %s, %s, %s)",
+                (id, username, password, role_id, full_name)
+            )
+            connection.commit()
+        user_exists_cache.set(id, True)
     except Error as e:
         if "Duplicate entry" in str(e):
             raise ValueError("Пользователь с таким именем уже существует.")
@@ -94,13 +106,14 @@ def update_user_password(user_id, new_password):
     :param new_password: Новый пароль пользователя.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "UPDATE users SET password = %s WHERE id = %s AND is_deleted = FALSE",
-                (new_password, user_id)
-            )
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE users SET password = %s WHERE id = %s AND is_deleted = FALSE",
+                    (new_password, user_id)
+                )
+                connection.commit()
+        user_cache.invalidate(user_id)
     except Error as e:
         logger.log(f"Ошибка при обновлении пароля: {e}", "ERROR")
 
@@ -112,22 +125,23 @@ def update_user_profile(user_id, settings):
     :param settings: Словарь с ключами и значениями для обновления (например, {'full_name': 'Иванов Иван Иванович'}).
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            # Формирование динамического SQL-запроса для обновления
-            update_fields = []
-            values = []
-            for field, value in settings.items():
-                if field in ('full_name', 'email', 'phone_number', 'password') and value is not None:
-                    update_fields.append(f"{field} = %s")
-                    values.append(value)
-            if update_fields:
-                update_query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = %s AND is_deleted = FALSE"
-                values.append(user_id)
-                cursor.execute(update_query, values)
-                connection.commit()
-            else:
-                logger.log("Нет допустимых полей для обновления.", "ERROR")
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                # Формирование динамического SQL-запроса для обновления
+                update_fields = []
+                values = []
+                for field, value in settings.items():
+                    if field in ('full_name', 'email', 'phone_number', 'password') and value is not None:
+                        update_fields.append(f"{field} = %s")
+                        values.append(value)
+                if update_fields:
+                    update_query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = %s AND is_deleted = FALSE"
+                    values.append(user_id)
+                    cursor.execute(update_query, values)
+                    connection.commit()
+                else:
+                    logger.log("Нет допустимых полей для обновления.", "ERROR")
+        user_cache.invalidate(user_id)
     except Error as e:
         logger.log(f"Ошибка при обновлении профиля пользователя: {e}", "ERROR")
 
@@ -138,11 +152,11 @@ def get_last_user_id():
     :return: Последний id в диапазоне до 10000 или None, если таких пользователей нет.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT MAX(id) + 1 FROM users WHERE id <= 10000")
-            result = cursor.fetchone()
-            return result[0]
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT MAX(id) + 1 FROM users WHERE id <= 10000")
+                result = cursor.fetchone()
+                return result[0]
     except Error as e:
         logger.log(f"Ошибка при получении последнего id пользователя: {e}", "ERROR")
         return None
@@ -154,12 +168,17 @@ def check_user_exists(user_id):
     :param user_id: ID пользователя, которого нужно проверить.
     :return: True, если пользователь существует, иначе False.
     """
+    hit, _ = user_exists_cache.get(user_id)
+    if hit:
+        return True
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE id = %s", (user_id,))
-            result = cursor.fetchone()
-            return result[0] > 0
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM users WHERE id = %s", (user_id,))
+                result = cursor.fetchone()
+                if result[0] > 0:
+                    user_exists_cache.set(user_id, True)
+                return result[0] > 0
     except Error as e:
         logger.log(f"Ошибка при проверке пользователя: {e}", "ERROR")
         return False
@@ -172,11 +191,11 @@ def check_user_exists_by_full_name(full_name):
     :return: True, если пользователь существует, иначе False.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE full_name = %s", (full_name,))
-            result = cursor.fetchone()
-            return result[0] > 0
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM users WHERE full_name = %s", (full_name,))
+                result = cursor.fetchone()
+                return result[0] > 0
     except Error as e:
         logger.log(f"Ошибка при проверке пользователя: {e}", "ERROR")
         return False
@@ -187,17 +206,17 @@ def get_users_by_session_id(session_id):
     Получает список пользователей с историей чатов для указанной сессии.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            query = """
-                SELECT DISTINCT u.id, u.full_name, u.username
-                FROM chats c
-                INNER JOIN users u ON c.user_id = u.id
-                WHERE c.session_id = %s AND c.is_deleted = FALSE
-            """
-            cursor.execute(query, (session_id,))
-            users = cursor.fetchall()
-            return users
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                query = """
+                    SELECT DISTINCT u.id, u.full_name, u.username
+                    FROM chats c
+                    INNER JOIN users u ON c.user_id = u.id
+                    WHERE c.session_id = %s AND c.is_deleted = FALSE
+                """
+                cursor.execute(query, (session_id,))
+                users = cursor.fetchall()
+                return users
     except Error as e:
         logger.log(f"Ошибка при получении пользователей для сессии: {e}", "ERROR")
         return []
@@ -212,17 +231,25 @@ def get_agent_by_id(agent_id):
     :return: Словарь с данными агента (имя, инструкция и т.д.), если агент существует. Возвращает None,
     если агент не найден.
     """
+    hit, agent = agent_cache.get(agent_id)
+    if hit:
+        return agent
+    version = agent_cache.version()
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT * FROM gpt_agents WHERE id = %s AND is_deleted = FALSE", (agent_id,))
-            agent = cursor.fetchone()
-            return agent
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT * FROM gpt_agents WHERE id = %s AND is_deleted = FALSE", (agent_id,))
+                agent = cursor.fetchone()
+                if agent:
+                    agent_cache.set(agent_id, agent, version)
+                return agent
     except Error as e:
         logger.log(f"Ошибка при получении агента: {e}", "ERROR")
 
 
-def insert_agent(user_id, name, instruction, start_message, error_message, temperature=0.5, max_tokens=150, api_key=None):
+def insert_agent(user_id, name, instruction, start_message, error_message, temperature=0.5, max_tokens=150, api_key=None,
+                 history_max_turns=DEFAULT_HISTORY_MAX_TURNS, history_token_budget=DEFAULT_HISTORY_TOKEN_BUDGET,
+                 response_cache_enabled=False):
     """
     Добавляет нового агента GPT в базу данных.
     :param user_id: ID пользователя, которому принадлежит агент.
@@ -233,16 +260,21 @@ def insert_agent(user_id, name, instruction, start_message, error_message, tempe
     :param temperature: Температура для генерации текста.
     :param max_tokens: Максимальное количество токенов для ответа.
     :param api_key: API ключ для агента.
+    :param history_max_turns: Максимальное количество пар сообщений истории, отправляемых в модель.
+    :param history_token_budget: Бюджет токенов истории, отправляемой в модель.
+    :param response_cache_enabled: Кэшировать ответы модели на одинаковые запросы.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(
-                """INSERT INTO gpt_agents (user_id, name, instruction, start_message, error_message, temperature, max_tokens, api_key) 
-                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                (user_id, name, instruction, start_message, error_message, temperature, max_tokens, api_key)
-            )
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO gpt_agents (user_id, name, instruction, start_message, error_message, temperature, max_tokens, api_key,
+                                               history_max_turns, history_token_budget, response_cache_enabled)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (user_id, name, instruction, start_message, error_message, temperature, max_tokens, api_key,
+                     history_max_turns, history_token_budget, response_cache_enabled)
+                )
+                connection.commit()
     except Error as e:
         logger.log(f"Ошибка при добавлении агента: {e}", "ERROR")
 
@@ -254,11 +286,11 @@ def get_all_agents_by_user_id(user_id):
     :return: Список агентов, принадлежащих пользователю, в формате словаря.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT * FROM gpt_agents WHERE user_id = %s AND is_deleted = FALSE", (user_id,))
-            agents = cursor.fetchall()
-            return agents
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT * FROM gpt_agents WHERE user_id = %s AND is_deleted = FALSE", (user_id,))
+                agents = cursor.fetchall()
+                return agents
     except Error as e:
         logger.log(f"Ошибка при получении агентов пользователя: {e}", "ERROR")
 
@@ -270,17 +302,17 @@ def get_all_agents_except_user(user_id):
     :return: Список агентов, не принадлежащих указанному пользователю.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT a.id, a.name, a.is_active, 
-                       CASE WHEN u.full_name IS NOT NULL THEN u.full_name ELSE u.username END AS user_name
-                FROM gpt_agents a
-                INNER JOIN users u ON a.user_id = u.id
-                WHERE a.user_id != %s AND a.is_deleted = FALSE
-            """, (user_id,))
-            agents = cursor.fetchall()
-            return agents
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT a.id, a.name, a.is_active, 
+                           CASE WHEN u.full_name IS NOT NULL THEN u.full_name ELSE u.username END AS user_name
+                    FROM gpt_agents a
+                    INNER JOIN users u ON a.user_id = u.id
+                    WHERE a.user_id != %s AND a.is_deleted = FALSE
+                """, (user_id,))
+                agents = cursor.fetchall()
+                return agents
     except Error as e:
         logger.log(f"Ошибка при получении агентов: {e}", "ERROR")
         return []
@@ -293,23 +325,28 @@ def update_agent_settings(agent_id, settings):
     :param settings: Словарь с полями и их новыми значениями для обновления.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            # Формируем динамический запрос SQL для обновления только указанных полей
-            update_fields = []
-            values = []
-            for field, value in settings.items():
-                if field not in ('created_at', 'is_active'):  # Исключаем неизменяемые поля
-                    update_fields.append(f"{field} = %s")
-                    values.append(value)
-            # Выполняем обновление, если есть поля для обновления
-            if update_fields:
-                update_query = f"UPDATE gpt_agents SET {', '.join(update_fields)} WHERE id = %s AND is_deleted = FALSE"
-                values.append(agent_id)
-                cursor.execute(update_query, values)
-                connection.commit()
-            else:
-                logger.log("Нет допустимых полей для обновления.", "ERROR")
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                # Формируем динамический запрос SQL для обновления только указанных полей
+                update_fields = []
+                values = []
+                for field, value in settings.items():
+                    if field not in ('created_at', 'is_active'):  # Исключаем неизменяемые поля
+                        update_fields.append(f"{field} = %s")
+                        values.append(value)
+                # Выполняем обновление, если есть поля для обновления
+                if update_fields:
+                    update_query = f"UPDATE gpt_agents SET {', '.join(update_fields)} WHERE id = %s AND is_deleted = FALSE"
+                    values.append(agent_id)
+                    cursor.execute(update_query, values)
+                    connection.commit()
+                else:
+                    logger.log("Нет допустимых полей для обновления.", "ERROR")
+        agent_cache.invalidate(agent_id)
+        # Данные сессий содержат имя агента
+        session_cache.clear()
+        # Сохраненные ответы модели получены со старыми настройками агента
+        response_cache.invalidate_agent(agent_id)
     except Error as e:
         logger.log(f"Ошибка при обновлении настроек агента: {e}", "ERROR")
 
@@ -321,13 +358,14 @@ def set_agent_active_status(agent_id, is_active):
     :param is_active: Новое значение статуса активности (True или False).
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "UPDATE gpt_agents SET is_active = %s WHERE id = %s AND is_deleted = FALSE",
-                (is_active, agent_id)
-            )
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE gpt_agents SET is_active = %s WHERE id = %s AND is_deleted = FALSE",
+                    (is_active, agent_id)
+                )
+                connection.commit()
+        agent_cache.invalidate(agent_id)
     except Error as e:
         logger.log(f"Ошибка при изменении статуса агента: {e}", "ERROR")
 
@@ -342,25 +380,26 @@ def get_chat_history_by_user_and_agent(user_id, agent_id, chat_type_id):
     :param chat_type_id: ID типа чата (например, 1 - тестовый чат).
     :return: Список словарей с сообщениями чата, где каждое сообщение включает роль (user или assistant) и текст сообщения (content). Если история пуста, возвращается пустой список.
     """
+    chat_write_buffer.flush_for(user_id=user_id, agent_id=agent_id, chat_type_id=chat_type_id)
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            query = """
-            SELECT user_message, bot_response 
-            FROM chats
-            WHERE user_id = %s AND agent_id = %s AND chat_type_id = %s AND is_deleted = FALSE
-            ORDER BY created_at
-            """
-            cursor.execute(query, (user_id, agent_id, chat_type_id))
-            history = cursor.fetchall()
-            # Формируем список словарей для передачи истории чата в шаблон
-            conversation_history = []
-            for record in history:
-                if record['user_message']:
-                    conversation_history.append({"role": "user", "content": record['user_message']})
-                if record['bot_response']:
-                    conversation_history.append({"role": "assistant", "content": record['bot_response']})
-            return conversation_history
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                query = """
+                SELECT user_message, bot_response 
+                FROM chats
+                WHERE user_id = %s AND agent_id = %s AND chat_type_id = %s AND is_deleted = FALSE
+                ORDER BY created_at
+                """
+                cursor.execute(query, (user_id, agent_id, chat_type_id))
+                history = cursor.fetchall()
+                # Формируем список словарей для передачи истории чата в шаблон
+                conversation_history = []
+                for record in history:
+                    if record['user_message']:
+                        conversation_history.append({"role": "user", "content": record['user_message']})
+                    if record['bot_response']:
+                        conversation_history.append({"role": "assistant", "content": record['bot_response']})
+                return conversation_history
     except Error as e:
         logger.log(f"Ошибка при чтении истории чата: {e}", "ERROR")
 
@@ -369,38 +408,124 @@ def get_chat_history_by_session_id_and_user_id(session_id, user_id):
     """
     Извлекает историю чата для заданной сессии и пользователя с дополнительными данными.
     """
+    chat_write_buffer.flush_for(session_id=session_id, user_id=user_id)
     try:
-        connection = db_instance.get_connection()
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                query = """
+                SELECT 
+                    c.id AS chat_id, 
+                    c.user_message, 
+                    c.bot_response, 
+                    c.created_at,
+                    u.full_name AS user_name, 
+                    b.bot_name
+                FROM chats c
+                INNER JOIN users u ON c.user_id = u.id
+                INNER JOIN sessions s ON c.session_id = s.id
+                INNER JOIN bots b ON c.session_id = b.session_id
+                WHERE c.session_id = %s 
+                  AND c.user_id = %s 
+                  AND c.is_deleted = FALSE
+                ORDER BY c.created_at ASC
+                """
+                cursor.execute(query, (session_id, user_id))
+                history = cursor.fetchall()
+                # Формируем список сообщений
+                conversation_history = []
+                for record in history:
+                    if record['user_message']:
+                        conversation_history.append({"role": "user", "content": record['user_message'],
+                                                     "user_name": record['user_name'], "bot_name": record['bot_name'], "created_at": record['created_at']})
+                    if record['bot_response']:
+                        conversation_history.append({"role": "assistant", "content": record['bot_response'],
+                                                     "user_name": record['user_name'], "bot_name": record['bot_name'], "created_at": record['created_at']})
+                return conversation_history
+    except Error as e:
+        logger.log(f"Ошибка при чтении истории чата: {e}", "ERROR")
+        return []
+
+
+# Условие keyset-пагинации: записи старше последней прочитанной (created_at, id)
+HISTORY_KEYSET_CONDITION = "AND (created_at < %s OR (created_at = %s AND id < %s))"
+
+
+def _read_recent_history(query, params, max_turns, token_budget):
+    """
+    Читает последние пары сообщений от новых к старым страницами по HISTORY_PAGE_SIZE с keyset-пагинацией,
+    пока не будет достигнут лимит пар или бюджет токенов.
+    :param query: SQL-запрос с плейсхолдером {keyset}, сортировкой по created_at DESC, id DESC и LIMIT %s.
+    :param params: Параметры фильтра запроса.
+    :param max_turns: Максимальное количество пар сообщений.
+    :param token_budget: Бюджет токенов истории.
+    :return: Список сообщений для модели в хронологическом порядке.
+    """
+    turns = []
+    used_tokens = 0
+    last_record = None
+    with db_pool.connection() as connection:
         with connection.cursor(dictionary=True) as cursor:
-            query = """
-            SELECT 
-                c.id AS chat_id, 
-                c.user_message, 
-                c.bot_response, 
-                c.created_at,
-                u.full_name AS user_name, 
-                b.bot_name
-            FROM chats c
-            INNER JOIN users u ON c.user_id = u.id
-            INNER JOIN sessions s ON c.session_id = s.id
-            INNER JOIN bots b ON c.session_id = b.session_id
-            WHERE c.session_id = %s 
-              AND c.user_id = %s 
-              AND c.is_deleted = FALSE
-            ORDER BY c.created_at ASC
-            """
-            cursor.execute(query, (session_id, user_id))
-            history = cursor.fetchall()
-            # Формируем список сообщений
-            conversation_history = []
-            for record in history:
-                if record['user_message']:
-                    conversation_history.append({"role": "user", "content": record['user_message'],
-                                                 "user_name": record['user_name'], "bot_name": record['bot_name'], "created_at": record['created_at']})
-                if record['bot_response']:
-                    conversation_history.append({"role": "assistant", "content": record['bot_response'],
-                                                 "user_name": record['user_name'], "bot_name": record['bot_name'], "created_at": record['created_at']})
-            return conversation_history
+            while len(turns) < max_turns:
+                page_size = min(HISTORY_PAGE_SIZE, max_turns - len(turns))
+                if last_record is None:
+                    cursor.execute(query.format(keyset=""), (*params, page_size))
+                else:
+                    keyset = (last_record['created_at'], last_record['created_at'], last_record['id'])
+                    cursor.execute(query.format(keyset=HISTORY_KEYSET_CONDITION), (*params, *keyset, page_size))
+                page = cursor.fetchall()
+                used_tokens, exhausted = take_turns_within_budget(page, turns, used_tokens, token_budget)
+                if exhausted or len(page) < page_size:
+                    break
+                last_record = page[-1]
+    return format_recent_history(turns)
+
+
+def get_recent_chat_history_by_user_and_agent(user_id, agent_id, chat_type_id, max_turns, token_budget):
+    """
+    Извлекает последние сообщения чата пользователя с агентом, помещающиеся в окно истории агента.
+    Используется для формирования запроса к модели вместо полной истории.
+    :param user_id: ID пользователя.
+    :param agent_id: ID агента.
+    :param chat_type_id: ID типа чата.
+    :param max_turns: Максимальное количество пар "сообщение - ответ".
+    :param token_budget: Бюджет токенов истории.
+    :return: Список словарей с ролью (user или assistant) и текстом сообщения (content) в хронологическом порядке.
+    """
+    query = """
+    SELECT id, user_message, bot_response, created_at
+    FROM chats
+    WHERE user_id = %s AND agent_id = %s AND chat_type_id = %s AND is_deleted = FALSE {keyset}
+    ORDER BY created_at DESC, id DESC
+    LIMIT %s
+    """
+    chat_write_buffer.flush_for(user_id=user_id, agent_id=agent_id, chat_type_id=chat_type_id)
+    try:
+        return _read_recent_history(query, (user_id, agent_id, chat_type_id), max_turns, token_budget)
+    except Error as e:
+        logger.log(f"Ошибка при чтении истории чата: {e}", "ERROR")
+        return []
+
+
+def get_recent_chat_history_by_session_id_and_user_id(session_id, user_id, max_turns, token_budget):
+    """
+    Извлекает последние сообщения пользователя в сессии, помещающиеся в окно истории агента.
+    Используется для формирования запроса к модели вместо полной истории.
+    :param session_id: ID сессии.
+    :param user_id: ID пользователя.
+    :param max_turns: Максимальное количество пар "сообщение - ответ".
+    :param token_budget: Бюджет токенов истории.
+    :return: Список словарей с ролью (user или assistant) и текстом сообщения (content) в хронологическом порядке.
+    """
+    query = """
+    SELECT id, user_message, bot_response, created_at
+    FROM chats
+    WHERE session_id = %s AND user_id = %s AND is_deleted = FALSE {keyset}
+    ORDER BY created_at DESC, id DESC
+    LIMIT %s
+    """
+    chat_write_buffer.flush_for(session_id=session_id, user_id=user_id)
+    try:
+        return _read_recent_history(query, (session_id, user_id), max_turns, token_budget)
     except Error as e:
         logger.log(f"Ошибка при чтении истории чата: {e}", "ERROR")
         return []
@@ -409,6 +534,7 @@ def get_chat_history_by_session_id_and_user_id(session_id, user_id):
 def insert_chat_message(user_id, agent_id, chat_type_id, user_message, bot_response):
     """
     Вставляет новое сообщение чата в базу данных.
+    Если включена отложенная запись (CHAT_WRITE_BEHIND), сообщение добавляется в буфер пакетной записи.
 
     :param user_id: ID пользователя, отправившего сообщение.
     :param agent_id: ID агента, участвующего в чате.
@@ -416,15 +542,18 @@ def insert_chat_message(user_id, agent_id, chat_type_id, user_message, bot_respo
     :param user_message: Текст сообщения пользователя.
     :param bot_response: Текст ответа бота.
     """
+    if CHAT_WRITE_BEHIND:
+        chat_write_buffer.add(user_id, agent_id, chat_type_id, None, user_message, bot_response)
+        return
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            query = """
-            INSERT INTO chats (user_id, agent_id, chat_type_id, user_message, bot_response)
-            VALUES (%s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, (user_id, agent_id, chat_type_id, user_message, bot_response))
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                query = """
+                INSERT INTO chats (user_id, agent_id, chat_type_id, user_message, bot_response)
+                VALUES (%s, %s, %s, %s, %s)
+                """
+                cursor.execute(query, (user_id, agent_id, chat_type_id, user_message, bot_response))
+                connection.commit()
     except Error as e:
         logger.log(f"Ошибка при записи истории чата: {e}", "ERROR")
 
@@ -433,6 +562,7 @@ def insert_chat_message(user_id, agent_id, chat_type_id, user_message, bot_respo
 def insert_chat_message_for_session(user_id, agent_id, chat_type_id, session_id, user_message, bot_response):
     """
     Вставляет новое сообщение чата для Telegram с учетом session_id.
+    Если включена отложенная запись (CHAT_WRITE_BEHIND), сообщение добавляется в буфер пакетной записи.
     :param session_id: ID сессии, для которой вставляется сообщение.
     :param user_id: ID пользователя, отправившего сообщение.
     :param agent_id: ID агента, участвующего в чате.
@@ -440,15 +570,18 @@ def insert_chat_message_for_session(user_id, agent_id, chat_type_id, session_id,
     :param user_message: Текст сообщения пользователя.
     :param bot_response: Текст ответа бота.
     """
+    if CHAT_WRITE_BEHIND:
+        chat_write_buffer.add(user_id, agent_id, chat_type_id, session_id, user_message, bot_response)
+        return
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            query = """
-            INSERT INTO chats (user_id, agent_id, chat_type_id, session_id, user_message, bot_response)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, (user_id, agent_id, chat_type_id, session_id, user_message, bot_response))
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                query = """
+                INSERT INTO chats (user_id, agent_id, chat_type_id, session_id, user_message, bot_response)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """
+                cursor.execute(query, (user_id, agent_id, chat_type_id, session_id, user_message, bot_response))
+                connection.commit()
     except Error as e:
         logger.log(f"Ошибка при записи истории чата: {e}", "ERROR")
 
@@ -460,16 +593,18 @@ def delete_chat_history(user_id, agent_id, chat_type_id):
     :param agent_id: ID агента, связанного с этим чатом.
     :param chat_type_id: ID типа чата.
     """
+    # Незаписанные сообщения этого чата должны попасть в базу до удаления, иначе они появятся после очистки
+    chat_write_buffer.flush_for(user_id=user_id, agent_id=agent_id, chat_type_id=chat_type_id)
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                UPDATE chats 
-                SET is_deleted = TRUE 
-                WHERE user_id = %s AND agent_id = %s AND chat_type_id = %s
-            """, (user_id, agent_id, chat_type_id))
-            connection.commit()
-        logger.log("История чата успешно удалена.", "ERROR")
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE chats 
+                    SET is_deleted = TRUE 
+                    WHERE user_id = %s AND agent_id = %s AND chat_type_id = %s
+                """, (user_id, agent_id, chat_type_id))
+                connection.commit()
+            logger.log("История чата успешно удалена.", "ERROR")
     except Error as e:
         logger.log(f"Ошибка при удалении истории чата: {e}", "ERROR")
 
@@ -483,16 +618,16 @@ def get_available_platforms(agent_id):
     :return: Список доступных платформ в виде словарей с ключами 'id' и 'name'.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT ct.id, ct.name 
-                FROM chat_types ct
-                LEFT JOIN sessions s ON ct.id = s.chat_type_id AND s.agent_id = %s AND s.is_deleted = FALSE
-                WHERE ct.id > 1 AND s.id IS NULL AND ct.is_deleted = FALSE
-            """, (agent_id,))
-            platforms = cursor.fetchall()
-            return platforms
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT ct.id, ct.name 
+                    FROM chat_types ct
+                    LEFT JOIN sessions s ON ct.id = s.chat_type_id AND s.agent_id = %s AND s.is_deleted = FALSE
+                    WHERE ct.id > 1 AND s.id IS NULL AND ct.is_deleted = FALSE
+                """, (agent_id,))
+                platforms = cursor.fetchall()
+                return platforms
     except Error as e:
         logger.log(f"Ошибка при получении доступных платформ: {e}", "ERROR")
         return []
@@ -507,14 +642,14 @@ def add_session(user_id, agent_id, chat_type_id):
     :return: ID созданной сессии.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO sessions (user_id, agent_id, chat_type_id, is_active, created_at, updated_at)
-                VALUES (%s, %s, %s, FALSE, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """, (user_id, agent_id, chat_type_id))
-            connection.commit()
-            return cursor.lastrowid if cursor.lastrowid else None # Возвращаем ID созданной сессии если он есть иначе None
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO sessions (user_id, agent_id, chat_type_id, is_active, created_at, updated_at)
+                    VALUES (%s, %s, %s, FALSE, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                """, (user_id, agent_id, chat_type_id))
+                connection.commit()
+                return cursor.lastrowid if cursor.lastrowid else None # Возвращаем ID созданной сессии если он есть иначе None
     except Error as e:
         logger.log(f"Ошибка при создании сессии: {e}", "ERROR")
         return None
@@ -526,20 +661,20 @@ def get_all_sessions():
     :return: Список всех активных сессий.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            query = """
-                SELECT 
-                    s.id, b.bot_name, s.created_at, s.updated_at, s.is_active, ct.name AS platform 
-                FROM sessions s
-                INNER JOIN chat_types ct ON s.chat_type_id = ct.id
-                INNER JOIN bots b ON s.id = b.session_id
-                WHERE s.is_deleted = FALSE
-                ORDER BY s.created_at ASC
-            """
-            cursor.execute(query)
-            sessions = cursor.fetchall()
-            return sessions
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                query = """
+                    SELECT 
+                        s.id, b.bot_name, s.created_at, s.updated_at, s.is_active, ct.name AS platform 
+                    FROM sessions s
+                    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.is_deleted = FALSE
+                    ORDER BY s.created_at ASC
+                """
+                cursor.execute(query)
+                sessions = cursor.fetchall()
+                return sessions
     except Error as e:
         logger.log(f"Ошибка при получении списка всех сессий: {e}", "ERROR")
         return []
@@ -552,19 +687,19 @@ def get_user_sessions(user_id):
     :return: Список сессий пользователя.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT s.id, s.agent_id, s.chat_type_id, s.is_active, s.created_at, s.updated_at,
-                 b.bot_name, b.bot_username, a.name AS agent_name, ct.name AS platform
-                FROM sessions s
-                INNER JOIN gpt_agents a ON s.agent_id = a.id
-                INNER JOIN chat_types ct ON s.chat_type_id = ct.id
-                INNER JOIN bots b ON s.id = b.session_id
-                WHERE s.user_id = %s AND s.is_deleted = FALSE
-            """, (user_id,))
-            sessions = cursor.fetchall()
-            return sessions
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT s.id, s.agent_id, s.chat_type_id, s.is_active, s.created_at, s.updated_at,
+                     b.bot_name, b.bot_username, a.name AS agent_name, ct.name AS platform
+                    FROM sessions s
+                    INNER JOIN gpt_agents a ON s.agent_id = a.id
+                    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.user_id = %s AND s.is_deleted = FALSE
+                """, (user_id,))
+                sessions = cursor.fetchall()
+                return sessions
     except Error as e:
         logger.log(f"Ошибка при получении сессий пользователя: {e}", "ERROR")
         return []
@@ -577,21 +712,21 @@ def get_all_sessions_except_admin(excluded_user_id):
     :return: Список всех сессий, кроме сессий указанного пользователя.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT s.id, s.agent_id, s.chat_type_id, s.is_active, s.created_at, s.updated_at, b.bot_name, b.bot_username,
-                       a.name AS agent_name, ct.name AS platform, s.user_id,
-                       CASE WHEN u.full_name IS NOT NULL THEN u.full_name ELSE u.username END AS user_name
-                FROM sessions s
-                INNER JOIN gpt_agents a ON s.agent_id = a.id
-                INNER JOIN chat_types ct ON s.chat_type_id = ct.id
-                INNER JOIN users u ON s.user_id = u.id
-                INNER JOIN bots b ON s.id = b.session_id
-                WHERE s.user_id != %s AND s.is_deleted = FALSE
-            """, (excluded_user_id,))
-            sessions = cursor.fetchall()
-            return sessions
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT s.id, s.agent_id, s.chat_type_id, s.is_active, s.created_at, s.updated_at, b.bot_name, b.bot_username,
+                           a.name AS agent_name, ct.name AS platform, s.user_id,
+                           CASE WHEN u.full_name IS NOT NULL THEN u.full_name ELSE u.username END AS user_name
+                    FROM sessions s
+                    INNER JOIN gpt_agents a ON s.agent_id = a.id
+                    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+                    INNER JOIN users u ON s.user_id = u.id
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.user_id != %s AND s.is_deleted = FALSE
+                """, (excluded_user_id,))
+                sessions = cursor.fetchall()
+                return sessions
     except Error as e:
         logger.log(f"Ошибка при получении всех сессий: {e}", "ERROR")
         return []
@@ -599,20 +734,16 @@ def get_all_sessions_except_admin(excluded_user_id):
 
 def get_all_active_telegram_sessions():
     """
-    Извлекает список всех активных сессий из базы данных.
-    :return: Список активных сессий.
+    Извлекает одним запросом все активные Telegram-сессии вместе с токеном и портом бота и настройками агента.
+    Загруженные сессии и агенты сохраняются в кэш.
+    :return: Список активных сессий; настройки агента каждой сессии находятся в ключе 'agent'.
     """
+    versions = message_context_cache_versions()
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT s.id, s.agent_id, s.chat_type_id, b.api_token, s.is_active, s.created_at, s.updated_at
-                FROM sessions s
-                INNER JOIN bots b ON s.id = b.session_id
-                WHERE s.is_active = TRUE AND s.is_deleted = FALSE AND s.chat_type_id = 2
-            """)
-            sessions = cursor.fetchall()
-            return sessions
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute(ACTIVE_SESSIONS_QUERY, (2,))
+                return build_active_sessions(cursor.fetchall(), versions)
     except Error as e:
         logger.log(f"Ошибка при получении активных сессий: {e}", "ERROR")
         return []
@@ -624,16 +755,16 @@ def get_all_active_whatsapp_sessions():
     :return: Список активных сессий.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT s.id, s.agent_id, s.chat_type_id, b.bot_username, s.is_active, s.created_at, s.updated_at
-                FROM sessions s
-                INNER JOIN bots b ON s.id = b.session_id
-                WHERE s.is_active = TRUE AND s.is_deleted = FALSE AND s.chat_type_id = 4
-            """)
-            sessions = cursor.fetchall()
-            return sessions
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT s.id, s.agent_id, s.chat_type_id, b.bot_username, s.is_active, s.created_at, s.updated_at
+                    FROM sessions s
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.is_active = TRUE AND s.is_deleted = FALSE AND s.chat_type_id = 4
+                """)
+                sessions = cursor.fetchall()
+                return sessions
     except Error as e:
         logger.log(f"Ошибка при получении активных сессий: {e}", "ERROR")
         return []
@@ -645,26 +776,180 @@ def get_session_by_id(session_id):
     :param session_id: ID сессии.
     :return: Словарь с данными сессии или None, если сессия не найдена.
     """
+    hit, session = session_cache.get(session_id)
+    if hit:
+        return session
+    version = session_cache.version()
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT s.id, s.agent_id, s.chat_type_id, s.user_id, s.is_active, b.api_token, b.webhook_port,
-                       s.created_at, s.updated_at, b.bot_name, b.bot_username, b.bot_description, a.name AS agent_name,
-                       ct.id as chat_type_id, ct.name AS platform
-                FROM sessions s
-                INNER JOIN gpt_agents a ON s.agent_id = a.id
-                INNER JOIN chat_types ct ON s.chat_type_id = ct.id
-                INNER JOIN bots b ON s.id = b.session_id
-                WHERE s.id = %s AND s.is_deleted = FALSE
-            """, (session_id,))
-            session = cursor.fetchone()
-            return session
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT s.id, s.agent_id, s.chat_type_id, s.user_id, s.is_active, b.api_token, b.webhook_port,
+                           s.created_at, s.updated_at, b.bot_name, b.bot_username, b.bot_description, a.name AS agent_name,
+                           ct.id as chat_type_id, ct.name AS platform
+                    FROM sessions s
+                    INNER JOIN gpt_agents a ON s.agent_id = a.id
+                    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+                    INNER JOIN bots b ON s.id = b.session_id
+                    WHERE s.id = %s AND s.is_deleted = FALSE
+                """, (session_id,))
+                session = cursor.fetchone()
+                if session:
+                    session_cache.set(session_id, session, version)
+                return session
     except Error as e:
         logger.log(f"Ошибка при получении данных сессии: {e}", "ERROR")
         return None
 
 
+# Колонки агента, возвращаемые загрузчиком контекста сообщения (с префиксом agent__ в результате запроса,
+# чтобы не пересекаться с колонками сессии agent_id и agent_name). Агент из контекста сохраняется в agent_cache
+# вместо результата get_agent_by_id, поэтому список должен содержать все колонки gpt_agents.
+MESSAGE_CONTEXT_AGENT_COLUMNS = (
+    'id', 'user_id', 'name', 'instruction', 'start_message', 'error_message', 'temperature', 'max_tokens', 'api_key',
+    'created_at', 'updated_at', 'is_active', 'is_deleted', 'history_max_turns', 'history_token_budget',
+    'response_cache_enabled',
+)
+
+MESSAGE_CONTEXT_QUERY = """
+    SELECT s.id, s.agent_id, s.chat_type_id, s.user_id, s.is_active, b.api_token, b.webhook_port,
+           s.created_at, s.updated_at, b.bot_name, b.bot_username, b.bot_description, a.name AS agent_name,
+           ct.name AS platform, {agent_columns},
+           EXISTS(SELECT 1 FROM users u WHERE u.id = %s) AS user_exists
+    FROM sessions s
+    INNER JOIN gpt_agents a ON s.agent_id = a.id AND a.is_deleted = FALSE
+    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+    INNER JOIN bots b ON s.id = b.session_id
+    WHERE s.id = %s AND s.is_deleted = FALSE
+""".format(agent_columns=", ".join(f"a.{column} AS agent__{column}" for column in MESSAGE_CONTEXT_AGENT_COLUMNS))
+
+
+# Активные сессии платформы с данными бота и агента (колонки как в MESSAGE_CONTEXT_QUERY).
+# Параметр запроса - ID типа чата.
+ACTIVE_SESSIONS_QUERY = """
+    SELECT s.id, s.agent_id, s.chat_type_id, s.user_id, s.is_active, b.api_token, b.webhook_port,
+           s.created_at, s.updated_at, b.bot_name, b.bot_username, b.bot_description, a.name AS agent_name,
+           ct.name AS platform, {agent_columns}
+    FROM sessions s
+    INNER JOIN gpt_agents a ON s.agent_id = a.id AND a.is_deleted = FALSE
+    INNER JOIN chat_types ct ON s.chat_type_id = ct.id
+    INNER JOIN bots b ON s.id = b.session_id
+    WHERE s.is_active = TRUE AND s.is_deleted = FALSE AND s.chat_type_id = %s
+""".format(agent_columns=", ".join(f"a.{column} AS agent__{column}" for column in MESSAGE_CONTEXT_AGENT_COLUMNS))
+
+
+def pop_agent_columns(row):
+    """
+    Извлекает из строки результата колонки агента с префиксом agent__.
+    :return: Словарь с данными агента.
+    """
+    return {column: row.pop(f"agent__{column}") for column in MESSAGE_CONTEXT_AGENT_COLUMNS}
+
+
+def build_active_sessions(rows, versions):
+    """
+    Разбирает строки результата ACTIVE_SESSIONS_QUERY и сохраняет сессии и агентов в кэш.
+    :param rows: Строки результата запроса.
+    :param versions: Версии кэшей, полученные через message_context_cache_versions() до запроса.
+    :return: Список сессий; настройки агента каждой сессии находятся в ключе 'agent'.
+    """
+    session_version, agent_version = versions
+    sessions = []
+    for row in rows:
+        agent = pop_agent_columns(row)
+        session_cache.set(row['id'], row, session_version)
+        agent_cache.set(agent['id'], agent, agent_version)
+        sessions.append({**row, "agent": agent})
+    return sessions
+
+
+def build_message_context(row):
+    """
+    Разбирает строку результата MESSAGE_CONTEXT_QUERY на данные сессии и агента.
+    :param row: Строка результата запроса в виде словаря или None.
+    :return: Словарь контекста сообщения или None, если сессия не найдена.
+    """
+    if not row:
+        return None
+    agent = pop_agent_columns(row)
+    user_exists = bool(row.pop('user_exists'))
+    return {
+        "session": row,
+        "agent": agent,
+        "api_key": agent['api_key'],
+        "user_exists": user_exists,
+    }
+
+
+def get_cached_message_context(session_id, user_id):
+    """
+    Собирает контекст сообщения из кэшей сессий, агентов и пользователей без обращения к базе.
+    :return: Словарь контекста сообщения или None, если каких-то данных нет в кэше.
+    """
+    hit, session = session_cache.get(session_id)
+    if not hit:
+        return None
+    hit, agent = agent_cache.get(session['agent_id'])
+    if not hit:
+        return None
+    hit, _ = user_exists_cache.get(user_id)
+    if not hit:
+        return None
+    return {
+        "session": session,
+        "agent": agent,
+        "api_key": agent['api_key'],
+        "user_exists": True,
+    }
+
+
+def message_context_cache_versions():
+    """
+    Возвращает версии кэшей сессий и агентов перед загрузкой контекста сообщения из базы.
+    """
+    return session_cache.version(), agent_cache.version()
+
+
+def cache_message_context(context, user_id, versions):
+    """
+    Сохраняет загруженный из базы контекст сообщения в кэши сессий, агентов и пользователей.
+    :param context: Словарь контекста сообщения.
+    :param user_id: ID пользователя, отправившего сообщение.
+    :param versions: Версии кэшей, полученные через message_context_cache_versions() до запроса.
+    """
+    session_version, agent_version = versions
+    session_cache.set(context['session']['id'], context['session'], session_version)
+    agent_cache.set(context['agent']['id'], context['agent'], agent_version)
+    if context['user_exists']:
+        user_exists_cache.set(user_id, True)
+
+
+def get_message_context(session_id, user_id):
+    """
+    Загружает одним запросом всё, что нужно для обработки входящего сообщения бота:
+    данные сессии и бота, настройки и API-ключ агента, а также признак существования пользователя.
+    Если все данные уже есть в кэше, запрос к базе не выполняется.
+    :param session_id: ID сессии.
+    :param user_id: ID пользователя, отправившего сообщение.
+    :return: Словарь с ключами session, agent, api_key и user_exists или None, если сессия не найдена.
+    """
+    context = get_cached_message_context(session_id, user_id)
+    if context is not None:
+        return context
+    versions = message_context_cache_versions()
+    try:
+        with db_pool.connection() as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute(MESSAGE_CONTEXT_QUERY, (user_id, session_id))
+                context = build_message_context(cursor.fetchone())
+                if context is not None:
+                    cache_message_context(context, user_id, versions)
+                return context
+    except Error as e:
+        logger.log(f"Ошибка при получении контекста сообщения: {e}", "ERROR")
+        return None
+
+
 def activate_session_in_db(session_id):
     """
     Активирует сессию в базе данных, устанавливая is_active в TRUE.
@@ -672,15 +957,16 @@ def activate_session_in_db(session_id):
     :return: True, если сессия успешно активирована, иначе False.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                UPDATE sessions
-                SET is_active = TRUE, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s AND is_deleted = FALSE
-            """, (session_id,))
-            connection.commit()
-            return cursor.rowcount > 0  # Возвращает True, если хотя бы одна строка была обновлена
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE sessions
+                    SET is_active = TRUE, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND is_deleted = FALSE
+                """, (session_id,))
+                connection.commit()
+                session_cache.invalidate(session_id)
+                return cursor.rowcount > 0  # Возвращает True, если хотя бы одна строка была обновлена
     except Error as e:
         logger.log(f"Ошибка при активации сессии: {e}", "ERROR")
         return False
@@ -693,15 +979,16 @@ def terminate_session_in_db(session_id):
     :return: True, если сессия успешно завершена, иначе False.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                UPDATE sessions
-                SET is_active = FALSE, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s AND is_deleted = FALSE
-            """, (session_id,))
-            connection.commit()
-            return cursor.rowcount > 0  # Возвращает True, если хотя бы одна строка была обновлена
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE sessions
+                    SET is_active = FALSE, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND is_deleted = FALSE
+                """, (session_id,))
+                connection.commit()
+                session_cache.invalidate(session_id)
+                return cursor.rowcount > 0  # Возвращает True, если хотя бы одна строка была обновлена
     except Error as e:
         logger.log(f"Ошибка при завершении сессии: {e}", "ERROR")
         return False
@@ -720,13 +1007,13 @@ def add_telegram_bot(session_id, api_token, bot_name, bot_username, webhook_port
     :return: ID созданной сессии.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO bots (session_id, api_token, bot_name, bot_username, webhook_port, created_at, updated_at)
-                VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """, (session_id, api_token, bot_name, bot_username, webhook_port))
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO bots (session_id, api_token, bot_name, bot_username, webhook_port, created_at, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                """, (session_id, api_token, bot_name, bot_username, webhook_port))
+                connection.commit()
     except Error as e:
         logger.log(f"Ошибка при создании телеграм бота: {e}", "ERROR")
         return None
@@ -740,13 +1027,13 @@ def add_whatsapp_bot(session_id, bot_name, bot_username):
     :param bot_username: В данном случае это номер телефона whatsapp аккаунта.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO bots (session_id, bot_name, bot_username, created_at, updated_at)
-                VALUES (%s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """, (session_id, bot_name, bot_username))
-            connection.commit()
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO bots (session_id, bot_name, bot_username, created_at, updated_at)
+                    VALUES (%s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                """, (session_id, bot_name, bot_username))
+                connection.commit()
     except Error as e:
         logger.log(f"Ошибка при добавлении WhatsApp-бота: {e}", "ERROR")
 
@@ -759,12 +1046,12 @@ def is_telegram_token_api_exists(api_token):
     :return: True, если токен существует, иначе False.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            query = "SELECT COUNT(*) FROM bots WHERE api_token = %s"
-            cursor.execute(query, (api_token,))
-            result = cursor.fetchone()
-            return result[0] > 0
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                query = "SELECT COUNT(*) FROM bots WHERE api_token = %s"
+                cursor.execute(query, (api_token,))
+                result = cursor.fetchone()
+                return result[0] > 0
     except Error as e:
         logger.log(f"Ошибка при проверке токена: {e}", "ERROR")
         return False
@@ -778,12 +1065,12 @@ def is_whatsapp_number_in_db(phone_number):
     :return: True, если телефон существует, иначе False.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            query = "SELECT COUNT(*) FROM bots WHERE bot_username = %s"
-            cursor.execute(query, (phone_number,))
-            result = cursor.fetchone()
-            return result[0] > 0
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                query = "SELECT COUNT(*) FROM bots WHERE bot_username = %s"
+                cursor.execute(query, (phone_number,))
+                result = cursor.fetchone()
+                return result[0] > 0
     except Error as e:
         logger.log(f"Ошибка при проверке токена: {e}", "ERROR")
         return False
@@ -796,12 +1083,12 @@ def get_webhook_port(session_id):
     :return: Порт вебхука в указанной сессии.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            query = "SELECT webhook_port FROM bots WHERE session_id = %s"
-            cursor.execute(query, (session_id,))
-            result = cursor.fetchone()
-            return result[0]
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                query = "SELECT webhook_port FROM bots WHERE session_id = %s"
+                cursor.execute(query, (session_id,))
+                result = cursor.fetchone()
+                return result[0]
     except Error as e:
         logger.log(f"Ошибка при получении последнего порта вебхука: {e}", "ERROR")
         return None
@@ -814,11 +1101,11 @@ def get_last_webhook_port():
     :return: Последний порт вебхука или None, если порты еще не использовались.
     """
     try:
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT MAX(webhook_port) + 1 FROM bots WHERE webhook_port BETWEEN 1 AND 65535")
-            result = cursor.fetchone()
-            return result[0]
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT MAX(webhook_port) + 1 FROM bots WHERE webhook_port BETWEEN 1 AND 65535")
+                result = cursor.fetchone()
+                return result[0]
     except Error as e:
         logger.log(f"Ошибка при получении последнего порта вебхука: {e}", "ERROR")
         return None
@@ -834,14 +1121,15 @@ def update_bot_name_db(session_id, new_bot_name):
         if 'Ошибка' in api_response:
             logger.log(f"Ошибка при обновлении имени через API: {api_response}", "ERROR")
             return False
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "UPDATE bots SET bot_name = %s WHERE session_id = %s AND is_deleted = FALSE",
-                (new_bot_name, session_id)
-            )
-            connection.commit()
-            return True
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE bots SET bot_name = %s WHERE session_id = %s AND is_deleted = FALSE",
+                    (new_bot_name, session_id)
+                )
+                connection.commit()
+                session_cache.invalidate(session_id)
+                return True
     except Exception as e:
         logger.log(f"Ошибка при обновлении имени бота в БД: {e}", "ERROR")
         return False
@@ -857,14 +1145,15 @@ def update_bot_description_db(session_id, new_bot_description):
         if 'Ошибка' in api_response:
             logger.log(f"Ошибка при обновлении описания через API: {api_response}", "ERROR")
             return False
-        connection = db_instance.get_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "UPDATE bots SET bot_description = %s WHERE session_id = %s AND is_deleted = FALSE",
-                (new_bot_description, session_id)
-            )
-            connection.commit()
-            return True
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE bots SET bot_description = %s WHERE session_id = %s AND is_deleted = FALSE",
+                    (new_bot_description, session_id)
+                )
+                connection.commit()
+                session_cache.invalidate(session_id)
+                return True
     except Exception as e:
         logger.log(f"Ошибка при обновлении описания бота в БД: {e}", "ERROR")
         return False
@@ -0,0 +1,213 @@
+"""
+db_migrations.py
+Версионированные миграции схемы базы данных.
+Применяет к существующей базе изменения схемы, появившиеся после db_create_tables.py (индексы, новые колонки и таблицы).
+Примененные версии хранятся в таблице `schema_migrations`, поэтому повторный запуск безопасен: выполняются только
+новые миграции. Каждая операция дополнительно проверяет information_schema и пропускается, если уже выполнена.
+Индексы и колонки добавляются онлайн (ALGORITHM=INPLACE, LOCK=NONE), без блокировки записи в таблицы.
+
+Миграции применяются при запуске приложения (run.py). Запуск вручную из корня проекта:
+    python -m database.db_migrations
+"""
+
+from mysql.connector import Error
+from database.db_connection import db_pool
+from utils.logs.logger import logger
+
+
+# Имя блокировки MySQL, не позволяющей двум экземплярам приложения применять миграции одновременно
+MIGRATIONS_LOCK_NAME = 'klasterbot_schema_migrations'
+
+
+########################################### Операции миграций ###########################################
+
+def index_exists(cursor, table, index_name):
+    """
+    Проверяет, существует ли индекс в таблице текущей базы данных.
+    """
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+    """, (table, index_name))
+    return cursor.fetchone()[0] > 0
+
+
+def column_exists(cursor, table, column):
+    """
+    Проверяет, существует ли колонка в таблице текущей базы данных.
+    """
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+def add_index(cursor, table, index_name, columns):
+    """
+    Онлайн-добавление индекса, если его ещё нет.
+    :param table: Имя таблицы.
+    :param index_name: Имя индекса.
+    :param columns: Список колонок индекса через запятую.
+    """
+    if index_exists(cursor, table, index_name):
+        print(f"Индекс '{index_name}' в таблице '{table}' уже существует.")
+        return
+    cursor.execute(f"ALTER TABLE {table} ADD INDEX {index_name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+    print(f"Индекс '{index_name}' добавлен в таблицу '{table}'.")
+
+
+def add_column(cursor, table, column, definition):
+    """
+    Онлайн-добавление колонки, если её ещё нет.
+    :param table: Имя таблицы.
+    :param column: Имя колонки.
+    :param definition: Определение колонки (тип, значение по умолчанию и т.д.).
+    """
+    if column_exists(cursor, table, column):
+        print(f"Колонка '{column}' в таблице '{table}' уже существует.")
+        return
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}, ALGORITHM=INPLACE, LOCK=NONE")
+    print(f"Колонка '{column}' добавлена в таблицу '{table}'.")
+
+
+############################################### Миграции ################################################
+
+def migration_0001_chats_history_indexes(cursor):
+    """
+    Составные индексы для чтения истории чатов:
+    - по сессии и пользователю (сообщения ботов, get_chat_history_by_session_id_and_user_id);
+    - по пользователю, агенту и типу чата (тестовый веб-чат, get_chat_history_by_user_and_agent).
+    Фильтр и сортировка по created_at полностью покрываются индексом; первичный ключ id InnoDB добавляет
+    в каждый вторичный индекс автоматически.
+    """
+    add_index(cursor, 'chats', 'idx_chats_session_user_created', 'session_id, user_id, is_deleted, created_at')
+    add_index(cursor, 'chats', 'idx_chats_user_agent_type_created', 'user_id, agent_id, chat_type_id, is_deleted, created_at')
+
+
+def migration_0002_lookup_indexes(cursor):
+    """
+    Индексы для поиска бота по токену, пользователя по полному имени и сессий пользователя.
+    """
+    add_index(cursor, 'bots', 'idx_bots_api_token', 'api_token')
+    add_index(cursor, 'users', 'idx_users_full_name', 'full_name')
+    add_index(cursor, 'sessions', 'idx_sessions_user_deleted', 'user_id, is_deleted')
+
+
+def migration_0003_agent_history_window(cursor):
+    """
+    Настраиваемое окно истории диалога агента: количество пар сообщений и бюджет токенов,
+    которые отправляются в модель вместе с новым сообщением.
+    """
+    add_column(cursor, 'gpt_agents', 'history_max_turns', 'INT NOT NULL DEFAULT 20')
+    add_column(cursor, 'gpt_agents', 'history_token_budget', 'INT NOT NULL DEFAULT 2000')
+
+
+def migration_0004_agent_response_cache(cursor):
+    """
+    Флаг кэширования ответов модели для агента (кэш одинаковых запросов, см. utils/llm_cache.py).
+    """
+    add_column(cursor, 'gpt_agents', 'response_cache_enabled', 'BOOLEAN NOT NULL DEFAULT FALSE')
+
+
+def migration_0005_telegram_updates(cursor):
+    """
+    Таблица принятых обновлений Telegram для отбрасывания повторных доставок вебхуков
+    (постоянное хранилище дедупликации, см. application/services/telegram/update_dedup.py).
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS telegram_updates (
+            session_id INT NOT NULL,
+            update_id BIGINT NOT NULL,
+            received_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (session_id, update_id),
+            INDEX idx_telegram_updates_received (received_at)
+        );
+    """)
+    print("Таблица 'telegram_updates' создана.")
+
+
+def migration_0006_bot_leases(cursor):
+    """
+    Таблица аренды Telegram-сессий узлами кластера (см. application/services/telegram/leases.py).
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_leases (
+            session_id INT NOT NULL PRIMARY KEY,
+            owner VARCHAR(255) NOT NULL,
+            expires_at DATETIME(3) NOT NULL,
+            updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+            INDEX idx_bot_leases_owner (owner)
+        );
+    """)
+    print("Таблица 'bot_leases' создана.")
+
+
+# Список миграций в порядке применения: (версия, описание, функция)
+MIGRATIONS = [
+    (1, 'Индексы истории чатов', migration_0001_chats_history_indexes),
+    (2, 'Индексы bots.api_token, users.full_name, sessions(user_id, is_deleted)', migration_0002_lookup_indexes),
+    (3, 'Окно истории диалога агента', migration_0003_agent_history_window),
+    (4, 'Кэширование ответов агента', migration_0004_agent_response_cache),
+    (5, 'Таблица принятых обновлений Telegram', migration_0005_telegram_updates),
+    (6, 'Таблица аренды Telegram-сессий узлами кластера', migration_0006_bot_leases),
+]
+
+
+############################################ Запуск миграций ############################################
+
+def get_applied_versions(cursor):
+    """
+    Создаёт таблицу `schema_migrations` при необходимости и возвращает множество примененных версий.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def run_migrations():
+    """
+    Применяет все ещё не примененные миграции по порядку версий.
+    :return: Список примененных в этом запуске версий.
+    """
+    applied_now = []
+    with db_pool.connection() as connection:
+        with connection.cursor(buffered=True) as cursor:
+            cursor.execute("SELECT GET_LOCK(%s, 60)", (MIGRATIONS_LOCK_NAME,))
+            if cursor.fetchone()[0] != 1:
+                raise RuntimeError("Не удалось получить блокировку миграций: миграции уже выполняются.")
+            try:
+                applied = get_applied_versions(cursor)
+                for version, description, migration in sorted(MIGRATIONS, key=lambda m: m[0]):
+                    if version in applied:
+                        continue
+                    print(f"Применение миграции {version}: {description}")
+                    migration(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    connection.commit()
+                    applied_now.append(version)
+                    logger.log(f"Миграция {version} применена: {description}")
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATIONS_LOCK_NAME,))
+    return applied_now
+
+
+if __name__ == "__main__":
+    try:
+        versions = run_migrations()
+        if versions:
+            print(f"Применены миграции: {', '.join(map(str, versions))}")
+        else:
+            print("Схема базы данных актуальна.")
+    except (Error, RuntimeError) as e:
+        print(f"Ошибка при применении миграций: {e}")
+        raise SystemExit(1)
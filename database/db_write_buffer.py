@@ -0,0 +1,249 @@
+"""
+db_write_buffer.py
+Модуль отложенной пакетной записи сообщений чата (write-behind).
+Вместо отдельного INSERT и commit на каждое сообщение строки накапливаются в памяти и записываются в таблицу `chats`
+одним многострочным INSERT каждые CHAT_WRITE_BATCH_SIZE строк или каждые CHAT_WRITE_FLUSH_INTERVAL_MS миллисекунд.
+
+Буфер включается переменной окружения CHAT_WRITE_BEHIND=true. Перед чтением истории чата вызывающий код сбрасывает
+в базу ожидающие строки того же чата (`flush_for`), поэтому только что записанные сообщения всегда видны в истории.
+При завершении приложения оставшиеся строки записываются методом `close()` (регистрируется через atexit в run.py).
+
+Ответ пользователю к моменту записи уже отправлен, поэтому пакет не отбрасывается при первой ошибке: INSERT
+повторяется до CHAT_WRITE_RETRIES раз с экспоненциальной задержкой (CHAT_WRITE_RETRY_DELAY_MS), а затем строки
+пакета записываются по одной, чтобы одна некорректная строка не приводила к потере остальных.
+"""
+
+from mysql.connector import Error
+from mysql.connector.errors import DataError, IntegrityError
+from database.db_connection import db_pool
+from utils.logs.logger import logger
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+
+# Колонки таблицы chats в порядке значений строки буфера
+CHAT_COLUMNS = ('user_id', 'agent_id', 'chat_type_id', 'session_id', 'user_message', 'bot_response')
+
+
+class ChatWriteBuffer:
+    """
+    Потокобезопасный буфер сообщений чата с фоновым потоком записи.
+
+    Сброс выполняется одним потоком за раз (`_flush_lock`), поэтому строки попадают в базу в порядке добавления.
+    Строки, которые уже забраны из буфера, но ещё не записаны, учитываются при проверке `flush_for`.
+    """
+
+    def __init__(self, name, batch_size, flush_interval, retries, retry_delay):
+        """
+        :param name: Имя буфера (используется в логах и статистике).
+        :param batch_size: Количество строк, при накоплении которых буфер сбрасывается немедленно.
+        :param flush_interval: Максимальное время хранения строки в буфере в секундах.
+        :param retries: Количество повторов пакетного INSERT после ошибки.
+        :param retry_delay: Задержка перед первым повтором в секундах (удваивается с каждым повтором).
+        """
+        self.name = name
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.retries = max(retries, 0)
+        self.retry_delay = retry_delay
+        self._pending = []  # Строки, ожидающие записи
+        self._in_flight = []  # Строки, записываемые в данный момент
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {
+            "queued_rows": 0,
+            "flushed_rows": 0,
+            "failed_rows": 0,
+            "retries": 0,
+            "row_fallbacks": 0,
+            "flushes": 0,
+            "max_batch": 0,
+        }
+
+    def _start(self):
+        """
+        Запускает фоновый поток записи при первом добавлении строки.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """
+        Цикл фонового потока: ожидает заполнения пакета или истечения интервала и сбрасывает буфер.
+        """
+        while True:
+            with self._lock:
+                if not self._pending and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    return
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._pending) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+            self.flush()
+
+    def add(self, user_id, agent_id, chat_type_id, session_id, user_message, bot_response):
+        """
+        Добавляет сообщение чата в буфер. Если буфер закрыт, сообщение записывается сразу.
+        """
+        row = (user_id, agent_id, chat_type_id, session_id, user_message, bot_response)
+        with self._lock:
+            if not self._closed:
+                self._pending.append(row)
+                self._stats["queued_rows"] += 1
+                self._start()
+                if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                    self._lock.notify()
+                return
+        self._write([row])
+
+    @staticmethod
+    def _matches(row, key):
+        """
+        Проверяет, относится ли строка к чату, заданному словарем {колонка: значение}.
+        ID сравниваются как строки: из параметров запроса они приходят строками, а из базы - числами.
+        """
+        return all(str(row[CHAT_COLUMNS.index(column)]) == str(value) for column, value in key.items())
+
+    def has_pending(self, **key):
+        """
+        Проверяет, есть ли незаписанные строки чата, заданного значениями колонок (например, session_id и user_id).
+        """
+        with self._lock:
+            return any(self._matches(row, key) for row in self._pending + self._in_flight)
+
+    def flush_for(self, **key):
+        """
+        Сбрасывает буфер, если в нём есть строки заданного чата. Вызывается перед чтением истории чата.
+        Если строки уже записываются другим потоком, ожидает окончания записи.
+        """
+        if self.has_pending(**key):
+            self.flush()
+
+    def flush(self):
+        """
+        Записывает все накопленные строки в базу данных многострочными INSERT по batch_size строк.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._in_flight, self._pending = self._pending, []
+            try:
+                for start in range(0, len(self._in_flight), self.batch_size):
+                    self._write(self._in_flight[start:start + self.batch_size])
+            finally:
+                with self._lock:
+                    self._in_flight = []
+
+    @staticmethod
+    def _insert(rows):
+        """
+        Записывает строки одним INSERT и одним commit.
+        """
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(rows))
+        query = f"INSERT INTO chats ({', '.join(CHAT_COLUMNS)}) VALUES {placeholders}"
+        params = [value for row in rows for value in row]
+        with db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                connection.commit()
+
+    def _write(self, rows):
+        """
+        Записывает пакет строк, повторяя INSERT после ошибки. Если повторы не помогли, строки записываются по одной.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self._insert(rows)
+                with self._lock:
+                    self._stats["flushes"] += 1
+                    self._stats["flushed_rows"] += len(rows)
+                    self._stats["max_batch"] = max(self._stats["max_batch"], len(rows))
+                return
+            except Error as e:
+                logger.log(f"Ошибка при пакетной записи истории чата ({len(rows)} сообщений, "
+                           f"попытка {attempt + 1}): {e}", "ERROR")
+                # Ошибка данных повторится, поэтому пакет сразу записывается по строкам
+                if isinstance(e, (DataError, IntegrityError)) or attempt == self.retries:
+                    break
+                with self._lock:
+                    self._stats["retries"] += 1
+                time.sleep(self.retry_delay * 2 ** attempt)
+        self._write_rows(rows)
+
+    def _write_rows(self, rows):
+        """
+        Записывает строки по одной. Некорректные строки пропускаются; при других ошибках (база данных недоступна)
+        запись прекращается, а оставшиеся строки считаются потерянными.
+        """
+        with self._lock:
+            self._stats["row_fallbacks"] += 1
+        for index, row in enumerate(rows):
+            try:
+                self._insert([row])
+                with self._lock:
+                    self._stats["flushed_rows"] += 1
+            except (DataError, IntegrityError) as e:
+                with self._lock:
+                    self._stats["failed_rows"] += 1
+                logger.log(f"Сообщение чата сессии {row[3]} не записано: {e}", "ERROR")
+            except Error as e:
+                with self._lock:
+                    self._stats["failed_rows"] += len(rows) - index
+                logger.log(f"Ошибка при записи истории чата, потеряно сообщений: {len(rows) - index}: {e}", "ERROR")
+                return
+
+    def stats(self):
+        """
+        Возвращает статистику буфера.
+        :return: Словарь с количеством ожидающих строк и счётчиками записи.
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "enabled": CHAT_WRITE_BEHIND,
+                "batch_size": self.batch_size,
+                "flush_interval_ms": round(self.flush_interval * 1000),
+                "pending": len(self._pending) + len(self._in_flight),
+                **self._stats,
+            }
+
+    def close(self):
+        """
+        Останавливает фоновый поток и записывает оставшиеся строки.
+        Используется для завершения работы с базой данных в конце работы приложения.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        print(f"Буфер записи '{self.name}' закрыт.")
+
+
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+
+# Буфер сообщений чата для использования во всем приложении
+chat_write_buffer = ChatWriteBuffer(
+    name="chats",
+    batch_size=int(os.getenv('CHAT_WRITE_BATCH_SIZE', 50)),
+    flush_interval=int(os.getenv('CHAT_WRITE_FLUSH_INTERVAL_MS', 200)) / 1000,
+    retries=int(os.getenv('CHAT_WRITE_RETRIES', 3)),
+    retry_delay=int(os.getenv('CHAT_WRITE_RETRY_DELAY_MS', 200)) / 1000,
+)
@@ -2,21 +2,31 @@
 run.py
 Этот файл является точкой входа для запуска Flask-приложения. Он инициализирует приложение с использованием функции
 `create_app` из модуля `application.app` и запускает сервер. Также здесь предусмотрено автоматическое завершение
-соединения с базой данных при завершении работы приложения.
+пула соединений с базой данных и запись буфера сообщений чата при завершении работы приложения.
 
 Основные компоненты:
 1. Инициализация Flask-приложения с использованием функции `create_app`.
 2. Настройка запуска сервера в режиме отладки (debug=True).
-3. Регистрация функции завершения соединения с базой данных с помощью модуля `atexit`,
-чтобы гарантировать корректное завершение соединения.
+3. Регистрация функции закрытия пула соединений с базой данных с помощью модуля `atexit`,
+чтобы гарантировать корректное завершение соединений.
+4. При TELEGRAM_WORKER_PROCESSES > 0 - режим супервизора: Telegram-боты распределяются между процессами-обработчиками
+(`run_worker`), а этот процесс выполняет Flask, WhatsApp-ботов и маршрутизацию вебхуков (см. sharding.py).
+5. Перед запуском применяются новые миграции схемы базы данных (database/db_migrations.py): код ботов использует
+колонки и таблицы, добавленные миграциями. Если миграции применить не удалось, приложение не запускается.
 """
 
 from application.app import create_app
-from database.db_connection import db_instance
+from database.db_connection import db_pool
+from database.db_migrations import run_migrations
+from database.db_write_buffer import chat_write_buffer
+from utils.llm_client import llm_clients
 from utils.logs.logger import logger
 from application.services.telegram.bot_manager import telegram_bot_manager
+from application.services.telegram.webhook_server import webhook_server
+from application.services.telegram.sharding import shard_supervisor, ShardWorker
 from application.services.whatsapp.bot_manager import whatsapp_bot_manager
-from database.db_functions import get_all_active_telegram_sessions, get_all_active_whatsapp_sessions
+from database import db_async_functions as async_db
+from mysql.connector import Error
 import asyncio
 import threading
 import atexit
@@ -28,16 +38,23 @@ flask_app = create_app()
 # Главный событийный цикл asyncio
 main_event_loop = asyncio.new_event_loop()
 flask_app.config["event_loop"] = main_event_loop
+# Запуск и остановка Telegram-ботов из веб-интерфейса: в режиме супервизора команды передаются обработчикам
+flask_app.config["telegram_bots"] = shard_supervisor if shard_supervisor.enabled else telegram_bot_manager
+# Запросы к OpenAI (в том числе из маршрутов Flask) выполняются в главном цикле с общим пулом HTTP-соединений
+llm_clients.bind_loop(main_event_loop)
 
-# Регистрация функции завершения соединения с базой
-atexit.register(db_instance.teardown)
+# Регистрация функции закрытия пула соединений с базой
+atexit.register(db_pool.close_all)
+# Запись оставшихся сообщений буфера чатов. atexit вызывает функции в обратном порядке регистрации,
+# поэтому буфер сбрасывается до закрытия пула соединений
+atexit.register(chat_write_buffer.close)
 
 
 async def start_all_telegram_bots():
     """
     Асинхронный запуск всех активных ботов.
     """
-    active_telegram_sessions = get_all_active_telegram_sessions()
+    active_telegram_sessions = await async_db.get_all_active_telegram_sessions()
     await telegram_bot_manager.start_all_bots(active_telegram_sessions)
 
 
@@ -45,10 +62,40 @@ async def start_all_whatsapp_bots():
     """
     Асинхронный запуск всех активных ботов.
     """
-    active_whatsapp_sessions = get_all_active_whatsapp_sessions()
+    active_whatsapp_sessions = await async_db.get_all_active_whatsapp_sessions()
     await whatsapp_bot_manager.start_all_bots(active_whatsapp_sessions)
 
 
+async def start_telegram_worker(worker):
+    """
+    Запуск сервера вебхуков процесса-обработчика. Боты регистрируются после получения состава обработчиков
+    от супервизора.
+    """
+    await webhook_server.start()
+    worker.start(main_event_loop)
+
+
+def run_worker(worker_id, port, conn):
+    """
+    Точка входа процесса-обработчика Telegram-ботов в режиме супервизора.
+    :param worker_id: Номер обработчика.
+    :param port: Порт сервера вебхуков обработчика (принимает обновления только от супервизора).
+    :param conn: Канал связи с супервизором.
+    """
+    webhook_server.host = "127.0.0.1"
+    webhook_server.port = port
+    try:
+        main_event_loop.run_until_complete(start_telegram_worker(ShardWorker(worker_id, conn, telegram_bot_manager)))
+        main_event_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Повторный вызов после команды остановки от супервизора ничего не делает
+        main_event_loop.run_until_complete(telegram_bot_manager.stop_all_bots())
+        chat_write_buffer.close()
+        main_event_loop.run_until_complete(llm_clients.close())
+
+
 def run_flask():
     """
     Запуск Flask в отдельном потоке.
@@ -56,17 +103,46 @@ def run_flask():
     flask_app.run(debug=True, use_reloader=False)
 
 
+def apply_migrations():
+    """
+    Применяет новые миграции схемы базы данных. Одновременный запуск нескольких экземпляров безопасен:
+    миграции выполняются под блокировкой MySQL.
+    """
+    try:
+        versions = run_migrations()
+    except (Error, RuntimeError) as e:
+        logger.log(f"Ошибка при применении миграций, приложение не запущено: {e}", "ERROR")
+        raise SystemExit(1)
+    if versions:
+        logger.log(f"Применены миграции: {', '.join(map(str, versions))}")
+
+
 if __name__ == "__main__":
+    # Схема базы данных обновляется до запуска Flask и ботов
+    apply_migrations()
     try:
         # Запускаем Flask в отдельном потоке
         flask_thread = threading.Thread(target=run_flask)
         flask_thread.start()
 
         # Запускаем всех активных ботов в главном цикле событий
-        asyncio.run_coroutine_threadsafe(start_all_telegram_bots(), main_event_loop)
+        if shard_supervisor.enabled:
+            asyncio.run_coroutine_threadsafe(shard_supervisor.start(run_worker), main_event_loop)
+        else:
+            asyncio.run_coroutine_threadsafe(start_all_telegram_bots(), main_event_loop)
         asyncio.run_coroutine_threadsafe(start_all_whatsapp_bots(), main_event_loop)
 
         # Запускаем основной событийный цикл
         main_event_loop.run_forever()
     except Exception as e:
         logger.log(f"Ошибка при запуске ботов или Flask: {e}", "ERROR")
+    finally:
+        # После остановки цикла событий (в том числе по Ctrl+C) останавливаем ботов: принятые обновления
+        # дорабатываются, аренда сессий освобождается, общая HTTP-сессия ботов закрывается. Затем записываем
+        # буфер сообщений чата и закрываем клиентов модели
+        if shard_supervisor.enabled:
+            main_event_loop.run_until_complete(shard_supervisor.stop())
+        else:
+            main_event_loop.run_until_complete(telegram_bot_manager.stop_all_bots())
+        chat_write_buffer.close()
+        main_event_loop.run_until_complete(llm_clients.close())
@@ -7,9 +7,10 @@ chat.js
 1. `toggleAgentStatus(agentId)`: Изменяет статус агента.
 2. `loadChatHistory(agentId, startMessageText)`: Загружает историю чата для выбранного агента и добавляет стартовое
 сообщение, если история пуста.
-3. `sendMessage()`: Отправляет сообщение пользователя и отображает ответ агента в чате.
-4. `clearChat()`: Очищает историю чата для выбранного агента.
-5. Обработчики событий: Отвечают за нажатие клавиш и выбор агента, обновляя историю чата и интерфейс пользователя.
+3. `sendMessage()`: Отправляет сообщение пользователя и отображает ответ агента в чате по мере генерации.
+4. `readEventStream(response, onEvent)`: Читает поток Server-Sent Events из ответа fetch.
+5. `clearChat()`: Очищает историю чата для выбранного агента.
+6. Обработчики событий: Отвечают за нажатие клавиш и выбор агента, обновляя историю чата и интерфейс пользователя.
 */
 
 // Обработчик события для кнопки отправки сообщения
@@ -103,36 +104,70 @@ function sendMessage() {
     chatInput.value = "";
     chatBox.scrollTop = chatBox.scrollHeight;
 
-    // Отправка сообщения на сервер
-    fetch('/chat', {
+    // Сообщение бота создаётся сразу и дополняется по мере получения ответа
+    const botMessage = document.createElement('div');
+    botMessage.classList.add('message', 'bot-message');
+    botMessage.style.opacity = '0';
+    chatBox.appendChild(botMessage);
+    setTimeout(() => {
+        botMessage.style.transition = "opacity 0.5s";
+        botMessage.style.opacity = '1';
+    }, 100);
+
+    // Отправка сообщения на сервер, ответ приходит потоком Server-Sent Events
+    fetch('/chat_stream', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
         body: JSON.stringify({ agent_id: agentId, chat_type_id: 1, message: messageText })  // Передаем chat_type_id
     })
-    .then(response => response.json())
-    .then(data => {
-        if (data.error) {
-            console.error(data.error);
-            alert("Ошибка: " + data.error);
-        } else {
-            const botMessage = document.createElement('div');
-            botMessage.classList.add('message', 'bot-message');
-            botMessage.textContent = data.response;
-            chatBox.appendChild(botMessage);
-
-            // Анимация появления сообщения бота
-            botMessage.style.opacity = '0';
-            setTimeout(() => {
-                botMessage.style.transition = "opacity 0.5s";
-                botMessage.style.opacity = '1';
-            }, 100);
-
-            chatBox.scrollTop = chatBox.scrollHeight;
+    .then(response => {
+        if (!response.ok) {
+            return response.json().then(data => { throw new Error(data.error || response.statusText); });
         }
+        return readEventStream(response, (event, data) => {
+            if (event === 'error') {
+                throw new Error(data.error);
+            } else if (event === 'done') {
+                botMessage.textContent = data.response;
+            } else {
+                botMessage.textContent += data.delta;
+            }
+            chatBox.scrollTop = chatBox.scrollHeight;
+        });
     })
-    .catch(error => console.error('Ошибка:', error));
+    .catch(error => {
+        console.error('Ошибка:', error);
+        botMessage.remove();
+        alert("Ошибка: " + error.message);
+    });
+}
+
+// Функция для чтения потока Server-Sent Events из ответа fetch.
+// Для каждого события вызывает onEvent(тип события, данные JSON).
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        // События разделяются пустой строкой
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex);
+            buffer = buffer.slice(separatorIndex + 2);
+            let event = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
 }
 
 // Функция для очистки чата
@@ -2,24 +2,42 @@
 gpt_api.py
 Модуль взаимодействия с API OpenAI для генерации ответов на основе истории диалога.
 Используется для получения ответов от модели на основе инструкций агента и введенных данных пользователя.
+Запросы выполняются клиентом API-ключа агента из `utils.llm_client`. Обработчики ботов вызывают потоковую
+`agenerate_response_stream`, веб-чат (маршрут /chat_stream) - `generate_response_stream`: ответ отдаётся частями
+по мере генерации. Непотоковые версии (`agenerate_response`, `generate_response`) возвращают ответ целиком.
+Для агентов с включенным кэшированием ответов (response_cache_enabled) повторяющиеся запросы обслуживаются
+из кэша `utils.llm_cache`. Одинаковые запросы, выполняющиеся одновременно (например, после рассылки многие
+пользователи пишут один и тот же текст), объединяются в один вызов модели (`single_flight`): потоковые запросы
+получают фрагменты одного общего потока.
+Вызовы модели проходят через планировщик `utils.llm_scheduler`, соблюдающий лимиты RPM/TPM API-ключа агента.
 """
 
+import asyncio
+import hashlib
 import openai
+import os
 
 from database.db_functions import get_agent_by_id
+from database import db_async_functions as async_db
+from database.db_cache import TTLCache
+from utils.llm_client import llm_clients, LLM_REQUEST_TIMEOUT, LLM_MODEL
+from utils.llm_cache import response_cache, chat_request_key
+from utils.llm_scheduler import llm_scheduler, LLM_MAX_QUEUE_WAIT
 from utils.utils import convert_decimals
 from utils.logs.logger import logger
 
 
-def get_openai_api_key(agent_id):
+def get_openai_api_key(agent_id, agent=None):
     """
     Получает API-ключ для указанного агента.
 
     :param agent_id: Идентификатор агента, для которого требуется получить API-ключ.
+    :param agent: Уже загруженные данные агента (если переданы, повторный запрос к базе не выполняется).
     :return: API-ключ, если он существует для агента.
     :raises ValueError: Если API-ключ не найден для указанного агента.
     """
-    agent = get_agent_by_id(agent_id)
+    if agent is None:
+        agent = get_agent_by_id(agent_id)
     if agent and agent['api_key']:
         return agent['api_key']
     else:
@@ -28,79 +46,387 @@ def get_openai_api_key(agent_id):
 
 from datetime import datetime
 
-def generate_response(agent_id, user_input, conversation_history):
+
+# Время ожидания ответа синхронными вызовами из Flask: запрос к модели плюс ожидание в очереди лимитов ключа
+SYNC_WAIT_TIMEOUT = LLM_REQUEST_TIMEOUT + LLM_MAX_QUEUE_WAIT
+
+
+def load_agent(agent_id, agent=None):
     """
-    Генерирует ответ на основе истории диалога и введенных данных пользователя, используя OpenAI API.
+    Возвращает данные агента, загружая их из базы, если они не были переданы.
+    :raises ValueError: Если агент не найден.
+    """
+    if agent is None:
+        agent = get_agent_by_id(agent_id)
+    if not agent:
+        logger.log(f"Ошибка: Агент с ID {agent_id} не найден.", level="ERROR")
+        raise ValueError("Агент не найден.")
+    return agent
+
+
+def build_chat_request(agent_id, agent, user_input, conversation_history):
+    """
+    Формирует параметры запроса к модели из настроек агента, истории диалога и сообщения пользователя.
+
+    :return: Словарь с ключами api_key, messages, temperature и max_tokens.
+    :raises ValueError: Если отсутствует API-ключ агента.
+    """
+    # Преобразуем инструкцию и параметры агента
+    prompt = convert_decimals(agent['instruction'])
+    temperature = convert_decimals(agent['temperature'])
+    max_tokens = agent['max_tokens']
+    # Обработка пользовательского ввода
+    user_input = str(user_input).encode("utf-8").decode("utf-8")
+    # Преобразуем conversation_history, убирая объекты datetime
+    formatted_conversation_history = []
+    for msg in conversation_history:
+        formatted_msg = msg.copy()
+        if isinstance(formatted_msg.get('created_at'), datetime):
+            formatted_msg['created_at'] = formatted_msg['created_at'].isoformat()  # Преобразуем datetime в строку
+        formatted_conversation_history.append(formatted_msg)
+    # Формируем историю сообщений для OpenAI API
+    messages = [{"role": "system", "content": prompt}] + formatted_conversation_history + [{"role": "user", "content": user_input}]
+    return {
+        "api_key": get_openai_api_key(agent_id, agent),
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+
+
+def lookup_cached_response(agent, request):
+    """
+    Ищет ответ на запрос в кэше ответов, если кэширование включено для агента.
+    :param agent: Данные агента.
+    :param request: Параметры запроса из build_chat_request().
+    :return: Кортеж (ключ кэша, поколение агента, сохраненный ответ). Если кэширование выключено, ключ - None.
+    """
+    if not agent.get('response_cache_enabled'):
+        return None, None, None
+    key = chat_request_key(agent, request, LLM_MODEL)
+    generation = response_cache.generation(agent['id'])
+    return key, generation, response_cache.get(key)
+
+
+def store_cached_response(agent, key, generation, response):
+    """
+    Сохраняет ответ модели в кэш ответов, если кэширование включено для агента (ключ не None).
+    """
+    if key is not None and response:
+        response_cache.set(key, agent['id'], response, generation)
+
+
+class SharedStream:
+    """
+    Поток фрагментов ответа, общий для одинаковых одновременных запросов. Фрагменты сохраняются,
+    поэтому присоединившийся позже запрос получает ответ с начала.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk):
+        """
+        Добавляет фрагмент и пробуждает ожидающих.
+        """
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error=None):
+        """
+        Завершает поток (с ошибкой, если она передана).
+        """
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def iterate(self):
+        """
+        Отдаёт фрагменты потока с начала по мере их поступления.
+        """
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов к модели.
+    Первый запрос с данным ключом выполняет вызов, остальные ожидают его результат (или получают фрагменты
+    общего потока). Вызов отменяется, только если его перестали ожидать все запросы.
+    """
+
+    def __init__(self):
+        self._calls = {}  # (цикл, ключ) -> [задача вызова, количество ожидающих]
+        self._streams = {}  # (цикл, ключ) -> SharedStream
+        self._stats = {
+            "calls": 0,
+            "coalesced": 0,
+            "streams": 0,
+            "coalesced_streams": 0,
+            "cancelled": 0,
+        }
+
+    async def do(self, key, make_call):
+        """
+        Выполняет вызов или присоединяется к уже выполняющемуся вызову с тем же ключом.
+        :param key: Ключ запроса (см. chat_request_key).
+        :param make_call: Функция без аргументов, возвращающая корутину вызова.
+        :return: Результат вызова.
+        """
+        call_key = (id(asyncio.get_running_loop()), key)
+        entry = self._calls.get(call_key)
+        if entry is None:
+            entry = [asyncio.ensure_future(make_call()), 0]
+            self._calls[call_key] = entry
+            self._stats["calls"] += 1
+            entry[0].add_done_callback(lambda _: self._calls.pop(call_key, None))
+        else:
+            self._stats["coalesced"] += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                task.cancel()
+                self._stats["cancelled"] += 1
+            raise
+        finally:
+            entry[1] -= 1
+
+    async def stream(self, key, make_stream):
+        """
+        Выполняет потоковый вызов или присоединяется к уже выполняющемуся потоку с тем же ключом.
+        :param key: Ключ запроса (см. chat_request_key).
+        :param make_stream: Функция без аргументов, возвращающая асинхронный генератор фрагментов.
+        :return: Асинхронный генератор фрагментов ответа.
+        """
+        call_key = (id(asyncio.get_running_loop()), key)
+        shared = self._streams.get(call_key)
+        if shared is None:
+            shared = self._streams[call_key] = SharedStream()
+            self._stats["streams"] += 1
+
+            async def pump():
+                try:
+                    async for chunk in make_stream():
+                        shared.publish(chunk)
+                    shared.finish()
+                except asyncio.CancelledError:
+                    shared.finish(asyncio.CancelledError())
+                    raise
+                except Exception as e:
+                    shared.finish(e)
+                finally:
+                    self._streams.pop(call_key, None)
+
+            shared.task = asyncio.ensure_future(pump())
+        else:
+            self._stats["coalesced_streams"] += 1
+        shared.waiters += 1
+        try:
+            async for chunk in shared.iterate():
+                yield chunk
+        finally:
+            shared.waiters -= 1
+            if shared.waiters == 0 and not shared.task.done():
+                shared.task.cancel()
+                self._stats["cancelled"] += 1
+
+    def stats(self):
+        """
+        Возвращает статистику объединения запросов.
+        :return: Словарь с количеством вызовов модели, объединенных запросов и выполняющихся вызовов.
+        """
+        return {"in_flight": len(self._calls), "streams_in_flight": len(self._streams), **self._stats}
+
+
+# Объединение одинаковых запросов к модели для использования во всем приложении
+single_flight = SingleFlight()
+
+
+async def complete_chat_request(agent, request):
+    """
+    Возвращает ответ модели на запрос: из кэша ответов, из уже выполняющегося одинакового запроса
+    или новым вызовом модели.
+    :param agent: Данные агента.
+    :param request: Параметры запроса из build_chat_request().
+    :return: Ответ модели в виде строки.
+    """
+    key, generation, response = lookup_cached_response(agent, request)
+    if response is not None:
+        return response
+    request = dict(request)
+    client = llm_clients.get(request.pop('api_key'))
+
+    async def call():
+        content = await llm_scheduler.run(agent['id'], client.api_key, request['messages'], request['max_tokens'],
+                                          lambda: client.chat_completion(**request))
+        response = format_response(content)
+        store_cached_response(agent, key, generation, response)
+        return response
+
+    return await single_flight.do(key or chat_request_key(agent, request, LLM_MODEL), call)
+
+
+def format_response(content):
+    """
+    Приводит ответ модели к строке.
+    """
+    return str(convert_decimals(content)).encode("utf-8").decode("utf-8")
+
+
+async def agenerate_response(agent_id, user_input, conversation_history, agent=None):
+    """
+    Асинхронно генерирует ответ на основе истории диалога и введенных данных пользователя, используя OpenAI API.
+    Используется обработчиками ботов: запрос не блокирует событийный цикл и отменяется вместе с обработчиком.
 
     :param agent_id: Идентификатор агента, для которого выполняется запрос.
     :param user_input: Введенные данные пользователя, на которые требуется ответить.
     :param conversation_history: История диалога, включающая предыдущие сообщения пользователя и ответы бота.
+    :param agent: Уже загруженные данные агента, например из контекста сообщения.
     :return: Ответ модели в виде строки.
     :raises ValueError: Если агент не найден или отсутствует API-ключ.
+    :raises LLMTimeoutError: Если модель не ответила за отведённое время.
     """
     try:
-        # Получаем данные агента
-        agent = get_agent_by_id(agent_id)
-        if not agent:
-            logger.log(f"Ошибка: Агент с ID {agent_id} не найден.", level="ERROR")
-            raise ValueError("Агент не найден.")
-        # logger.log(f"Получены данные агента: {agent}")
-        # Устанавливаем API-ключ для OpenAI
-        openai.api_key = get_openai_api_key(agent_id)
-        # logger.log(f"API-ключ для агента {agent_id} успешно установлен.")
-        # Преобразуем инструкцию и параметры агента
-        prompt = convert_decimals(agent['instruction'])
-        temperature = convert_decimals(agent['temperature'])
-        max_tokens = agent['max_tokens']
-        # logger.log(f"Параметры агента: prompt={prompt}, temperature={temperature}, max_tokens={max_tokens}")
-        # Обработка пользовательского ввода
-        user_input = str(user_input).encode("utf-8").decode("utf-8")
-        # logger.log(f"Входное сообщение пользователя: {user_input}")
-        # Преобразуем conversation_history, убирая объекты datetime
-        formatted_conversation_history = []
-        for msg in conversation_history:
-            formatted_msg = msg.copy()
-            if isinstance(formatted_msg.get('created_at'), datetime):
-                formatted_msg['created_at'] = formatted_msg['created_at'].isoformat()  # Преобразуем datetime в строку
-            formatted_conversation_history.append(formatted_msg)
-        # Формируем историю сообщений для OpenAI API
-        messages = [{"role": "system", "content": prompt}] + formatted_conversation_history + [{"role": "user", "content": user_input}]
-        # logger.log(f"История сообщений для OpenAI API: {messages}")
-        # Выполняем запрос к OpenAI API для генерации ответа
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        # logger.log(f"Ответ от OpenAI API: {response}")
-        # Извлекаем ответ и преобразуем его к нужному формату
-        response_data = {
-            "response": response.choices[0].message['content']
-        }
-        response_data = convert_decimals(response_data)
-        response_data['response'] = str(response_data['response']).encode("utf-8").decode("utf-8")
-        # logger.log(f"Сформированный ответ: {response_data['response']}")
-        return response_data['response']
+        if agent is None:
+            agent = await async_db.get_agent_by_id(agent_id)
+        agent = load_agent(agent_id, agent)
+        request = build_chat_request(agent_id, agent, user_input, conversation_history)
+        return await complete_chat_request(agent, request)
+    except Exception as e:
+        logger.log(f"Ошибка в agenerate_response: {e}", level="ERROR")
+        raise
+
 
+def generate_response(agent_id, user_input, conversation_history, agent=None):
+    """
+    Генерирует ответ на основе истории диалога и введенных данных пользователя, используя OpenAI API.
+    Синхронная версия для маршрутов Flask: запрос выполняется асинхронным клиентом в главном событийном цикле,
+    поэтому одинаковые запросы из Flask и от ботов тоже объединяются.
+
+    :param agent_id: Идентификатор агента, для которого выполняется запрос.
+    :param user_input: Введенные данные пользователя, на которые требуется ответить.
+    :param conversation_history: История диалога, включающая предыдущие сообщения пользователя и ответы бота.
+    :param agent: Уже загруженные данные агента, например из контекста сообщения (если переданы,
+    агент не запрашивается из базы повторно).
+    :return: Ответ модели в виде строки.
+    :raises ValueError: Если агент не найден или отсутствует API-ключ.
+    :raises LLMTimeoutError: Если модель не ответила за отведённое время.
+    """
+    try:
+        agent = load_agent(agent_id, agent)
+        request = build_chat_request(agent_id, agent, user_input, conversation_history)
+        return llm_clients.run_sync(complete_chat_request(agent, request), SYNC_WAIT_TIMEOUT)
     except Exception as e:
         logger.log(f"Ошибка в generate_response: {e}", level="ERROR")
         raise
 
 
+async def stream_chat_request(agent, request):
+    """
+    Отдаёт ответ модели на запрос частями: из кэша ответов (одним фрагментом), из уже выполняющегося одинакового
+    потокового запроса или новым потоковым вызовом модели.
+    :param agent: Данные агента.
+    :param request: Параметры запроса из build_chat_request().
+    :return: Асинхронный генератор фрагментов ответа.
+    """
+    key, generation, response = lookup_cached_response(agent, request)
+    if response is not None:
+        yield response
+        return
+    request = dict(request)
+    client = llm_clients.get(request.pop('api_key'))
+
+    async def call():
+        parts = []
+        async for delta in llm_scheduler.stream(agent['id'], client.api_key, request['messages'],
+                                                request['max_tokens'], lambda: client.chat_completion_stream(**request)):
+            parts.append(delta)
+            yield delta
+        store_cached_response(agent, key, generation, "".join(parts))
+
+    async for delta in single_flight.stream(key or chat_request_key(agent, request, LLM_MODEL), call):
+        yield delta
+
+
+async def agenerate_response_stream(agent_id, user_input, conversation_history, agent=None):
+    """
+    Асинхронно генерирует ответ модели и отдаёт его частями по мере генерации.
+    Параметры и исключения такие же, как у `agenerate_response`.
+
+    :return: Асинхронный генератор фрагментов ответа.
+    """
+    try:
+        if agent is None:
+            agent = await async_db.get_agent_by_id(agent_id)
+        agent = load_agent(agent_id, agent)
+        request = build_chat_request(agent_id, agent, user_input, conversation_history)
+        async for delta in stream_chat_request(agent, request):
+            yield delta
+    except Exception as e:
+        logger.log(f"Ошибка в agenerate_response_stream: {e}", level="ERROR")
+        raise
+
+
+def generate_response_stream(agent_id, user_input, conversation_history, agent=None):
+    """
+    Генерирует ответ модели и отдаёт его частями по мере генерации. Синхронная версия для маршрутов Flask.
+    Параметры и исключения такие же, как у `generate_response`.
+
+    :return: Генератор фрагментов ответа.
+    """
+    try:
+        agent = load_agent(agent_id, agent)
+        request = build_chat_request(agent_id, agent, user_input, conversation_history)
+        yield from llm_clients.iterate_sync(stream_chat_request(agent, request), SYNC_WAIT_TIMEOUT)
+    except Exception as e:
+        logger.log(f"Ошибка в generate_response_stream: {e}", level="ERROR")
+        raise
+
+
+# Результаты проверки API-ключей (ключ кэша - SHA-256 API-ключа, значение - True или False)
+api_key_validation_cache = TTLCache("api_key_validation", 1000, float(os.getenv('API_KEY_VALIDATION_TTL', 3600)))
+
+
 def validate_api_key(api_key):
     """
     Проверяет валидность переданного API-ключа путем выполнения тестового запроса к OpenAI API.
+    Результат проверки кэшируется на API_KEY_VALIDATION_TTL секунд; ошибки сети не кэшируются.
 
     :param api_key: API-ключ для проверки.
     :return: True, если ключ валиден, иначе False.
     """
-    openai.api_key = api_key
+    cache_key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    hit, is_valid = api_key_validation_cache.get(cache_key)
+    if hit:
+        return is_valid
     try:
-        openai.Model.list()
-        return True
+        openai.Model.list(api_key=api_key, request_timeout=LLM_REQUEST_TIMEOUT)
+        is_valid = True
     except openai.error.AuthenticationError:
-        return False
+        is_valid = False
     except Exception as e:
         logger.log(f"Ошибка при проверке GPT API KEY: {e}")
-        return False
\ No newline at end of file
+        return False
+    api_key_validation_cache.set(cache_key, is_valid)
+    return is_valid
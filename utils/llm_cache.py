@@ -0,0 +1,181 @@
+"""
+llm_cache.py
+Кэш ответов модели для агентов с включенной опцией кэширования (response_cache_enabled).
+Ответ сохраняется по точному совпадению запроса: ключ - хэш агента и версии его настроек, инструкции, температуры,
+max_tokens, модели, переданной в модель истории и сообщения пользователя. Поэтому одинаковые первые сообщения
+("привет", "сколько стоит?") обслуживаются без платного обращения к OpenAI.
+
+Кэш ограничен по количеству записей и по суммарному размеру (LRU), записи устаревают через LLM_CACHE_TTL секунд.
+Записи агента сбрасываются при изменении его настроек (`invalidate_agent` вызывается из update_agent_settings),
+в режиме супервизора Telegram-ботов - и в процессах-обработчиках (см. db_cache.notify_invalidation).
+"""
+
+from collections import OrderedDict
+from database.db_cache import register_cache, notify_invalidation
+from dotenv import load_dotenv
+import threading
+import hashlib
+import json
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+
+def chat_request_key(agent, request, model):
+    """
+    Формирует ключ запроса к модели: одинаковые запросы имеют одинаковый ключ.
+    :param agent: Данные агента.
+    :param request: Параметры запроса (messages, temperature, max_tokens), см. gpt_api.build_chat_request.
+    :param model: Модель OpenAI.
+    :return: SHA-256 запроса в виде строки.
+    """
+    payload = json.dumps({
+        "agent_id": agent['id'],
+        "version": str(agent.get('updated_at')),
+        "model": model,
+        "temperature": str(request['temperature']),
+        "max_tokens": request['max_tokens'],
+        "messages": [(message['role'], message['content']) for message in request['messages']],
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Потокобезопасный LRU-кэш ответов модели с ограничением по количеству записей, объёму и времени жизни.
+
+    Перед запросом к модели вызывающий код запоминает поколение агента (`generation(agent_id)`) и передаёт его
+    в `set`: если за время запроса настройки агента изменились, устаревший ответ не сохраняется.
+    """
+
+    def __init__(self, name, max_entries, max_bytes, ttl):
+        """
+        :param name: Имя кэша (используется в статистике).
+        :param max_entries: Максимальное количество записей.
+        :param max_bytes: Максимальный суммарный размер ответов в байтах.
+        :param ttl: Время жизни записи в секундах.
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # Ключ -> (ID агента, ответ, размер, время истечения)
+        self._agent_keys = {}  # ID агента -> множество ключей его записей
+        self._generations = {}  # ID агента -> номер поколения, увеличивается при инвалидации
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+        register_cache(name, self.invalidate_agent)
+
+    def _remove(self, key):
+        """
+        Удаляет запись и обновляет индекс агента и занятый объём. Вызывается под блокировкой.
+        """
+        agent_id, _, size, _ = self._data.pop(key)
+        self._bytes -= size
+        keys = self._agent_keys.get(agent_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._agent_keys[agent_id]
+
+    def get(self, key):
+        """
+        Возвращает сохраненный ответ модели.
+        :param key: Ключ из chat_request_key().
+        :return: Текст ответа или None, если ответа нет в кэше.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return None
+            if item[3] <= time.monotonic():
+                self._remove(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return item[1]
+
+    def generation(self, agent_id):
+        """
+        Возвращает текущее поколение записей агента. Запоминается перед запросом к модели.
+        """
+        with self._lock:
+            return self._generations.get(str(agent_id), 0)
+
+    def set(self, key, agent_id, response, generation=None):
+        """
+        Сохраняет ответ модели.
+        :param key: Ключ из chat_request_key().
+        :param agent_id: ID агента.
+        :param response: Текст ответа.
+        :param generation: Поколение агента, полученное до запроса. Если с тех пор настройки агента изменились,
+        ответ не сохраняется.
+        """
+        agent_id = str(agent_id)
+        size = len(key) + len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generations.get(agent_id, 0):
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (agent_id, response, size, time.monotonic() + self.ttl)
+            self._agent_keys.setdefault(agent_id, set()).add(key)
+            self._bytes += size
+            self._stats["stores"] += 1
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self._stats["evictions"] += 1
+
+    def invalidate_agent(self, agent_id):
+        """
+        Удаляет все сохраненные ответы агента. Вызывается при изменении настроек агента.
+        :param agent_id: ID агента.
+        """
+        agent_id = str(agent_id)
+        with self._lock:
+            self._generations[agent_id] = self._generations.get(agent_id, 0) + 1
+            for key in list(self._agent_keys.get(agent_id, ())):
+                self._remove(key)
+            self._stats["invalidations"] += 1
+        notify_invalidation(self.name, agent_id)
+
+    def stats(self):
+        """
+        Возвращает статистику кэша.
+        :return: Словарь с количеством записей, занятым объёмом и счётчиками попаданий и промахов.
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                **self._stats,
+            }
+
+
+# Кэш ответов модели для использования во всем приложении
+response_cache = ResponseCache(
+    name="llm_responses",
+    max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', 10000)),
+    max_bytes=int(os.getenv('LLM_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+    ttl=float(os.getenv('LLM_CACHE_TTL', 3600)),
+)
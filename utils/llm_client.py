@@ -0,0 +1,473 @@
+"""
+llm_client.py
+Асинхронные клиенты OpenAI с пулами HTTP-соединений.
+Запросы к модели выполняются через `openai.ChatCompletion.acreate` и не блокируют событийный цикл ботов.
+Для каждого API-ключа создаётся отдельный клиент (`llm_clients.get(api_key)`) с собственной aiohttp-сессией
+и keep-alive соединениями. Ключ передаётся в каждый запрос явно, глобальный `openai.api_key` не используется,
+поэтому запросы разных агентов выполняются параллельно и не могут уйти с чужим ключом.
+Запросы ограничены по времени (LLM_REQUEST_TIMEOUT) и корректно отменяются вместе с вызывающей задачей.
+
+Синхронный код (маршруты Flask) вызывает клиент через `chat_completion_sync`: запрос выполняется в главном
+событийном цикле приложения, а поток Flask ожидает результат.
+
+Потоковые ответы (`chat_completion_stream`, `chat_completion_stream_sync`) отдают текст частями по мере генерации,
+поэтому пользователь видит начало ответа через время до первого токена, а не после завершения генерации.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import suppress
+from dotenv import load_dotenv
+import threading
+import queue
+import time
+import aiohttp
+import asyncio
+import openai
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o-mini')
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', 10))
+LLM_HTTP_POOL_SIZE = int(os.getenv('LLM_HTTP_POOL_SIZE', 20))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv('LLM_KEEPALIVE_TIMEOUT', 60))
+LLM_MAX_CLIENTS = int(os.getenv('LLM_MAX_CLIENTS', 256))
+
+
+class LLMTimeoutError(TimeoutError):
+    """
+    Исключение, возникающее, когда модель не ответила за отведённое время.
+    """
+
+
+def mask_api_key(api_key):
+    """
+    Возвращает безопасное для логов и статистики представление API-ключа.
+    """
+    return f"...{api_key[-4:]}" if api_key else "-"
+
+
+def run_coroutine_sync(coroutine, loop, timeout):
+    """
+    Выполняет корутину из синхронного кода (потока Flask) и возвращает её результат.
+    Корутина выполняется в главном событийном цикле приложения; если время ожидания истекло, она отменяется.
+    Если цикл не задан или не запущен (например, при запуске без ботов), корутина выполняется во временном цикле.
+
+    :param coroutine: Корутина запроса к модели.
+    :param loop: Главный событийный цикл приложения или None.
+    :param timeout: Время ожидания результата в секундах.
+    :raises LLMTimeoutError: Если результат не получен за отведённое время.
+    """
+    if loop is None or not loop.is_running():
+        return asyncio.run(coroutine)
+    try:
+        in_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        in_loop = False
+    if in_loop:
+        coroutine.close()
+        raise RuntimeError("Синхронный вызов модели нельзя выполнять из событийного цикла, используйте асинхронную версию.")
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        # Небольшой запас, чтобы таймаут сработал внутри цикла и был учтён в статистике
+        return future.result(timeout + 1)
+    except FutureTimeoutError:
+        future.cancel()
+        raise LLMTimeoutError(f"Модель не ответила за {timeout} с.")
+
+
+def iterate_async_sync(stream, loop, timeout):
+    """
+    Перебирает асинхронный генератор из синхронного кода (потока Flask).
+    Генератор выполняется в главном событийном цикле приложения, элементы передаются в поток через очередь.
+    Если синхронный генератор закрыт до конца (клиент отключился), выполнение в цикле отменяется.
+    Если цикл не задан или не запущен, генератор перебирается во временном цикле текущего потока.
+
+    :param stream: Асинхронный генератор.
+    :param loop: Главный событийный цикл приложения или None.
+    :param timeout: Максимальное время ожидания очередного элемента в секундах.
+    :return: Генератор элементов.
+    :raises LLMTimeoutError: Если очередной элемент не получен за отведённое время.
+    """
+    if loop is None or not loop.is_running():
+        yield from _iterate_in_new_loop(stream)
+        return
+    try:
+        in_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        in_loop = False
+    if in_loop:
+        raise RuntimeError("Синхронный вызов модели нельзя выполнять из событийного цикла, используйте асинхронную версию.")
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in stream:
+                items.put(item)
+            items.put(done)
+        except Exception as e:
+            items.put(e)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    try:
+        while True:
+            try:
+                item = items.get(timeout=timeout + 1)
+            except queue.Empty:
+                raise LLMTimeoutError(f"Модель не ответила за {timeout} с.")
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        future.cancel()
+
+
+def _iterate_in_new_loop(stream):
+    """
+    Перебирает асинхронный генератор во временном событийном цикле текущего потока.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(stream.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(stream.aclose())
+        loop.close()
+
+
+class AsyncLLMClient:
+    """
+    Асинхронный клиент OpenAI для одного API-ключа с собственной aiohttp-сессией.
+
+    Сессия создаётся лениво в событийном цикле, к которому привязан клиент (`bind_loop`), и переиспользует
+    соединения между запросами. Запросы из других циклов выполняются без общего пула.
+    """
+
+    def __init__(self, name, api_key, pool_size, request_timeout, connect_timeout, keepalive_timeout):
+        """
+        :param name: Имя клиента (используется в статистике).
+        :param api_key: API-ключ OpenAI, с которым выполняются все запросы клиента.
+        :param pool_size: Максимальное количество одновременных HTTP-соединений.
+        :param request_timeout: Максимальное время запроса к модели в секундах.
+        :param connect_timeout: Максимальное время установки соединения в секундах.
+        :param keepalive_timeout: Время хранения неиспользуемого соединения в секундах.
+        """
+        self.name = name
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.request_timeout = request_timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._loop = None
+        self._session = None
+        self._stats = {
+            "requests": 0,
+            "streams": 0,
+            "in_flight": 0,
+            "timeouts": 0,
+            "cancelled": 0,
+            "errors": 0,
+        }
+
+    def bind_loop(self, loop):
+        """
+        Привязывает клиент к главному событийному циклу приложения.
+        :param loop: Событийный цикл, в котором работают боты.
+        """
+        self._loop = loop
+
+    def _get_session(self):
+        """
+        Возвращает общую aiohttp-сессию, создавая её при первом вызове.
+        Вызывается только из привязанного событийного цикла.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            timeout = aiohttp.ClientTimeout(total=self.request_timeout, connect=self.connect_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def _in_bound_loop(self):
+        """
+        Проверяет, выполняется ли код в событийном цикле, к которому привязан клиент.
+        """
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def chat_completion(self, messages, temperature, max_tokens, model=LLM_MODEL, timeout=None):
+        """
+        Выполняет запрос к модели и возвращает текст ответа.
+
+        :param messages: Список сообщений для модели.
+        :param temperature: Температура генерации.
+        :param max_tokens: Максимальное количество токенов ответа.
+        :param model: Модель OpenAI.
+        :param timeout: Максимальное время запроса в секундах (по умолчанию request_timeout клиента).
+        :return: Текст ответа модели.
+        :raises LLMTimeoutError: Если модель не ответила за отведённое время.
+        """
+        timeout = timeout or self.request_timeout
+        # openai 0.28 берёт общую сессию из контекстной переменной; она устанавливается только в текущей задаче
+        session_token = openai.aiosession.set(self._get_session()) if self._in_bound_loop() else None
+        self._stats["requests"] += 1
+        self._stats["in_flight"] += 1
+        try:
+            response = await asyncio.wait_for(
+                openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    api_key=self.api_key,
+                    request_timeout=timeout
+                ),
+                timeout
+            )
+            return response.choices[0].message['content']
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise LLMTimeoutError(f"Модель не ответила за {timeout} с.")
+        except asyncio.CancelledError:
+            self._stats["cancelled"] += 1
+            raise
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._stats["in_flight"] -= 1
+            if session_token is not None:
+                openai.aiosession.reset(session_token)
+
+    async def chat_completion_stream(self, messages, temperature, max_tokens, model=LLM_MODEL, timeout=None):
+        """
+        Выполняет потоковый запрос к модели и отдаёт текст ответа частями по мере генерации.
+        Время всего ответа ограничено timeout; при отмене вызывающей задачи или закрытии генератора запрос прерывается.
+
+        :param messages: Список сообщений для модели.
+        :param temperature: Температура генерации.
+        :param max_tokens: Максимальное количество токенов ответа.
+        :param model: Модель OpenAI.
+        :param timeout: Максимальное время ответа в секундах (по умолчанию request_timeout клиента).
+        :return: Асинхронный генератор фрагментов текста.
+        :raises LLMTimeoutError: Если модель не закончила ответ за отведённое время.
+        """
+        timeout = timeout or self.request_timeout
+        deadline = time.monotonic() + timeout
+        session_token = openai.aiosession.set(self._get_session()) if self._in_bound_loop() else None
+        self._stats["requests"] += 1
+        self._stats["streams"] += 1
+        self._stats["in_flight"] += 1
+        chunks = None
+        try:
+            chunks = await asyncio.wait_for(
+                openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    api_key=self.api_key,
+                    request_timeout=timeout,
+                    stream=True
+                ),
+                timeout
+            )
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+                except StopAsyncIteration:
+                    break
+                delta = chunk.choices[0].delta.get('content') if chunk.choices else None
+                if delta:
+                    yield delta
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise LLMTimeoutError(f"Модель не ответила за {timeout} с.")
+        except (asyncio.CancelledError, GeneratorExit):
+            self._stats["cancelled"] += 1
+            raise
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._stats["in_flight"] -= 1
+            if chunks is not None:
+                with suppress(Exception):
+                    await chunks.aclose()
+            if session_token is not None:
+                # Генератор может быть закрыт из другого контекста, тогда сбрасывать переменную не нужно
+                with suppress(ValueError):
+                    openai.aiosession.reset(session_token)
+
+    def chat_completion_stream_sync(self, messages, temperature, max_tokens, model=LLM_MODEL, timeout=None):
+        """
+        Синхронная обертка над `chat_completion_stream` для потоков Flask (например, для ответа Server-Sent Events).
+        Запрос выполняется в привязанном событийном цикле, фрагменты передаются в поток Flask через очередь.
+        Если генератор закрыт до конца ответа (клиент отключился), запрос отменяется.
+
+        :return: Генератор фрагментов текста.
+        :raises LLMTimeoutError: Если модель не закончила ответ за отведённое время.
+        """
+        timeout = timeout or self.request_timeout
+        stream = self.chat_completion_stream(messages, temperature, max_tokens, model, timeout)
+        return iterate_async_sync(stream, self._loop, timeout)
+
+    def chat_completion_sync(self, messages, temperature, max_tokens, model=LLM_MODEL, timeout=None):
+        """
+        Синхронная обертка над `chat_completion` для потоков Flask.
+        Запрос выполняется в привязанном событийном цикле; если время ожидания истекло, запрос отменяется.
+        Если клиент не привязан к циклу (например, при запуске без ботов), запрос выполняется во временном цикле.
+
+        :return: Текст ответа модели.
+        :raises LLMTimeoutError: Если модель не ответила за отведённое время.
+        """
+        timeout = timeout or self.request_timeout
+        coroutine = self.chat_completion(messages, temperature, max_tokens, model, timeout)
+        return run_coroutine_sync(coroutine, self._loop, timeout)
+
+    def stats(self):
+        """
+        Возвращает статистику клиента.
+        :return: Словарь с количеством запросов, таймаутов, отмен и ошибок.
+        """
+        return {
+            "name": self.name,
+            "api_key": mask_api_key(self.api_key),
+            "pool_size": self.pool_size,
+            "request_timeout": self.request_timeout,
+            **self._stats,
+        }
+
+    async def close_when_idle(self):
+        """
+        Закрывает aiohttp-сессию после завершения выполняющихся запросов клиента.
+        """
+        while self._stats["in_flight"]:
+            await asyncio.sleep(0.1)
+        await self.close()
+
+    async def close(self):
+        """
+        Закрывает aiohttp-сессию клиента. Вызывается при остановке приложения в привязанном цикле.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            print(f"HTTP-сессия клиента '{self.name}' закрыта.")
+        self._session = None
+
+
+class LLMClientRegistry:
+    """
+    Потокобезопасный реестр клиентов OpenAI по API-ключам.
+    Клиенты переиспользуются между запросами; количество клиентов ограничено, давно неиспользуемые
+    клиенты вытесняются, а их HTTP-сессии закрываются.
+    """
+
+    def __init__(self, max_clients, **client_settings):
+        """
+        :param max_clients: Максимальное количество клиентов (API-ключей) в реестре.
+        :param client_settings: Настройки создаваемых клиентов (pool_size, request_timeout и т.д.).
+        """
+        self.max_clients = max(max_clients, 1)
+        self.client_settings = client_settings
+        self._clients = OrderedDict()  # API-ключ -> AsyncLLMClient
+        self._lock = threading.Lock()
+        self._loop = None
+        self._stats = {
+            "created": 0,
+            "evicted": 0,
+        }
+
+    def bind_loop(self, loop):
+        """
+        Привязывает реестр и все его клиенты к главному событийному циклу приложения.
+        :param loop: Событийный цикл, в котором работают боты.
+        """
+        with self._lock:
+            self._loop = loop
+            for client in self._clients.values():
+                client.bind_loop(loop)
+
+    def get(self, api_key):
+        """
+        Возвращает клиент для API-ключа, создавая его при первом обращении.
+        :param api_key: API-ключ OpenAI.
+        :return: Экземпляр AsyncLLMClient.
+        """
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is not None:
+                self._clients.move_to_end(api_key)
+                return client
+            client = AsyncLLMClient(name=f"openai-{mask_api_key(api_key)}", api_key=api_key, **self.client_settings)
+            client.bind_loop(self._loop)
+            self._clients[api_key] = client
+            self._stats["created"] += 1
+            while len(self._clients) > self.max_clients:
+                _, evicted = self._clients.popitem(last=False)
+                self._stats["evicted"] += 1
+                self._close_later(evicted)
+            return client
+
+    def run_sync(self, coroutine, timeout=LLM_REQUEST_TIMEOUT):
+        """
+        Выполняет корутину, использующую клиенты реестра, из синхронного кода в привязанном событийном цикле.
+        См. run_coroutine_sync().
+        """
+        return run_coroutine_sync(coroutine, self._loop, timeout)
+
+    def iterate_sync(self, stream, timeout=LLM_REQUEST_TIMEOUT):
+        """
+        Перебирает асинхронный генератор, использующий клиенты реестра, из синхронного кода
+        в привязанном событийном цикле. См. iterate_async_sync().
+        """
+        return iterate_async_sync(stream, self._loop, timeout)
+
+    def _close_later(self, client):
+        """
+        Закрывает HTTP-сессию вытесненного клиента в привязанном событийном цикле после завершения его запросов.
+        """
+        if self._loop is not None and self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.close_when_idle(), self._loop)
+
+    def stats(self):
+        """
+        Возвращает статистику реестра и всех клиентов.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            stats = {"clients": len(clients), "max_clients": self.max_clients, **self._stats}
+        stats["per_client"] = [client.stats() for client in clients]
+        return stats
+
+    async def close(self):
+        """
+        Закрывает HTTP-сессии всех клиентов. Вызывается при остановке приложения в привязанном цикле.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            await client.close()
+
+
+# Реестр клиентов OpenAI для использования во всем приложении
+llm_clients = LLMClientRegistry(
+    max_clients=LLM_MAX_CLIENTS,
+    pool_size=LLM_HTTP_POOL_SIZE,
+    request_timeout=LLM_REQUEST_TIMEOUT,
+    connect_timeout=LLM_CONNECT_TIMEOUT,
+    keepalive_timeout=LLM_KEEPALIVE_TIMEOUT,
+)
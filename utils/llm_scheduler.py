@@ -0,0 +1,355 @@
+"""
+llm_scheduler.py
+Планировщик запросов к модели с учётом лимитов OpenAI для каждого API-ключа.
+
+Для каждого ключа ведутся бюджеты запросов в минуту (RPM) и токенов в минуту (TPM) в виде пополняемых корзин
+и ограничивается количество одновременных запросов. Запрос, превышающий бюджет, ждёт в очереди ключа (FIFO),
+а не получает ошибку 429. Ответы 429 и ошибки сервера 5xx повторяются с экспоненциальной задержкой со случайным
+разбросом; заголовок Retry-After соблюдается и приостанавливает все запросы ключа.
+
+По каждому агенту собирается статистика: длина очереди, время ожидания, количество повторов.
+
+Бюджеты ведутся в памяти процесса. В режиме супервизора Telegram-ботов (TELEGRAM_WORKER_PROCESSES > 0) запросы
+к модели выполняют супервизор (веб-чат) и каждый обработчик, поэтому LLM_KEY_RPM и LLM_KEY_TPM делятся поровну
+между TELEGRAM_WORKER_PROCESSES + 1 процессами. Обработчики, добавленные позже (`ShardSupervisor.add_worker`),
+в расчёте не учитываются.
+"""
+
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from utils.utils import estimate_tokens
+from utils.llm_client import mask_api_key
+import asyncio
+import random
+import openai
+import time
+import os
+
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+
+LLM_KEY_RPM = int(os.getenv('LLM_KEY_RPM', 500))
+LLM_KEY_TPM = int(os.getenv('LLM_KEY_TPM', 200000))
+LLM_KEY_MAX_CONCURRENCY = int(os.getenv('LLM_KEY_MAX_CONCURRENCY', 20))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 3))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', 0.5))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', 20))
+LLM_MAX_QUEUE_WAIT = float(os.getenv('LLM_MAX_QUEUE_WAIT', 30))
+# Количество процессов, выполняющих запросы к модели с собственными бюджетами ключей
+LLM_PROCESSES = int(os.getenv('TELEGRAM_WORKER_PROCESSES', 0)) + 1
+
+
+class LLMRateLimitError(Exception):
+    """
+    Исключение, возникающее, когда запрос не дождался бюджета API-ключа или свободного слота одновременных запросов
+    за LLM_MAX_QUEUE_WAIT секунд.
+    """
+
+
+def estimate_request_tokens(messages, max_tokens):
+    """
+    Оценивает количество токенов запроса для бюджета TPM: сообщения запроса плюс максимальная длина ответа.
+    """
+    return sum(estimate_tokens(message['content']) for message in messages) + (max_tokens or 0)
+
+
+def retry_after_seconds(error):
+    """
+    Возвращает задержку из заголовка Retry-After ответа OpenAI или None, если заголовка нет.
+    """
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """
+    Проверяет, можно ли повторить запрос после ошибки: 429 (кроме исчерпанной квоты), 5xx и обрывы соединения.
+    """
+    if isinstance(error, openai.error.RateLimitError):
+        return error.code != 'insufficient_quota'
+    if isinstance(error, (openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+                          openai.error.TryAgain)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return (error.http_status or 500) >= 500
+    return False
+
+
+class KeyBudget:
+    """
+    Бюджет одного API-ключа: корзины запросов и токенов, пополняемые равномерно в течение минуты,
+    и ограничение одновременных запросов. Ожидающие запросы обслуживаются по очереди.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrency):
+        """
+        :param rpm: Лимит запросов в минуту.
+        :param tpm: Лимит токенов в минуту.
+        :param max_concurrency: Максимальное количество одновременных запросов.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0  # Время, до которого запросы приостановлены по Retry-After
+        self.waiting = 0
+        self.queue = asyncio.Lock()  # asyncio.Lock пропускает ожидающих в порядке очереди
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+
+    def _refill(self):
+        """
+        Пополняет корзины пропорционально прошедшему времени.
+        """
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def _delay(self, tokens):
+        """
+        Возвращает время в секундах, через которое в бюджете будет место для запроса.
+        """
+        self._refill()
+        delay = max(0.0, self.paused_until - time.monotonic())
+        if self.requests < 1:
+            delay = max(delay, (1 - self.requests) * 60 / self.rpm)
+        if self.tokens < tokens:
+            delay = max(delay, (tokens - self.tokens) * 60 / self.tpm)
+        return delay
+
+    async def reserve(self, tokens, deadline):
+        """
+        Ожидает своей очереди и места в бюджете, затем списывает запрос и токены.
+        :param tokens: Оценка токенов запроса.
+        :param deadline: Время (time.monotonic), после которого ожидание прекращается.
+        :raises LLMRateLimitError: Если место в бюджете не появилось до deadline.
+        """
+        tokens = min(tokens, self.tpm)
+        async with self.queue:
+            while True:
+                delay = self._delay(tokens)
+                if delay <= 0:
+                    break
+                if time.monotonic() + delay > deadline:
+                    raise LLMRateLimitError("Превышен лимит запросов к модели, попробуйте позже.")
+                await asyncio.sleep(delay)
+            self.requests -= 1
+            self.tokens -= tokens
+
+    def pause(self, seconds):
+        """
+        Приостанавливает запросы ключа (после ответа 429 с Retry-After).
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self):
+        """
+        Возвращает текущее состояние бюджета.
+        """
+        self._refill()
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "requests_available": int(self.requests),
+            "tokens_available": int(self.tokens),
+            "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 2),
+            "waiting": self.waiting,
+        }
+
+
+class LLMScheduler:
+    """
+    Планировщик запросов к модели по API-ключам с очередью, повторами и статистикой по агентам.
+    Бюджеты ключей привязаны к событийному циклу, в котором выполняются запросы.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrency, max_retries, backoff_base, backoff_max, max_queue_wait):
+        """
+        :param rpm: Лимит запросов в минуту для каждого ключа.
+        :param tpm: Лимит токенов в минуту для каждого ключа.
+        :param max_concurrency: Максимальное количество одновременных запросов для каждого ключа.
+        :param max_retries: Максимальное количество повторов после 429 и 5xx.
+        :param backoff_base: Начальная задержка повтора в секундах.
+        :param backoff_max: Максимальная задержка повтора в секундах.
+        :param max_queue_wait: Максимальное время ожидания в очереди ключа в секундах.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_queue_wait = max_queue_wait
+        self._budgets = {}  # (цикл, API-ключ) -> KeyBudget
+        self._agents = {}  # ID агента -> статистика
+
+    def _budget(self, api_key):
+        """
+        Возвращает бюджет API-ключа, создавая его при первом обращении.
+        """
+        key = (id(asyncio.get_running_loop()), api_key)
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = KeyBudget(self.rpm, self.tpm, self.max_concurrency)
+            self._budgets[key] = budget
+        return budget
+
+    def _agent_stats(self, agent_id):
+        """
+        Возвращает словарь статистики агента, создавая его при первом обращении.
+        """
+        stats = self._agents.get(agent_id)
+        if stats is None:
+            stats = {
+                "queued": 0,
+                "requests": 0,
+                "waits": 0,
+                "total_wait_ms": 0.0,
+                "max_wait_ms": 0.0,
+                "retries": 0,
+                "rate_limited": 0,
+                "rejected": 0,
+            }
+            self._agents[agent_id] = stats
+        return stats
+
+    def _backoff(self, attempt, error):
+        """
+        Возвращает задержку перед повтором: Retry-After, если он указан, иначе экспоненциальную задержку
+        со случайным разбросом (full jitter).
+        """
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @asynccontextmanager
+    async def slot(self, agent_id, api_key, tokens):
+        """
+        Асинхронный контекстный менеджер: ожидает места в бюджете ключа и свободного слота одновременных запросов.
+        :param agent_id: ID агента (для статистики).
+        :param api_key: API-ключ агента.
+        :param tokens: Оценка токенов запроса.
+        :raises LLMRateLimitError: Если место в бюджете и слот не освободились за max_queue_wait секунд.
+        """
+        budget = self._budget(api_key)
+        stats = self._agent_stats(agent_id)
+        started = time.monotonic()
+        deadline = started + self.max_queue_wait
+        stats["queued"] += 1
+        budget.waiting += 1
+        try:
+            await budget.reserve(tokens, deadline)
+            if budget.concurrency.locked():
+                try:
+                    await asyncio.wait_for(budget.concurrency.acquire(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    raise LLMRateLimitError("Превышено количество одновременных запросов к модели, "
+                                            "попробуйте позже.") from None
+            else:
+                await budget.concurrency.acquire()
+        except LLMRateLimitError:
+            stats["rejected"] += 1
+            raise
+        finally:
+            stats["queued"] -= 1
+            budget.waiting -= 1
+        wait_ms = (time.monotonic() - started) * 1000
+        stats["requests"] += 1
+        if wait_ms >= 1:
+            stats["waits"] += 1
+            stats["total_wait_ms"] = round(stats["total_wait_ms"] + wait_ms, 2)
+            stats["max_wait_ms"] = max(stats["max_wait_ms"], round(wait_ms, 2))
+        try:
+            yield budget
+        finally:
+            budget.concurrency.release()
+
+    async def _handle_error(self, agent_id, budget, attempt, error):
+        """
+        Решает, повторять ли запрос после ошибки, и ожидает задержку перед повтором.
+        :raises: Исходную ошибку, если повтор невозможен.
+        """
+        if not is_retryable(error) or attempt >= self.max_retries:
+            raise error
+        stats = self._agent_stats(agent_id)
+        delay = self._backoff(attempt, error)
+        if isinstance(error, openai.error.RateLimitError):
+            stats["rate_limited"] += 1
+            budget.pause(delay)
+        stats["retries"] += 1
+        await asyncio.sleep(delay)
+
+    async def run(self, agent_id, api_key, messages, max_tokens, make_call):
+        """
+        Выполняет запрос к модели с учётом бюджета ключа и повторяет его после 429 и 5xx.
+        :param agent_id: ID агента.
+        :param api_key: API-ключ агента.
+        :param messages: Сообщения запроса (для оценки токенов).
+        :param max_tokens: Максимальная длина ответа в токенах.
+        :param make_call: Функция без аргументов, возвращающая корутину запроса.
+        :return: Результат запроса.
+        """
+        tokens = estimate_request_tokens(messages, max_tokens)
+        attempt = 0
+        while True:
+            async with self.slot(agent_id, api_key, tokens) as budget:
+                try:
+                    return await make_call()
+                except openai.error.OpenAIError as e:
+                    error = e
+            await self._handle_error(agent_id, budget, attempt, error)
+            attempt += 1
+
+    async def stream(self, agent_id, api_key, messages, max_tokens, make_stream):
+        """
+        Выполняет потоковый запрос к модели с учётом бюджета ключа. Запрос повторяется после 429 и 5xx,
+        только если пользователю ещё не был отдан ни один фрагмент ответа.
+        :param make_stream: Функция без аргументов, возвращающая асинхронный генератор фрагментов.
+        :return: Асинхронный генератор фрагментов ответа.
+        """
+        tokens = estimate_request_tokens(messages, max_tokens)
+        attempt = 0
+        while True:
+            started = False
+            async with self.slot(agent_id, api_key, tokens) as budget:
+                try:
+                    async for delta in make_stream():
+                        started = True
+                        yield delta
+                    return
+                except openai.error.OpenAIError as e:
+                    if started:
+                        raise
+                    error = e
+            await self._handle_error(agent_id, budget, attempt, error)
+            attempt += 1
+
+    def stats(self):
+        """
+        Возвращает статистику планировщика по агентам и API-ключам.
+        """
+        return {
+            "agents": {str(agent_id): dict(stats) for agent_id, stats in self._agents.items()},
+            "keys": {mask_api_key(api_key): budget.stats() for (_, api_key), budget in self._budgets.items()},
+        }
+
+
+# Планировщик запросов к модели для использования во всем приложении
+llm_scheduler = LLMScheduler(
+    rpm=max(1, LLM_KEY_RPM // LLM_PROCESSES),
+    tpm=max(1, LLM_KEY_TPM // LLM_PROCESSES),
+    max_concurrency=LLM_KEY_MAX_CONCURRENCY,
+    max_retries=LLM_MAX_RETRIES,
+    backoff_base=LLM_BACKOFF_BASE,
+    backoff_max=LLM_BACKOFF_MAX,
+    max_queue_wait=LLM_MAX_QUEUE_WAIT,
+)
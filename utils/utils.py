@@ -315,3 +315,69 @@ def get_telegram_bot_name_and_username_by_token(api_token: str):
         return None
     except requests.RequestException:
         return None
+
+
+import math
+
+# Окно истории диалога по умолчанию (если у агента оно не настроено)
+DEFAULT_HISTORY_MAX_TURNS = 20  # Максимальное количество пар "сообщение пользователя - ответ бота"
+DEFAULT_HISTORY_TOKEN_BUDGET = 2000  # Максимальное количество токенов истории, отправляемых в модель
+HISTORY_PAGE_SIZE = 10  # Количество пар, читаемых из базы за один запрос
+CHARS_PER_TOKEN = 3  # Среднее количество символов на токен (с запасом для кириллицы)
+
+def estimate_tokens(text):
+    """
+    Приблизительно оценивает количество токенов в тексте.
+    :param text: Текст сообщения (может быть None).
+    :return: Оценка количества токенов.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def get_history_window(agent):
+    """
+    Возвращает окно истории диалога, настроенное для агента.
+    :param agent: Словарь с данными агента.
+    :return: Кортеж (максимальное количество пар сообщений, бюджет токенов).
+    """
+    max_turns = agent.get('history_max_turns') if agent else None
+    token_budget = agent.get('history_token_budget') if agent else None
+    return (
+        DEFAULT_HISTORY_MAX_TURNS if max_turns is None else max_turns,
+        DEFAULT_HISTORY_TOKEN_BUDGET if token_budget is None else token_budget,
+    )
+
+
+def take_turns_within_budget(records, turns, used_tokens, token_budget):
+    """
+    Добавляет в `turns` записи истории (от новых к старым), пока они помещаются в бюджет токенов.
+    :param records: Записи чата, отсортированные от новых к старым.
+    :param turns: Список уже принятых записей (дополняется на месте).
+    :param used_tokens: Количество токенов, уже занятых принятыми записями.
+    :param token_budget: Бюджет токенов.
+    :return: Кортеж (занятые токены, True если бюджет исчерпан).
+    """
+    for record in records:
+        tokens = estimate_tokens(record['user_message']) + estimate_tokens(record['bot_response'])
+        if used_tokens + tokens > token_budget:
+            return used_tokens, True
+        used_tokens += tokens
+        turns.append(record)
+    return used_tokens, False
+
+
+def format_recent_history(turns):
+    """
+    Преобразует записи истории (от новых к старым) в список сообщений для модели в хронологическом порядке.
+    :param turns: Записи чата с полями user_message и bot_response.
+    :return: Список словарей с ролью (user или assistant) и текстом сообщения (content).
+    """
+    conversation_history = []
+    for record in reversed(turns):
+        if record['user_message']:
+            conversation_history.append({"role": "user", "content": record['user_message']})
+        if record['bot_response']:
+            conversation_history.append({"role": "assistant", "content": record['bot_response']})
+    return conversation_history